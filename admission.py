@@ -0,0 +1,186 @@
+#!/usr/bin/env python3.10
+
+"""
+Admission control cho các lượt gọi OpenAI của Moon Discord Bot
+
+Giới hạn số request OpenAI chạy đồng thời, giới hạn tốc độ theo người dùng và
+theo server bằng token bucket, và xếp hàng chờ có giới hạn theo độ ưu tiên:
+mention (người dùng đang nhìn) được chạy trước /chat (đã defer, có 15 phút).
+Khi hàng đợi đầy, request bị từ chối ngay thay vì chờ tới timeout.
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Tuple
+
+from metrics import ERRORS_TOTAL
+
+# Độ ưu tiên trong hàng đợi (số nhỏ chạy trước)
+PRIORITY_MENTION = 0
+PRIORITY_COMMAND = 1
+
+# Số bucket tối đa giữ trong bộ nhớ trước khi dọn các bucket đã đầy lại
+_MAX_BUCKETS = 10_000
+
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối: vượt giới hạn tốc độ hoặc hàng đợi đã đầy"""
+
+    def __init__(self, reason: str, retry_after: float = 0.0):
+        super().__init__(f"{reason} (retry after {retry_after:.1f}s)")
+        # "user_rate", "guild_rate" hoặc "queue_full"
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket: nạp `rate` token mỗi giây, chứa tối đa `capacity` token"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, now: float | None = None) -> float:
+        """Lấy một token; trả về 0 nếu thành công, ngược lại số giây cần chờ"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class AdmissionController:
+    """Cổng vào cho mọi lượt gọi OpenAI
+
+    check_rate() được gọi ngay khi nhận câu hỏi; slot() bao quanh lượt gọi
+    OpenAI và giữ một trong `max_concurrent` chỗ chạy đồng thời.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 8,
+        max_queue: int = 32,
+        user_rate_per_minute: float = 6.0,
+        user_burst: int = 3,
+        guild_rate_per_minute: float = 30.0,
+        guild_burst: int = 10,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.user_rate = user_rate_per_minute / 60
+        self.user_burst = max(1, user_burst)
+        self.guild_rate = guild_rate_per_minute / 60
+        self.guild_burst = max(1, guild_burst)
+        self._user_buckets: Dict[str, TokenBucket] = {}
+        self._guild_buckets: Dict[str, TokenBucket] = {}
+        self._active = 0
+        # Heap (priority, thứ tự đến, future) của các request đang chờ chỗ chạy
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self.rejected = 0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    # --- Giới hạn tốc độ ---
+    @staticmethod
+    def _bucket(buckets: Dict[str, TokenBucket], key: str, rate: float, burst: int, now: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= _MAX_BUCKETS:
+                # Bucket đã đầy lại tương đương bucket mới, bỏ đi để giới hạn bộ nhớ
+                for stale in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[stale]
+            bucket = TokenBucket(rate, burst)
+            buckets[key] = bucket
+        return bucket
+
+    def check_rate(self, user_id: str, guild_id: str | None = None):
+        """Trừ một token của người dùng và server, raise AdmissionRejected nếu hết"""
+        now = time.monotonic()
+        user_bucket = None
+        if self.user_rate > 0:
+            user_bucket = self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst, now)
+            wait = user_bucket.try_acquire(now)
+            if wait:
+                self.rejected += 1
+                ERRORS_TOTAL.inc("admission", "user_rate")
+                raise AdmissionRejected("user_rate", wait)
+        if guild_id and self.guild_rate > 0:
+            guild_bucket = self._bucket(self._guild_buckets, guild_id, self.guild_rate, self.guild_burst, now)
+            wait = guild_bucket.try_acquire(now)
+            if wait:
+                # Không tính lượt bị từ chối vào quota của người dùng
+                if user_bucket:
+                    user_bucket.refund()
+                self.rejected += 1
+                ERRORS_TOTAL.inc("admission", "guild_rate")
+                raise AdmissionRejected("guild_rate", wait)
+
+    # --- Giới hạn đồng thời ---
+    def _release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # Chuyển thẳng chỗ chạy cho request ưu tiên nhất đang chờ
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_MENTION) -> AsyncIterator[None]:
+        """Giữ một chỗ chạy trong suốt lượt gọi OpenAI"""
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                ERRORS_TOTAL.inc("admission", "queue_full")
+                raise AdmissionRejected("queue_full", 0.0)
+            entry = (priority, next(self._sequence), asyncio.get_running_loop().create_future())
+            heapq.heappush(self._waiters, entry)
+            try:
+                await entry[2]
+            except asyncio.CancelledError:
+                if entry[2].done() and not entry[2].cancelled():
+                    # Đã được nhường chỗ ngay trước khi bị hủy: trả lại chỗ
+                    self._release()
+                elif entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "rejected": self.rejected,
+        }
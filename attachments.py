@@ -0,0 +1,257 @@
+#!/usr/bin/env python3.10
+
+"""
+Xử lý file đính kèm cho Moon Discord Bot
+
+Tải file đính kèm từ Discord một lần (có giới hạn dung lượng), thu nhỏ ảnh
+lớn trong process pool, băm nội dung và upload lên OpenAI. File ID được cache
+theo hash nên ảnh/PDF gửi lại nhiều lần chỉ upload một lần. PDF có text được
+trích xuất cục bộ và gửi dạng input_text; PDF scan vẫn được upload. Khi có
+lỗi, file được gửi dạng URL như trước.
+
+File upload có hạn dùng trên OpenAI (dài hơn TTL của cache một chút) và tự
+hết hạn thay vì bị xóa khi bot dừng: chuỗi hội thoại lưu trong SQLite vẫn có
+thể tham chiếu tới file sau khi khởi động lại.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List
+from urllib.parse import urlparse
+
+import aiohttp
+
+from cache import TTLCache
+
+try:
+    import PIL  # noqa: F401
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+try:
+    import pypdf  # noqa: F401
+    PYPDF_AVAILABLE = True
+except ImportError:
+    PYPDF_AVAILABLE = False
+
+IMAGE = "image"
+PDF = "pdf"
+# Giới hạn expires_after của Files API (1 giờ tới 30 ngày)
+FILE_MIN_EXPIRY = 3600
+FILE_MAX_EXPIRY = 30 * 86400
+
+
+class AttachmentTooLarge(Exception):
+    """File đính kèm vượt quá dung lượng cho phép"""
+
+
+@dataclass(frozen=True)
+class Attachment:
+    """File đính kèm đã sẵn sàng để đưa vào input của Responses API"""
+    kind: str
+    url: str
+    sha256: str | None = None
+    file_id: str | None = None
+    # Text trích xuất sẵn từ PDF (đã kèm tiêu đề), được gửi thay cho file
+    text: str | None = None
+
+    def input_block(self) -> Dict[str, Any]:
+        if self.text is not None:
+            return {"type": "input_text", "text": self.text}
+        if self.kind == IMAGE:
+            if self.file_id:
+                return {"type": "input_image", "file_id": self.file_id, "detail": "auto"}
+            return {"type": "input_image", "image_url": self.url}
+        if self.file_id:
+            return {"type": "input_file", "file_id": self.file_id}
+        return {"type": "input_file", "file_url": self.url}
+
+
+def downscale_image(data: bytes, max_edge: int, quality: int) -> tuple[bytes, str, str]:
+    """Thu nhỏ ảnh về cạnh dài tối đa max_edge (chạy trong process pool)
+
+    Trả về (dữ liệu, phần mở rộng, mime type). Ảnh đã đủ nhỏ được giữ nguyên.
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image_format = (image.format or "").upper()
+        if max(image.size) <= max_edge and image_format in ("JPEG", "PNG", "WEBP"):
+            return data, image_format.lower().replace("jpeg", "jpg"), f"image/{image_format.lower()}"
+        # Ảnh động (GIF/WebP) chỉ giữ khung hình đầu, model cũng chỉ xem khung này
+        image.seek(0)
+        image.thumbnail((max_edge, max_edge))
+        output = io.BytesIO()
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        if has_alpha:
+            image.save(output, format="PNG", optimize=True)
+            return output.getvalue(), "png", "image/png"
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue(), "jpg", "image/jpeg"
+
+
+def extract_pdf_text(data: bytes, max_pages: int, max_chars: int) -> tuple[str, int, int]:
+    """Trích xuất text từ tối đa max_pages trang đầu (chạy trong process pool)
+
+    Trả về (text, số trang đã đọc, tổng số trang).
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(io.BytesIO(data))
+    total_pages = len(reader.pages)
+    parts = []
+    length = 0
+    pages_read = 0
+    for page in reader.pages[:max_pages]:
+        page_text = (page.extract_text() or "").strip()
+        pages_read += 1
+        if page_text:
+            parts.append(page_text)
+            length += len(page_text)
+        if length >= max_chars:
+            break
+    return "\n\n".join(parts)[:max_chars], pages_read, total_pages
+
+
+class AttachmentPipeline:
+    """Tải, thu nhỏ, băm và upload file đính kèm, dùng lại file ID theo hash"""
+
+    def __init__(
+        self,
+        client: Any,
+        max_bytes: int = 20 * 1024 * 1024,
+        image_max_edge: int = 1536,
+        image_quality: int = 85,
+        cache_size: int = 512,
+        cache_ttl: float = 7 * 86400,
+        workers: int = 2,
+        pdf_extract_text: bool = True,
+        pdf_max_pages: int = 30,
+        pdf_max_chars: int = 60000,
+        pdf_min_chars_per_page: int = 200,
+    ):
+        self.client = client
+        self.max_bytes = max_bytes
+        self.image_max_edge = image_max_edge
+        self.image_quality = image_quality
+        self.workers = workers
+        self.pdf_extract_text = pdf_extract_text and PYPDF_AVAILABLE
+        self.pdf_max_pages = pdf_max_pages
+        self.pdf_max_chars = pdf_max_chars
+        # Ít text hơn mức này mỗi trang thì coi là PDF scan và upload nguyên file
+        self.pdf_min_chars_per_page = pdf_min_chars_per_page
+        # sha256 -> file ID trên OpenAI
+        self.file_ids = TTLCache("attachments", max_entries=cache_size, default_ttl=cache_ttl)
+        # File trên OpenAI hết hạn sau cache_ttl (+1 giờ để cache không trả về file đã hết hạn)
+        self.file_expiry = int(min(max(cache_ttl + 3600, FILE_MIN_EXPIRY), FILE_MAX_EXPIRY))
+        # sha256 -> text trích xuất từ PDF (None nếu là PDF scan)
+        self.pdf_texts = TTLCache("pdf_text", max_entries=cache_size, max_bytes=64 * 1024 * 1024, default_ttl=cache_ttl)
+        self._executor: ProcessPoolExecutor | None = None
+        self.session: aiohttp.ClientSession | None = None
+
+    def start(self, session: aiohttp.ClientSession):
+        self.session = session
+        if (PIL_AVAILABLE or self.pdf_extract_text) and self.workers > 0 and self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        if not PIL_AVAILABLE:
+            logging.warning("Chưa cài Pillow, ảnh đính kèm sẽ được upload nguyên bản")
+        if not PYPDF_AVAILABLE:
+            logging.warning("Chưa cài pypdf, file PDF sẽ được upload nguyên bản")
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _download(self, url: str) -> bytes:
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > self.max_bytes:
+                raise AttachmentTooLarge(f"{response.content_length} bytes")
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                buffer.extend(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise AttachmentTooLarge(f"> {self.max_bytes} bytes")
+            return bytes(buffer)
+
+    async def _upload(self, kind: str, url: str, data: bytes) -> str:
+        filename = os.path.basename(urlparse(url).path) or "attachment"
+        if kind == IMAGE:
+            mime = mimetypes.guess_type(filename)[0] or "image/png"
+            if self._executor is not None and PIL_AVAILABLE:
+                loop = asyncio.get_running_loop()
+                data, extension, mime = await loop.run_in_executor(
+                    self._executor, downscale_image, data, self.image_max_edge, self.image_quality
+                )
+                filename = f"{os.path.splitext(filename)[0]}.{extension}"
+            purpose = "vision"
+        else:
+            mime = "application/pdf"
+            purpose = "user_data"
+        uploaded = await self.client.files.create(
+            file=(filename, data, mime),
+            purpose=purpose,
+            extra_body={"expires_after": {"anchor": "created_at", "seconds": self.file_expiry}},
+        )
+        logging.info(f"Uploaded attachment {filename} ({len(data)} bytes) as {uploaded.id}")
+        return uploaded.id
+
+    async def _extract_pdf(self, url: str, data: bytes) -> str | None:
+        loop = asyncio.get_running_loop()
+        text, pages_read, total_pages = await loop.run_in_executor(
+            self._executor, extract_pdf_text, data, self.pdf_max_pages, self.pdf_max_chars
+        )
+        if len(text) < self.pdf_min_chars_per_page * pages_read:
+            logging.info(f"PDF has too little text ({len(text)} chars / {pages_read} pages), uploading file instead")
+            return None
+        filename = os.path.basename(urlparse(url).path) or "file.pdf"
+        truncated = pages_read < total_pages or len(text) >= self.pdf_max_chars
+        header = f"[Nội dung file PDF {filename}, {total_pages} trang"
+        header += f", đã cắt bớt sau trang {pages_read}]" if truncated else "]"
+        return f"{header}\n{text}"
+
+    async def prepare(self, kind: str, url: str) -> Attachment:
+        """Chuẩn bị một file đính kèm; lỗi ở bất kỳ bước nào thì dùng URL gốc"""
+        if self.session is None:
+            return Attachment(kind, url)
+        try:
+            data = await self._download(url)
+        except AttachmentTooLarge as e:
+            logging.warning(f"Attachment too large to ingest, sending URL instead: {e}")
+            return Attachment(kind, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Could not download attachment, sending URL instead: {e}")
+            return Attachment(kind, url)
+
+        digest = hashlib.sha256(data).hexdigest()
+        if kind == PDF and self.pdf_extract_text and self._executor is not None:
+            try:
+                text = await self.pdf_texts.get_or_load(digest, lambda: self._extract_pdf(url, data))
+            except Exception as e:
+                logging.warning(f"Could not extract PDF text, uploading file instead: {e}")
+                text = None
+            if text is not None:
+                return Attachment(kind, url, sha256=digest, text=text)
+        try:
+            # Cùng nội dung (kể cả đang upload song song) chỉ upload một lần
+            file_id = await self.file_ids.get_or_load(
+                (kind, digest), lambda: self._upload(kind, url, data)
+            )
+        except Exception as e:
+            logging.warning(f"Could not upload attachment, sending URL instead: {e}")
+            return Attachment(kind, url, sha256=digest)
+        return Attachment(kind, url, sha256=digest, file_id=file_id)
+
+    async def prepare_all(self, images: List[str], pdfs: List[str]) -> List[Attachment]:
+        return list(await asyncio.gather(
+            *(self.prepare(IMAGE, url) for url in images),
+            *(self.prepare(PDF, url) for url in pdfs),
+        ))
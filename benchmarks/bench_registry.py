@@ -0,0 +1,72 @@
+#!/usr/bin/env python3.10
+
+"""
+Micro-benchmark cho FunctionRegistry
+
+Đo chi phí mỗi request của phần registry trong ask_openai:
+- dựng danh sách `tools` (cách cũ: tạo list mới từ get_schemas mỗi request,
+  cách mới: tools_payload() dùng lại cùng một object)
+- validate + ép kiểu tham số trước khi gọi function
+
+Chạy: python benchmarks/bench_registry.py
+"""
+
+import asyncio
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from registry import FunctionRegistry  # noqa: E402
+from functions import register_all_functions  # noqa: E402
+
+
+def legacy_tools(registry: FunctionRegistry):
+    tools = []
+    function_tools = registry.get_schemas()
+    if function_tools:
+        tools.extend(function_tools)
+    return tools if tools else None
+
+
+def report(label: str, seconds: float, number: int):
+    print(f"{label:<45} {seconds / number * 1e6:8.3f} µs/request")
+
+
+def main():
+    registry = FunctionRegistry()
+    register_all_functions(registry)
+
+    @registry.register(name="noop")
+    async def noop(city: str, days: int, metric: bool):
+        return "ok"
+
+    number = 200_000
+    report("tools: rebuild list per request", timeit.timeit(lambda: legacy_tools(registry), number=number), number)
+    report("tools: frozen tools_payload()", timeit.timeit(registry.tools_payload, number=number), number)
+
+    validate = registry.validators["noop"]
+    arguments = {"city": "Hà Nội", "days": "3", "metric": "true"}
+    report("validate + coerce 3 arguments", timeit.timeit(lambda: validate(arguments), number=number), number)
+
+    loop = asyncio.new_event_loop()
+    number = 20_000
+    good = {"city": "Hà Nội", "days": 3, "metric": True}
+    bad = {"city": "Hà Nội"}
+    report(
+        "call_function (valid arguments)",
+        timeit.timeit(lambda: loop.run_until_complete(registry.call_function("noop", good)), number=number),
+        number,
+    )
+    report(
+        "call_function (rejected before dispatch)",
+        timeit.timeit(lambda: loop.run_until_complete(registry.call_function("noop", bad)), number=number),
+        number,
+    )
+    loop.close()
+    print(f"schema version: {registry.schema_version} ({len(registry.schemas_json)} bytes)")
+
+
+if __name__ == "__main__":
+    main()
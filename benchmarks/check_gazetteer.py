@@ -0,0 +1,65 @@
+#!/usr/bin/env python3.10
+
+"""
+Kiểm tra hồi quy của gazetteer offline
+
+Mỗi trường hợp là một địa chỉ và địa danh mong đợi (None = gazetteer phải bỏ
+qua để get_weather gọi geocoding API). Các địa danh nước ngoài có tên tiếng
+Việt gần giống tên tỉnh ("Bắc Kinh" ~ Bắc Ninh, "Lào" ~ Lào Cai) hay địa chỉ
+ở nước khác ("Hue, Texas") không được trả về một tỉnh của Việt Nam.
+
+Chạy: python benchmarks/check_gazetteer.py
+"""
+
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gazetteer import Gazetteer  # noqa: E402
+
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gazetteer_vn.json")
+
+CASES = [
+    # Địa danh Việt Nam
+    ("Hà Nội", "Thành phố Hà Nội"),
+    ("Hanoi", "Thành phố Hà Nội"),
+    ("Sai Gon", "Thành phố Hồ Chí Minh"),
+    ("Ho Chi Min", "Thành phố Hồ Chí Minh"),
+    ("Quận 1, TP HCM", "Quận 1, Thành phố Hồ Chí Minh"),
+    ("Huế", "Thành phố Huế"),
+    ("Đà Lạt", "Đà Lạt, Lâm Đồng"),
+    ("Lào Cai", "Lào Cai"),
+    ("Lao Cai", "Lào Cai"),
+    ("Bac Ninh", "Bắc Ninh"),
+    ("Sapa", "Sa Pa, Lào Cai"),
+    ("Ba Ria", "Bà Rịa, Thành phố Hồ Chí Minh"),
+    # Nước ngoài: để geocoding API xử lý
+    ("Bắc Kinh", None),
+    ("Bac Kinh", None),
+    ("Bắc Kinh, Trung Quốc", None),
+    ("Lào", None),
+    ("Viêng Chăn, Lào", None),
+    ("Hue, Texas", None),
+    ("Paris, France", None),
+    ("Tokyo", None),
+]
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    gazetteer = Gazetteer.load(GAZETTEER_FILE)
+    failed = 0
+    for address, expected in CASES:
+        place = gazetteer.lookup(address)
+        actual = place.display_name if place else None
+        ok = actual == expected
+        failed += not ok
+        print(f"{address:<28} {str(actual):<40} {'PASS' if ok else f'FAIL: expected {expected}'}")
+    print(f"{len(CASES) - failed}/{len(CASES)} cases passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
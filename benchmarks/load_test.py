@@ -0,0 +1,374 @@
+#!/usr/bin/env python3.10
+
+"""
+Load test end-to-end cho Moon Discord Bot
+
+Chạy ask_openai, ChatCommand.chat hoặc on_message của bot thật với Discord
+giả lập, gọi tới server Responses API và OpenWeatherMap giả lập
+(benchmarks/mock_servers.py, chạy ở process riêng). Với mỗi mức đồng thời,
+in ra throughput, độ trễ p50/p95/p99, độ trễ của event loop và bộ nhớ.
+
+Mỗi luồng tải là một kênh riêng (chuỗi hội thoại riêng) của một người dùng
+riêng. Cấu hình của bot đọc từ env như bình thường, ví dụ:
+
+    OPENAI_MAX_CONCURRENCY=64 ADMISSION_QUEUE_SIZE=256 \\
+        python benchmarks/load_test.py --mode mention --concurrency 1 8 32 128
+
+Các file dữ liệu (hội thoại, token usage) được đặt vào thư mục tạm và giới
+hạn tốc độ theo người dùng/server bị tắt để không ảnh hưởng tới bot thật.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_servers import MockSettings, start_in_process  # noqa: E402
+
+QUESTIONS = (
+    "Giải thích ngắn gọn sự khác nhau giữa TCP và UDP",
+    "Thời tiết Hà Nội hôm nay thế nào?",
+    "Gợi ý một món ăn tối dễ nấu",
+    "Viết một hàm Python đảo ngược chuỗi",
+    "Ngày mai ở Đà Nẵng có mưa không?",
+)
+
+
+# --- Discord giả lập ---
+class FakeUser:
+    def __init__(self, user_id: int, bot: bool = False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class FakeSentMessage:
+    def __init__(self, probe: "RequestProbe", content: str):
+        self.probe = probe
+        self.content = content
+
+    async def edit(self, content: str = None, **kwargs):
+        await asyncio.sleep(self.probe.discord_latency)
+        self.content = content
+        self.probe.edits += 1
+
+
+class RequestProbe:
+    """Ghi lại thời điểm và số lần bot gửi/sửa tin nhắn cho một request"""
+
+    def __init__(self, discord_latency: float):
+        self.discord_latency = discord_latency
+        self.started = time.perf_counter()
+        self.first_send: float | None = None
+        self.sends = 0
+        self.edits = 0
+        self.last_content = ""
+
+    async def send(self, content: str = None, **kwargs) -> FakeSentMessage:
+        await asyncio.sleep(self.discord_latency)
+        if self.first_send is None:
+            self.first_send = time.perf_counter() - self.started
+        self.sends += 1
+        self.last_content = content or ""
+        return FakeSentMessage(self, content)
+
+
+class FakeInteractionResponse:
+    def __init__(self, probe: RequestProbe):
+        self.probe = probe
+
+    async def defer(self, thinking: bool = False, **kwargs):
+        await asyncio.sleep(self.probe.discord_latency)
+
+    async def send_message(self, content: str = None, **kwargs):
+        await self.probe.send(content)
+
+
+class FakeFollowup:
+    def __init__(self, probe: RequestProbe):
+        self.send = probe.send
+
+
+class FakeInteraction:
+    def __init__(self, probe: RequestProbe, user: FakeUser, channel_id: int, guild_id: int):
+        self.user = user
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.response = FakeInteractionResponse(probe)
+        self.followup = FakeFollowup(probe)
+
+
+class FakeChannel:
+    def __init__(self, probe: RequestProbe, channel_id: int):
+        self.id = channel_id
+        self.send = probe.send
+
+    @asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, probe: RequestProbe, author: FakeUser, bot_user: FakeUser, channel_id: int, guild_id: int, text: str):
+        self.author = author
+        self.content = f"<@{bot_user.id}> {text}"
+        self.mentions = [bot_user]
+        self.attachments = []
+        self.channel = FakeChannel(probe, channel_id)
+        self.guild = FakeGuild(guild_id)
+        self.reply = probe.send
+
+
+# --- Đo lường ---
+def percentile(values: List[float], q: float) -> float:
+    """Percentile theo nearest-rank (values đã sắp xếp)"""
+    if not values:
+        return float("nan")
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def rss_mb() -> float:
+    """RSS hiện tại (MB); ngoài Linux dùng RSS cao nhất"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+async def monitor_loop_lag(samples: List[float], interval: float = 0.01):
+    """Độ trễ của event loop: thời gian thức dậy muộn hơn dự kiến"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+# --- Chạy tải ---
+async def run_level(main, args, concurrency: int, level_index: int, requests: int) -> Dict[str, float]:
+    from metrics import ERRORS_TOTAL
+
+    bot_user = main.bot.user
+    cog = main.ChatCommand(main.bot)
+    latencies: List[float] = []
+    first_sends: List[float] = []
+    failures = 0
+    errors_before = ERRORS_TOTAL.snapshot()
+    per_worker = max(1, requests // concurrency)
+
+    async def one_request(worker: int, sequence: int):
+        nonlocal failures
+        probe = RequestProbe(args.discord_latency)
+        user = FakeUser(10_000 + worker)
+        channel_id = 1_000_000 * (level_index + 1) + worker
+        question = QUESTIONS[(worker + sequence) % len(QUESTIONS)]
+        try:
+            if args.mode == "ask":
+                answer, _, _ = await main.ask_openai(f"<@{user.id}>: {question}")
+                probe.last_content = answer
+            elif args.mode == "chat":
+                interaction = FakeInteraction(probe, user, channel_id, args.guild_id)
+                await cog.chat.callback(cog, interaction, question, None)
+            else:
+                message = FakeMessage(probe, user, bot_user, channel_id, args.guild_id, question)
+                await main.on_message(message)
+        except Exception as e:
+            failures += 1
+            logging.error(f"Request lỗi: {type(e).__name__}: {e}")
+            return
+        latencies.append(time.perf_counter() - probe.started)
+        if probe.first_send is not None:
+            first_sends.append(probe.first_send)
+
+    async def worker(index: int):
+        for sequence in range(per_worker):
+            await one_request(index, sequence)
+
+    lag_samples: List[float] = []
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    rss_after = rss_mb()
+    monitor.cancel()
+
+    errors = {
+        key: value - errors_before.get(key, 0)
+        for key, value in ERRORS_TOTAL.snapshot().items()
+        if value - errors_before.get(key, 0)
+    }
+    rejected = sum(value for (source, _), value in errors.items() if source == "admission")
+    openai_errors = sum(value for (source, _), value in errors.items() if source == "openai")
+    latencies.sort()
+    first_sends.sort()
+    lag_samples.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": concurrency * per_worker,
+        "failed": failures,
+        "rejected": rejected,
+        "openai_errors": openai_errors,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "first_reply_p50": percentile(first_sends, 50),
+        "loop_lag_p99_ms": percentile(lag_samples, 99) * 1000,
+        "loop_lag_max_ms": (lag_samples[-1] if lag_samples else 0.0) * 1000,
+        "rss_mb": rss_after,
+        "rss_delta_mb": rss_after - rss_before,
+    }
+
+
+def print_table(results: List[Dict[str, float]]):
+    header = (
+        f"{'conc':>5} {'req':>6} {'fail':>5} {'rej':>5} {'req/s':>8} "
+        f"{'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'1st s':>7} "
+        f"{'lag p99':>8} {'lag max':>8} {'RSS MB':>8} {'ΔRSS':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['concurrency']:>5} {r['requests']:>6} {r['failed']:>5} {r['rejected']:>5.0f} "
+            f"{r['throughput']:>8.2f} {r['p50']:>7.3f} {r['p95']:>7.3f} {r['p99']:>7.3f} "
+            f"{r['first_reply_p50']:>7.3f} {r['loop_lag_p99_ms']:>6.1f}ms {r['loop_lag_max_ms']:>6.1f}ms "
+            f"{r['rss_mb']:>8.1f} {r['rss_delta_mb']:>+7.1f}"
+        )
+
+
+async def run(args, base_url: str) -> List[Dict[str, float]]:
+    import main
+
+    if not args.verbose:
+        # Log INFO của từng request làm sai số đo
+        logging.getLogger().setLevel(logging.WARNING)
+    # Bot chưa đăng nhập Discord: gán user giả và bỏ qua prefix command
+    main.bot._connection.user = FakeUser(999, bot=True)
+
+    async def process_commands(message):
+        return None
+
+    main.bot.process_commands = process_commands
+    await main.start_services()
+    results = []
+    try:
+        # Làm nóng (import lười, kết nối HTTP, gazetteer) trước khi đo
+        await run_level(main, args, 1, len(args.concurrency), 2)
+        for index, concurrency in enumerate(args.concurrency):
+            results.append(await run_level(main, args, concurrency, index, args.requests))
+    finally:
+        await main.stop_services()
+        await main.openai_client.close()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test Moon Discord Bot với OpenAI/OpenWeatherMap giả lập")
+    parser.add_argument("--mode", choices=("ask", "chat", "mention"), default="mention",
+                        help="ask: gọi ask_openai; chat: /chat; mention: on_message")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32],
+                        help="Các mức số kênh hỏi đồng thời")
+    parser.add_argument("--requests", type=int, default=64, help="Số request mỗi mức đồng thời")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="Trả lời dạng streaming (STREAM_RESPONSES)")
+    parser.add_argument("--latency", type=float, default=0.5, help="Độ trễ trung bình của Responses API (giây)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Biên độ dao động độ trễ (giây)")
+    parser.add_argument("--tool-rate", type=float, default=0.3, help="Tỉ lệ lượt hỏi gọi get_weather")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Tỉ lệ request OpenAI bị lỗi 429/500")
+    parser.add_argument("--input-tokens", type=int, default=1200)
+    parser.add_argument("--output-tokens", type=int, default=300)
+    parser.add_argument("--weather-latency", type=float, default=0.08, help="Độ trễ của OpenWeatherMap giả lập")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Độ trễ mỗi lần gửi/sửa tin nhắn")
+    parser.add_argument("--guild-id", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", metavar="PATH", help="Ghi kết quả ra file JSON")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log INFO của bot")
+    return parser.parse_args()
+
+
+def configure_env(args, base_url: str, data_dir: str):
+    # Luôn trỏ về server giả lập và thư mục tạm, kể cả khi có file .env của bot thật
+    os.environ.update({
+        "DISCORD_TOKEN": "load-test",
+        "OPENAI_API_KEY": "load-test",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENWEATHERMAP_API_KEY": "load-test",
+        "OPENWEATHERMAP_BASE_URL": base_url,
+        "STREAM_RESPONSES": "true" if args.stream else "false",
+        "TOKEN_USAGE_FILE": os.path.join(data_dir, "token_usage.json"),
+        "CONVERSATION_DB_FILE": os.path.join(data_dir, "conversations.db"),
+        "USER_RATE_PER_MINUTE": "0",
+        "GUILD_RATE_PER_MINUTE": "0",
+        "METRICS_PORT": "0",
+    })
+    os.environ.setdefault("DISCORD_STATUS", "load test")
+    os.environ.setdefault("INSTRUCTIONS", "Bạn là Moon, trợ lý thân thiện trên Discord. Trả lời ngắn gọn bằng tiếng Việt.")
+    os.environ.setdefault("COMPACTION_THRESHOLD", "0")
+    os.environ.setdefault("TRACE_FILE", "")
+
+
+def main():
+    args = parse_args()
+    settings = MockSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        tool_rate=args.tool_rate,
+        error_rate=args.error_rate,
+        input_tokens=args.input_tokens,
+        output_tokens=args.output_tokens,
+        weather_latency=args.weather_latency,
+        seed=args.seed,
+    )
+    process, base_url = start_in_process(settings)
+    try:
+        with tempfile.TemporaryDirectory(prefix="moon-load-test-") as data_dir:
+            configure_env(args, base_url, data_dir)
+            results = asyncio.run(run(args, base_url))
+        with urllib.request.urlopen(f"{base_url}/stats") as response:
+            upstream = json.load(response)
+    finally:
+        process.terminate()
+        process.join()
+
+    print()
+    print(
+        f"mode={args.mode} stream={args.stream} latency={args.latency}s±{args.jitter}s "
+        f"tool_rate={args.tool_rate} error_rate={args.error_rate} "
+        f"max_concurrency={os.environ.get('OPENAI_MAX_CONCURRENCY', 'default')}"
+    )
+    print_table(results)
+    print(f"upstream requests: {upstream}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results, "upstream": upstream}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3.10
+
+"""
+Server giả lập cho benchmark: OpenAI Responses API và OpenWeatherMap
+
+Một aiohttp app phục vụ cả hai:
+- POST /v1/responses: độ trễ, số token, tỉ lệ gọi get_weather và tỉ lệ lỗi
+  (429/500) cấu hình được; hỗ trợ stream=true (SSE) như API thật
+- GET /geo/1.0/direct, /data/2.5/weather, /data/2.5/forecast: dữ liệu thời
+  tiết cố định với độ trễ cấu hình được
+
+Server chạy trong process riêng (start_in_process) để CPU của server giả lập
+không làm sai số đo event loop của bot.
+"""
+
+import asyncio
+import itertools
+import json
+import multiprocessing
+import random
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+from aiohttp import web
+
+# Địa chỉ model dùng khi gọi get_weather (phần lớn có trong gazetteer, vài địa chỉ phải geocoding)
+WEATHER_ADDRESSES = (
+    "Hà Nội", "TP. Hồ Chí Minh", "Đà Nẵng", "Huế", "Cần Thơ", "Hải Phòng",
+    "Quận 1, TP. Hồ Chí Minh", "Nha Trang", "Paris", "Tokyo",
+)
+
+
+@dataclass
+class MockSettings:
+    """Hành vi của server giả lập"""
+    # Độ trễ (giây) của một response và biên độ dao động ngẫu nhiên (±)
+    latency: float = 0.5
+    jitter: float = 0.2
+    # Tỉ lệ lượt hỏi đầu được trả về dưới dạng function_call get_weather
+    tool_rate: float = 0.3
+    # Tỉ lệ request bị lỗi (một nửa 429 có retry-after-ms, một nửa 500)
+    error_rate: float = 0.0
+    input_tokens: int = 1200
+    output_tokens: int = 300
+    # Độ dài câu trả lời và số delta khi stream
+    answer_chars: int = 600
+    stream_chunks: int = 20
+    weather_latency: float = 0.08
+    seed: int | None = None
+
+
+_ids = itertools.count(1)
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_{next(_ids):012x}"
+
+
+def message_item(text: str) -> Dict[str, Any]:
+    return {
+        "type": "message",
+        "id": _new_id("msg"),
+        "role": "assistant",
+        "status": "completed",
+        "content": [{"type": "output_text", "text": text, "annotations": []}],
+    }
+
+
+def function_call_item(name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "type": "function_call",
+        "id": _new_id("fc"),
+        "call_id": _new_id("call"),
+        "name": name,
+        "arguments": json.dumps(arguments, ensure_ascii=False),
+        "status": "completed",
+    }
+
+
+def response_object(model: str, output: List[Dict[str, Any]], settings: MockSettings, status: str = "completed"):
+    return {
+        "id": _new_id("resp"),
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": status,
+        "model": model,
+        "output": output,
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": settings.input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": settings.output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": settings.input_tokens + settings.output_tokens,
+        },
+    }
+
+
+class MockServer:
+    """Các handler của server giả lập và bộ đếm request theo route"""
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.random = random.Random(settings.seed)
+        self.requests: Dict[str, int] = {}
+        self.answer = ("Moon trả lời: " + "lorem ipsum dolor sit amet " * 100)[: settings.answer_chars]
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/responses", self.responses)
+        app.router.add_get("/geo/1.0/direct", self.geocoding)
+        app.router.add_get("/data/2.5/weather", self.weather)
+        app.router.add_get("/data/2.5/forecast", self.forecast)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+    def _count(self, route: str):
+        self.requests[route] = self.requests.get(route, 0) + 1
+
+    def _latency(self) -> float:
+        settings = self.settings
+        return max(0.0, settings.latency + self.random.uniform(-settings.jitter, settings.jitter))
+
+    # --- Responses API ---
+    def _output(self, body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        inputs = body.get("input") or []
+        first = inputs[0] if isinstance(inputs, list) and inputs else {}
+        if first.get("type") == "function_call_output":
+            return [message_item(self.answer)]
+        tool_names = {tool.get("name") for tool in body.get("tools") or []}
+        if "get_weather" in tool_names and self.random.random() < self.settings.tool_rate:
+            address = self.random.choice(WEATHER_ADDRESSES)
+            return [function_call_item("get_weather", {"address": address})]
+        return [message_item(self.answer)]
+
+    def _error(self) -> web.Response | None:
+        if self.random.random() >= self.settings.error_rate:
+            return None
+        if self.random.random() < 0.5:
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error", "code": None}},
+                status=429,
+                headers={"retry-after-ms": "200"},
+            )
+        return web.json_response(
+            {"error": {"message": "Internal server error (mock)", "type": "server_error", "code": None}},
+            status=500,
+        )
+
+    async def responses(self, request: web.Request) -> web.StreamResponse:
+        self._count("responses")
+        body = await request.json()
+        error = self._error()
+        if error is not None:
+            await asyncio.sleep(self._latency() / 4)
+            return error
+        output = self._output(body)
+        response = response_object(body.get("model", "mock"), output, self.settings)
+        if not body.get("stream"):
+            await asyncio.sleep(self._latency())
+            return web.json_response(response)
+        return await self._stream(request, response)
+
+    async def _stream(self, request: web.Request, response: Dict[str, Any]) -> web.StreamResponse:
+        stream = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await stream.prepare(request)
+        sequence = itertools.count()
+
+        async def send(event: Dict[str, Any]):
+            event["sequence_number"] = next(sequence)
+            payload = json.dumps(event, ensure_ascii=False)
+            await stream.write(f"event: {event['type']}\ndata: {payload}\n\n".encode("utf-8"))
+
+        latency = self._latency()
+        # Nửa độ trễ trước token đầu tiên, nửa còn lại rải đều cho các delta
+        await asyncio.sleep(latency / 2)
+        await send({"type": "response.created", "response": {**response, "status": "in_progress", "output": []}})
+        item = response["output"][0]
+        if item["type"] == "message":
+            text = item["content"][0]["text"]
+            chunks = max(1, self.settings.stream_chunks)
+            size = max(1, -(-len(text) // chunks))
+            for start in range(0, len(text), size):
+                await asyncio.sleep(latency / 2 / chunks)
+                await send({
+                    "type": "response.output_text.delta",
+                    "item_id": item["id"],
+                    "output_index": 0,
+                    "content_index": 0,
+                    "delta": text[start:start + size],
+                })
+        else:
+            await asyncio.sleep(latency / 2)
+        await send({"type": "response.completed", "response": response})
+        await stream.write_eof()
+        return stream
+
+    # --- OpenWeatherMap ---
+    async def geocoding(self, request: web.Request) -> web.Response:
+        self._count("geocoding")
+        await asyncio.sleep(self.settings.weather_latency)
+        name = request.query.get("q", "")
+        return web.json_response([
+            {"name": name, "local_names": {"vi": name}, "lat": 21.0285, "lon": 105.8542, "country": "VN"}
+        ])
+
+    def _conditions(self) -> Dict[str, Any]:
+        return {
+            "main": {
+                "temp": 29.5, "feels_like": 33.1, "temp_min": 27.0, "temp_max": 31.0,
+                "humidity": 74, "pressure": 1008,
+            },
+            "weather": [{"main": "Clouds", "description": "mây rải rác", "icon": "03d"}],
+            "wind": {"speed": 3.6, "deg": 140},
+        }
+
+    async def weather(self, request: web.Request) -> web.Response:
+        self._count("weather")
+        await asyncio.sleep(self.settings.weather_latency)
+        return web.json_response({**self._conditions(), "sys": {"country": "VN"}, "name": "Mock"})
+
+    async def forecast(self, request: web.Request) -> web.Response:
+        self._count("forecast")
+        await asyncio.sleep(self.settings.weather_latency)
+        count = int(request.query.get("cnt", 8))
+        now = int(time.time())
+        items = []
+        for index in range(count):
+            dt = now + 3 * 3600 * (index + 1)
+            items.append({
+                **self._conditions(),
+                "dt": dt,
+                "dt_txt": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(dt)),
+            })
+        return web.json_response({"cnt": count, "list": items})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+
+async def serve(app: web.Application, host: str = "127.0.0.1", port: int = 0) -> Tuple[web.AppRunner, int]:
+    """Chạy app trong event loop hiện tại, trả về (runner, cổng thực tế)"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+def _run(factory: Callable[..., web.Application], args: tuple, host: str, ports: multiprocessing.Queue):
+    async def main():
+        runner, port = await serve(factory(*args), host)
+        ports.put(port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve_in_process(
+    factory: Callable[..., web.Application], *args: Any, host: str = "127.0.0.1"
+) -> Tuple[multiprocessing.Process, str]:
+    """Chạy app do factory(*args) tạo trong process riêng, trả về (process, base URL)"""
+    ports: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(factory, args, host, ports), daemon=True)
+    process.start()
+    port = ports.get(timeout=15)
+    return process, f"http://{host}:{port}"
+
+
+def _mock_app(settings: MockSettings) -> web.Application:
+    return MockServer(settings).app()
+
+
+def start_in_process(settings: MockSettings, host: str = "127.0.0.1") -> Tuple[multiprocessing.Process, str]:
+    """Chạy server giả lập trong process riêng, trả về (process, base URL)"""
+    return serve_in_process(_mock_app, settings, host=host)
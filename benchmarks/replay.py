@@ -0,0 +1,317 @@
+#!/usr/bin/env python3.10
+
+"""
+Phát lại cassette để kiểm tra hồi quy hiệu năng của ask_openai
+
+Cassette được ghi khi chạy bot với CASSETTE_DIR (xem cassettes.py). Mỗi
+cassette là một kịch bản: runner dựng lại trạng thái ngân sách token lúc ghi,
+gọi ask_openai của bản build hiện tại và trả lời mọi request tới Responses API
+và OpenWeatherMap bằng dữ liệu đã ghi (server phát lại chạy ở process riêng,
+không có độ trễ mạng), nên kết quả ổn định và chạy được offline.
+
+Một kịch bản FAIL khi:
+- số lần gọi OpenAI / HTTP, số token hoặc overhead nội bộ (thời gian chạy
+  ask_openai khi upstream trả lời ngay) vượt ngân sách trong cassette
+- bot gửi request không có trong cassette, request khác hình dạng lúc ghi
+  (model, previous_response_id, loại input), bỏ sót request đã ghi, hoặc
+  câu trả lời / model được chọn khác lúc ghi
+
+Chạy: python benchmarks/replay.py benchmarks/cassettes [--repeat 5] [--overhead-ms 50]
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import deque
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cassettes import cache_key, load_cassette, params_key  # noqa: E402
+from mock_servers import serve_in_process  # noqa: E402
+
+
+def request_shape(body: Dict[str, Any] | None) -> Dict[str, Any]:
+    """Các trường quyết định luồng xử lý của một request Responses API"""
+    body = body or {}
+    inputs = body.get("input")
+    if isinstance(inputs, list):
+        kinds = [item.get("type") or item.get("role") for item in inputs]
+    else:
+        kinds = [type(inputs).__name__]
+    return {
+        "model": body.get("model"),
+        "previous_response_id": body.get("previous_response_id"),
+        "stream": bool(body.get("stream")),
+        "store": body.get("store", True),
+        "input": kinds,
+    }
+
+
+class ReplayServer:
+    """Trả lời request bằng interaction đã ghi của cassette đang được nạp"""
+
+    def __init__(self):
+        self._load({"interactions": []})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/__replay/load", self.load)
+        app.router.add_get("/__replay/report", self.report)
+        app.router.add_route("*", "/{tail:.*}", self.handle)
+        return app
+
+    def _load(self, cassette: Dict[str, Any]):
+        self.openai = deque(i for i in cassette["interactions"] if i["kind"] == "openai")
+        self.http: Dict[str, deque] = {}
+        for interaction in cassette["interactions"]:
+            if interaction["kind"] == "http":
+                key = params_key(interaction["method"], interaction["url"], interaction["params"])
+                self.http.setdefault(key, deque()).append(interaction)
+        self.served = {"openai": 0, "http": 0}
+        self.problems: List[str] = []
+
+    async def load(self, request: web.Request) -> web.Response:
+        self._load(await request.json())
+        return web.json_response({"ok": True})
+
+    async def report(self, request: web.Request) -> web.Response:
+        leftover = len(self.openai) + sum(len(queue) for queue in self.http.values())
+        problems = list(self.problems)
+        if leftover:
+            problems.append(f"{leftover} request đã ghi không được gọi lại")
+        return web.json_response({"served": self.served, "problems": problems})
+
+    @staticmethod
+    def _respond(interaction: Dict[str, Any]) -> web.Response:
+        if "status" not in interaction:
+            # Lúc ghi request bị lỗi kết nối
+            return web.Response(status=502, text="recorded connection error")
+        headers = dict(interaction.get("headers") or {})
+        content_type = headers.pop("content-type", headers.pop("Content-Type", "application/json"))
+        return web.Response(
+            status=interaction["status"],
+            body=interaction.get("body", "").encode("utf-8"),
+            headers={**headers, "Content-Type": content_type},
+        )
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.path.startswith("/v1/"):
+            body = await request.json() if request.can_read_body else None
+            if not self.openai:
+                self.problems.append(f"request OpenAI ngoài cassette: {request.method} {request.path}")
+                return web.json_response({"error": {"message": "not in cassette", "type": "replay"}}, status=400)
+            interaction = self.openai.popleft()
+            self.served["openai"] += 1
+            expected, actual = request_shape(interaction.get("request")), request_shape(body)
+            if interaction.get("path") != request.path or expected != actual:
+                self.problems.append(f"request OpenAI #{self.served['openai']} khác lúc ghi: {actual} != {expected}")
+            return self._respond(interaction)
+
+        key = params_key(request.method, request.path, dict(request.query))
+        queue = self.http.get(key)
+        if not queue:
+            self.problems.append(f"request HTTP ngoài cassette: {key}")
+            return web.Response(status=404, text="not in cassette")
+        self.served["http"] += 1
+        return self._respond(queue.popleft())
+
+
+def _replay_app() -> web.Application:
+    return ReplayServer().app()
+
+
+def _post_json(url: str, data: Dict[str, Any]):
+    request = urllib.request.Request(
+        url, data=json.dumps(data).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def _get_json(url: str):
+    with urllib.request.urlopen(url) as response:
+        return json.load(response)
+
+
+def configure_env(base_url: str, data_dir: str):
+    # Luôn trỏ về server phát lại; tắt mọi thứ làm kết quả không ổn định
+    os.environ.update({
+        "DISCORD_TOKEN": "replay",
+        "OPENAI_API_KEY": "replay",
+        "OPENAI_BASE_URL": f"{base_url}/v1",
+        "OPENWEATHERMAP_API_KEY": "replay",
+        "OPENWEATHERMAP_BASE_URL": base_url,
+        "TOKEN_USAGE_FILE": os.path.join(data_dir, "token_usage.json"),
+        "CONVERSATION_DB_FILE": "",
+        "CASSETTE_DIR": "",
+        "RESPONSE_CACHE_ENABLED": "false",
+        "OPENAI_HEDGE_REQUESTS": "false",
+        "COMPACTION_THRESHOLD": "0",
+        "METRICS_PORT": "0",
+        "TRACE_FILE": "",
+    })
+    os.environ.setdefault("DISCORD_STATUS", "replay")
+    os.environ.setdefault("INSTRUCTIONS", "Bạn là Moon, trợ lý thân thiện trên Discord.")
+
+
+async def replay_scenario(main, base_url: str, cassette: Dict[str, Any], data_dir: str, args) -> Dict[str, Any]:
+    from attachments import Attachment
+    from budget import BudgetRouter
+    from metrics import TOKENS_TOTAL
+    from token_usage import TokenUsageLedger
+
+    call = cassette["call"]
+    routing = cassette["routing"]
+    recorded = cassette["result"]
+    budget = cassette.get("budget") or {}
+    timings: List[float] = []
+    first: Dict[str, Any] = {}
+    gazetteer = main.runtime_context.gazetteer
+
+    for attempt in range(args.repeat):
+        await asyncio.to_thread(_post_json, f"{base_url}/__replay/load", cassette)
+        # Trạng thái ngân sách giống lúc ghi, cache của function trống
+        ledger = TokenUsageLedger(os.path.join(data_dir, f"usage-{attempt}.json"), flush_interval=3600)
+        for tier, used in routing["usage"].items():
+            if used:
+                ledger.add(tier, used)
+        main.budget_router = BudgetRouter(
+            ledger,
+            limits=routing["limits"],
+            premium_models=routing["premium_models"],
+            mini_models=routing["mini_models"],
+            fallback_model=routing["fallback_model"],
+            instructions=main.INSTRUCTIONS,
+        )
+        main.runtime_context.caches.clear()
+        for hit in cassette.get("cache_hits", ()):
+            main.runtime_context.cache(hit["cache"]).set(cache_key(hit["key"]), hit["value"])
+        main.runtime_context.gazetteer = gazetteer if call.get("gazetteer") else None
+        random.seed(attempt)
+        tokens_before = TOKENS_TOTAL.snapshot()
+
+        started = time.perf_counter()
+        answer, chat_id, _ = await main.ask_openai(
+            call["prompt"],
+            chat_id=call["chat_id"],
+            attachments=[Attachment(**a) for a in call["attachments"]] or None,
+            # Model mặc định lúc ghi (OPENAI_MODEL) có thể khác cấu hình hiện tại
+            force_model=call["force_model"] or call["model"],
+            on_delta=(lambda delta: None) if call["stream"] else None,
+            context_tokens=call["context_tokens"],
+            summary=call["summary"],
+        )
+        timings.append(time.perf_counter() - started)
+        main.runtime_context.gazetteer = gazetteer
+
+        if attempt == 0:
+            report = await asyncio.to_thread(_get_json, f"{base_url}/__replay/report")
+            tokens = {
+                key: value - tokens_before.get(key, 0)
+                for key, value in TOKENS_TOTAL.snapshot().items()
+                if value - tokens_before.get(key, 0)
+            }
+            first = {
+                "answer": answer,
+                "chat_id": chat_id,
+                "served": report["served"],
+                "problems": report["problems"],
+                "tokens": int(sum(tokens.values())),
+                "models": sorted({model for _, model in tokens}),
+            }
+
+    overhead_ms = statistics.median(timings) * 1000
+    failures = list(first["problems"])
+    if first["answer"] != recorded["answer"]:
+        failures.append("câu trả lời khác lúc ghi")
+    if recorded.get("tokens") and first["models"] != [recorded["model"]]:
+        failures.append(f"model {first['models']} != {recorded['model']}")
+    limits = {
+        "openai_calls": (first["served"]["openai"], budget.get("openai_calls")),
+        "http_calls": (first["served"]["http"], budget.get("http_calls")),
+        "tokens": (first["tokens"], budget.get("tokens")),
+        "overhead_ms": (overhead_ms, budget.get("overhead_ms") or args.overhead_ms),
+    }
+    for name, (value, limit) in limits.items():
+        if limit is not None and value > limit:
+            failures.append(f"{name} {value:.0f} > {limit}")
+    return {
+        "scenario": cassette["scenario"],
+        "openai_calls": first["served"]["openai"],
+        "http_calls": first["served"]["http"],
+        "tokens": first["tokens"],
+        "overhead_ms": overhead_ms,
+        "recorded_ms": recorded.get("elapsed", 0) * 1000,
+        "failures": failures,
+    }
+
+
+async def run(args, base_url: str, cassettes: List[Dict[str, Any]], data_dir: str) -> List[Dict[str, Any]]:
+    import main
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    await main.start_services()
+    try:
+        return [await replay_scenario(main, base_url, cassette, data_dir, args) for cassette in cassettes]
+    finally:
+        await main.stop_services()
+        await main.openai_client.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Phát lại cassette của ask_openai và kiểm tra ngân sách")
+    parser.add_argument("paths", nargs="+", help="File cassette hoặc thư mục chứa cassette (*.json)")
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần chạy mỗi kịch bản (lấy median overhead)")
+    parser.add_argument("--overhead-ms", type=float, default=50.0,
+                        help="Ngân sách overhead mặc định khi cassette không ghi overhead_ms")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log INFO của bot")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    files: List[str] = []
+    for path in args.paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path])
+    cassettes = [load_cassette(path) for path in files]
+    if not cassettes:
+        print("Không có cassette nào")
+        sys.exit(2)
+
+    process, base_url = serve_in_process(_replay_app)
+    try:
+        with tempfile.TemporaryDirectory(prefix="moon-replay-") as data_dir:
+            configure_env(base_url, data_dir)
+            results = asyncio.run(run(args, base_url, cassettes, data_dir))
+    finally:
+        process.terminate()
+        process.join()
+
+    print(f"{'scenario':<32} {'openai':>6} {'http':>5} {'tokens':>7} {'overhead':>10} {'recorded':>10}  result")
+    failed = 0
+    for r in results:
+        status = "PASS" if not r["failures"] else "FAIL: " + "; ".join(r["failures"])
+        failed += bool(r["failures"])
+        print(
+            f"{r['scenario']:<32} {r['openai_calls']:>6} {r['http_calls']:>5} {r['tokens']:>7} "
+            f"{r['overhead_ms']:>8.1f}ms {r['recorded_ms']:>8.0f}ms  {status}"
+        )
+    print(f"{len(results) - failed}/{len(results)} scenarios passed")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3.10
+
+"""
+Chọn model theo ngân sách token cho Moon Discord Bot
+
+Trước mỗi lượt hỏi, router ước tính số token sẽ dùng (prompt, file đính kèm,
+độ dài chuỗi hội thoại) và giữ chỗ trong ledger. Nếu tier premium không còn
+đủ ngân sách thì chọn model mini ngay từ đầu, nên không request nào phải gửi
+lại chỉ vì vượt giới hạn sau khi đã trả lời.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable
+
+from metrics import TOKENS_TOTAL
+from token_usage import TokenUsageLedger
+
+# Ước tính thô: tiếng Việt có dấu trung bình khoảng 3 ký tự một token
+CHARS_PER_TOKEN = 3
+# Một ảnh đã thu nhỏ (chi tiết "auto") và một file PDF upload nguyên bản
+IMAGE_TOKENS = 1100
+PDF_FILE_TOKENS = 5000
+# Dự phòng cho câu trả lời, reasoning và các vòng gọi tool
+OUTPUT_TOKENS = 2000
+
+
+@dataclass
+class Route:
+    """Model được chọn cho một lượt hỏi cùng phần token đã giữ chỗ"""
+    model: str
+    tier: str | None
+    reserved: int
+    # Tổng token thực tế của các response trong lượt hỏi
+    used: int = 0
+    settled: bool = False
+
+
+class BudgetRouter:
+    """Chọn model premium/mini trước khi gọi và quyết toán sau khi xong"""
+
+    def __init__(
+        self,
+        ledger: TokenUsageLedger,
+        limits: Dict[str, int],
+        premium_models: Iterable[str],
+        mini_models: Iterable[str],
+        fallback_model: str,
+        instructions: str | None = None,
+    ):
+        self.ledger = ledger
+        self.limits = limits
+        self.premium_models = set(premium_models)
+        self.mini_models = set(mini_models)
+        self.fallback_model = fallback_model
+        self.instruction_tokens = len(instructions or "") // CHARS_PER_TOKEN
+
+    def tier_of(self, model: str) -> str | None:
+        if model in self.premium_models:
+            return "premium"
+        if model in self.mini_models:
+            return "mini"
+        return None
+
+    def estimate(
+        self,
+        prompt: str,
+        attachments: Iterable[Any] = (),
+        context_tokens: int = 0,
+        tools_bytes: int = 0,
+    ) -> int:
+        """Ước tính số token của một lượt hỏi (làm tròn lên, thà giữ dư còn hơn thiếu)"""
+        tokens = self.instruction_tokens + tools_bytes // 4 + len(prompt) // CHARS_PER_TOKEN
+        for attachment in attachments or ():
+            if getattr(attachment, "text", None) is not None:
+                tokens += len(attachment.text) // CHARS_PER_TOKEN
+            elif attachment.kind == "image":
+                tokens += IMAGE_TOKENS
+            else:
+                tokens += PDF_FILE_TOKENS
+        # previous_response_id khiến toàn bộ ngữ cảnh trước đó được tính lại vào input
+        return tokens + context_tokens + OUTPUT_TOKENS
+
+    def route(self, model: str, estimate: int) -> Route:
+        """Giữ chỗ ngân sách và trả về model sẽ dùng"""
+        tier = self.tier_of(model)
+        if tier == "premium":
+            if self.ledger.reserve("premium", estimate, self.limits.get("premium")):
+                return Route(model, tier, estimate)
+            logging.warning(
+                f"Premium budget cannot cover ~{estimate} tokens "
+                f"(used {self.ledger.get('premium')}, reserved {self.ledger.reserved('premium')}). "
+                f"Routing to {self.fallback_model}."
+            )
+            model = self.fallback_model
+            tier = self.tier_of(model) or "mini"
+        if tier is not None:
+            # Tier mini chỉ được theo dõi, không chặn request
+            self.ledger.reserve(tier, estimate)
+        return Route(model, tier, estimate if tier else 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Cấu hình và mức dùng hiện tại (đã dùng + đang giữ chỗ), để phát lại đúng quyết định chọn model"""
+        return {
+            "premium_models": sorted(self.premium_models),
+            "mini_models": sorted(self.mini_models),
+            "limits": dict(self.limits),
+            "fallback_model": self.fallback_model,
+            "usage": {tier: self.ledger.get(tier) + self.ledger.reserved(tier) for tier in ("premium", "mini")},
+        }
+
+    def record(self, route: Route, response: Any):
+        """Cộng usage của một response vào lượt hỏi"""
+        usage = getattr(response, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage else None
+        if total:
+            route.used += total
+
+    def record_abandoned(self, route: Route, winner: Any):
+        """Cộng chi phí ước tính của một request dự phòng bị hủy (bằng usage của request thắng)"""
+        usage = getattr(winner, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage else None
+        if total:
+            route.used += total
+            logging.info(f"Counted ~{total} tokens for an abandoned hedged request on {route.model}")
+
+    def settle(self, route: Route) -> int:
+        """Trả lại phần giữ chỗ và ghi số token thực tế (chỉ một lần)"""
+        if route.used and not route.settled:
+            TOKENS_TOTAL.inc(route.tier or "untracked", route.model, amount=route.used)
+        if route.settled or route.tier is None:
+            route.settled = True
+            return 0
+        route.settled = True
+        total = self.ledger.settle(route.tier, route.reserved, route.used)
+        if route.used:
+            logging.info(
+                f"Used {route.used} tokens for model {route.model} (tier: {route.tier}, "
+                f"estimated {route.reserved}). Total tier usage: {total} tokens."
+            )
+        return total
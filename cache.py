@@ -0,0 +1,159 @@
+#!/usr/bin/env python3.10
+
+"""
+Cache TTL/LRU dùng chung cho Moon Discord Bot
+
+Mỗi entry có thời hạn riêng, cache bị giới hạn theo số entry và dung lượng
+ước tính. get_or_load gộp các lần tải đồng thời cho cùng một key (single-flight)
+để chỉ một request ra upstream.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+MISSING = object()
+
+
+class _LoadCancelled(Exception):
+    """Loader dùng chung bị hủy: các caller đang chờ tự tải lại thay vì nhận CancelledError"""
+
+
+def _default_sizeof(value: Any) -> int:
+    return len(repr(value))
+
+
+class TTLCache:
+    """Cache LRU có TTL theo từng entry và giới hạn dung lượng"""
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        max_bytes: int | None = None,
+        default_ttl: float = 600.0,
+        sizeof: Callable[[Any], int] = _default_sizeof,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.sizeof = sizeof
+        # key -> (value, expires_at, size)
+        self._entries: OrderedDict[Hashable, tuple[Any, float, int]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+        # Callback (tên cache, key, giá trị) cho mỗi lần hit, dùng khi ghi cassette
+        self.on_hit: Callable[[str, Hashable, Any], None] | None = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0]
+            self._pop(key)
+        return MISSING
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """Lấy giá trị còn hạn, đồng thời đếm hit/miss"""
+        value = self._lookup(key)
+        if value is MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.on_hit is not None:
+            self.on_hit(self.name, key, value)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        if key in self._entries:
+            self._pop(key)
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._entries[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self._entries))
+            self._pop(oldest)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        if key in self._entries:
+            self._pop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: float | None = None,
+    ) -> Any:
+        """Trả về giá trị trong cache, hoặc gọi loader (một lần cho mỗi key đang tải)"""
+        while True:
+            value = self._lookup(key)
+            if value is not MISSING:
+                self.hits += 1
+                if self.on_hit is not None:
+                    self.on_hit(self.name, key, value)
+                return value
+
+            # Đã có request đang tải key này thì chờ chung kết quả
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            self.shared += 1
+            try:
+                return await asyncio.shield(future)
+            except _LoadCancelled:
+                # Caller đang tải bị hủy (ví dụ hết timeout): thử tải lại
+                continue
+
+        self.misses += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            # Hủy chỉ áp dụng cho caller này, không lan sang các caller đang chờ chung
+            future.set_exception(_LoadCancelled() if isinstance(e, asyncio.CancelledError) else e)
+            # Tránh cảnh báo "exception was never retrieved" khi không ai chờ
+            future.exception()
+            raise
+        else:
+            self.set(key, value, ttl)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
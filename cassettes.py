@@ -0,0 +1,288 @@
+#!/usr/bin/env python3.10
+
+"""
+Ghi lại traffic thật của ask_openai thành cassette cho Moon Discord Bot
+
+Khi bật CASSETTE_DIR, mỗi lượt ask_openai được ghi thành một file JSON gồm
+tham số của lượt hỏi, trạng thái ngân sách token lúc đó, mọi cặp
+request/response tới Responses API (qua transport của httpx) và tới các API
+mà functions.py gọi (qua TraceConfig của aiohttp), cùng kết quả cuối cùng.
+API key, token và header Authorization bị xóa khỏi cả request lẫn response
+trước khi ghi.
+
+benchmarks/replay.py phát lại các cassette này offline để kiểm tra số lần gọi,
+số token và overhead nội bộ của bản build mới.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, Iterator, List
+
+import aiohttp
+import httpx
+
+CASSETTE_VERSION = 1
+REDACTED = "REDACTED"
+
+# Query param chứa khóa API (OpenWeatherMap dùng appid)
+_SECRET_PARAMS = {"appid", "api_key", "apikey", "key", "token", "access_token"}
+# Khóa có dạng nhận ra được dù không nằm trong danh sách bí mật (OpenAI, Bearer token)
+_SECRET_PATTERN = re.compile(r"\bsk-[A-Za-z0-9_-]{20,}|(?<=Bearer )[A-Za-z0-9._~+/-]{16,}")
+# Header của response cần giữ để phát lại đúng hành vi (stream, retry)
+_KEPT_HEADERS = {"content-type", "retry-after", "retry-after-ms"}
+
+_current_cassette: ContextVar["Cassette | None"] = ContextVar("moon_current_cassette", default=None)
+
+
+class Redactor:
+    """Xóa các giá trị bí mật (API key, token) khỏi text trước khi ghi"""
+
+    def __init__(self, secrets: Iterable[str]):
+        # Chỉ xóa chuỗi đủ dài để không thay nhầm từ thông thường
+        self.secrets = sorted({s for s in secrets if s and len(s) >= 8}, key=len, reverse=True)
+
+    def text(self, value: str) -> str:
+        for secret in self.secrets:
+            value = value.replace(secret, REDACTED)
+        return _SECRET_PATTERN.sub(REDACTED, value)
+
+    def params(self, params: Dict[str, str]) -> Dict[str, str]:
+        return {
+            key: REDACTED if key.lower() in _SECRET_PARAMS else self.text(value)
+            for key, value in params.items()
+        }
+
+
+def _decode(body: bytes) -> str:
+    return body.decode("utf-8", errors="replace")
+
+
+class Cassette:
+    """Các interaction của một lượt ask_openai, theo thứ tự bắt đầu"""
+
+    def __init__(self, call: Dict[str, Any], routing: Dict[str, Any]):
+        self.call = call
+        self.routing = routing
+        self.interactions: List[Dict[str, Any]] = []
+        # Giá trị function lấy từ cache (không có request ra ngoài), phát lại phải nạp sẵn
+        self.cache_hits: Dict[str, Dict[str, Any]] = {}
+        self.started = time.perf_counter()
+
+    def begin(self, interaction: Dict[str, Any]) -> Dict[str, Any]:
+        interaction["offset"] = round(time.perf_counter() - self.started, 4)
+        self.interactions.append(interaction)
+        return interaction
+
+    def to_dict(self, scenario: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        openai_calls = sum(1 for i in self.interactions if i["kind"] == "openai")
+        http_calls = len(self.interactions) - openai_calls
+        return {
+            "version": CASSETTE_VERSION,
+            "scenario": scenario,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "call": self.call,
+            "routing": self.routing,
+            "interactions": self.interactions,
+            "cache_hits": list(self.cache_hits.values()),
+            "result": result,
+            # Ngân sách mặc định khi phát lại, sửa tay nếu cần
+            "budget": {
+                "openai_calls": openai_calls,
+                "http_calls": http_calls,
+                "tokens": int(result.get("tokens", 0) * 1.1),
+                "overhead_ms": None,
+            },
+        }
+
+
+class _TeeStream(httpx.AsyncByteStream):
+    """Chuyển tiếp body (kể cả SSE) cho client và giữ lại một bản để ghi"""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_complete):
+        self._stream = stream
+        self._on_complete = on_complete
+        self._chunks: List[bytes] = []
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            self._chunks.append(chunk)
+            yield chunk
+
+    async def aclose(self):
+        await self._stream.aclose()
+        self._on_complete(b"".join(self._chunks))
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Transport httpx ghi request/response của OpenAI client vào cassette hiện tại"""
+
+    def __init__(self, redactor: Redactor, inner: httpx.AsyncBaseTransport | None = None):
+        self.redactor = redactor
+        self.inner = inner or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        cassette = _current_cassette.get()
+        if cassette is None:
+            return await self.inner.handle_async_request(request)
+        # Body không nén để cassette đọc được và phát lại đơn giản
+        request.headers["Accept-Encoding"] = "identity"
+        # Request cũng có thể chứa bí mật (kết quả function, prompt có dán key)
+        try:
+            body = json.loads(self.redactor.text(_decode(request.content))) if request.content else None
+        except ValueError:
+            body = None
+        interaction = cassette.begin({
+            "kind": "openai",
+            "method": request.method,
+            "path": request.url.path,
+            "request": body,
+        })
+        started = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+
+        def complete(content: bytes):
+            interaction.update({
+                "status": response.status_code,
+                "headers": {k: v for k, v in response.headers.items() if k.lower() in _KEPT_HEADERS},
+                "body": self.redactor.text(_decode(content)),
+                "elapsed": round(time.perf_counter() - started, 4),
+            })
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_TeeStream(response.stream, complete),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+
+class CassetteRecorder:
+    """Bật ghi cassette cho OpenAI client và session aiohttp dùng chung"""
+
+    def __init__(self, directory: str, secrets: Iterable[str]):
+        self.directory = directory
+        self.redactor = Redactor(secrets)
+        self.recorded = 0
+        self._writes: set[asyncio.Future] = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def transport(self) -> RecordingTransport:
+        return RecordingTransport(self.redactor)
+
+    def aiohttp_trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            cassette = _current_cassette.get()
+            ctx.cassette_interaction = None
+            if cassette is None:
+                return
+            ctx.cassette_started = time.perf_counter()
+            ctx.cassette_interaction = cassette.begin({
+                "kind": "http",
+                "method": params.method,
+                "url": str(params.url.with_query(None)),
+                "params": self.redactor.params(dict(params.url.query)),
+            })
+
+        async def on_request_end(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            interaction = getattr(ctx, "cassette_interaction", None)
+            if interaction is None:
+                return
+            # read() giữ body trong response nên function vẫn đọc được như bình thường
+            body = await params.response.read()
+            interaction.update({
+                "status": params.response.status,
+                "headers": {k: v for k, v in params.response.headers.items() if k.lower() in _KEPT_HEADERS},
+                "body": self.redactor.text(_decode(body)),
+                "elapsed": round(time.perf_counter() - ctx.cassette_started, 4),
+            })
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def cache_hit(self, cache: str, key: Any, value: Any):
+        """Callback on_hit của TTLCache: ghi lại giá trị cache mà lượt hỏi đã dùng"""
+        cassette = _current_cassette.get()
+        if cassette is None:
+            return
+        try:
+            entry = json.loads(self.redactor.text(json.dumps(
+                {"cache": cache, "key": key, "value": value}, ensure_ascii=False
+            )))
+        except (TypeError, ValueError):
+            return
+        cassette.cache_hits.setdefault(json.dumps([cache, entry["key"]], ensure_ascii=False), entry)
+
+    @contextmanager
+    def record(self, call: Dict[str, Any], routing: Dict[str, Any]) -> Iterator[Cassette]:
+        """Ghi mọi interaction trong khối with vào một cassette mới"""
+        cassette = Cassette(call, routing)
+        token = _current_cassette.set(cassette)
+        try:
+            yield cassette
+        finally:
+            _current_cassette.reset(token)
+
+    def save(self, cassette: Cassette, result: Dict[str, Any]):
+        """Ghi cassette ra file ở thread nền"""
+        self.recorded += 1
+        scenario = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.recorded:04d}"
+        data = cassette.to_dict(scenario, result)
+        data["call"]["prompt"] = self.redactor.text(data["call"]["prompt"])
+        path = os.path.join(self.directory, f"{scenario}.json")
+        future = asyncio.ensure_future(asyncio.to_thread(_write_json, path, data))
+        self._writes.add(future)
+        future.add_done_callback(self._written)
+
+    def _written(self, future: asyncio.Future):
+        self._writes.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Lỗi khi ghi cassette: {future.exception()}")
+
+    async def close(self):
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+def _write_json(path: str, data: Dict[str, Any]):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def load_cassette(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    # Cassette được commit vào repo, không chấp nhận file còn sót khóa
+    if _SECRET_PATTERN.search(text):
+        raise ValueError(f"{path}: cassette còn chứa khóa chưa bị xóa")
+    data = json.loads(text)
+    if data.get("version") != CASSETTE_VERSION:
+        raise ValueError(f"{path}: cassette version {data.get('version')} không được hỗ trợ")
+    return data
+
+
+def cache_key(key: Any) -> Any:
+    """Key cache đọc từ JSON (list) về dạng tuple như lúc ghi"""
+    if isinstance(key, list):
+        return tuple(cache_key(item) for item in key)
+    return key
+
+
+def params_key(method: str, url: str, params: Dict[str, str]) -> str:
+    """Khóa so khớp một request aiohttp khi phát lại (bỏ qua param đã bị xóa)"""
+    path = re.sub(r"^https?://[^/]+", "", url)
+    kept = sorted((k, v) for k, v in params.items() if v != REDACTED and k.lower() not in _SECRET_PARAMS)
+    return f"{method} {path}?" + "&".join(f"{k}={v}" for k, v in kept)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3.10
+
+"""
+Hàng đợi theo kênh cho Moon Discord Bot
+
+Các lượt hỏi trong cùng một kênh được xử lý tuần tự để chuỗi
+previous_response_id không bị ghi đè, trong khi các kênh khác nhau vẫn chạy
+song song. Các mention đến gần nhau có thể được gộp thành một lượt.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List
+
+from tracing import Span
+
+
+@dataclass
+class Turn:
+    """Một lượt hỏi đang chờ xử lý trong kênh"""
+    prompt: str
+    images: List[str] = field(default_factory=list)
+    pdfs: List[str] = field(default_factory=list)
+    coalesce: bool = False
+    # Callback nhận từng delta text khi trả lời dạng streaming
+    on_delta: Callable[[str], None] | None = None
+    # True nếu lượt này đại diện cho cả nhóm được gộp (lượt đầu tiên)
+    primary: bool = True
+    # Độ ưu tiên khi chờ chỗ gọi OpenAI (số nhỏ chạy trước)
+    priority: int = 0
+    # Span gốc của lượt hỏi, để worker của kênh tiếp tục đúng trace
+    trace: Span | None = None
+    future: asyncio.Future | None = None
+
+
+class _ChannelQueue:
+    def __init__(self):
+        self.turns: deque[Turn] = deque()
+        self.wakeup = asyncio.Event()
+        self.worker: asyncio.Task | None = None
+
+
+class ChannelDispatcher:
+    """Chạy các lượt của từng kênh theo thứ tự, mỗi kênh một worker"""
+
+    def __init__(
+        self,
+        handler: Callable[[str, List[Turn]], Awaitable[Any]],
+        coalesce_window: float = 0.0,
+        max_batch: int = 5,
+        idle_timeout: float = 60.0,
+    ):
+        self.handler = handler
+        self.coalesce_window = coalesce_window
+        self.max_batch = max(1, max_batch)
+        self.idle_timeout = idle_timeout
+        self._channels: Dict[str, _ChannelQueue] = {}
+
+    def queue_depth(self) -> int:
+        """Tổng số lượt đang chờ trên tất cả các kênh"""
+        return sum(len(channel.turns) for channel in self._channels.values())
+
+    def pending(self, channel_id: str) -> int:
+        """Số lượt đang chờ trong một kênh"""
+        channel = self._channels.get(channel_id)
+        return len(channel.turns) if channel else 0
+
+    async def submit(self, channel_id: str, turn: Turn) -> Any:
+        """Đưa một lượt vào hàng đợi của kênh và chờ kết quả"""
+        turn.future = asyncio.get_running_loop().create_future()
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = _ChannelQueue()
+            self._channels[channel_id] = channel
+        channel.turns.append(turn)
+        channel.wakeup.set()
+        if channel.worker is None or channel.worker.done():
+            channel.worker = asyncio.create_task(self._run(channel_id, channel))
+        return await turn.future
+
+    async def _collect(self, channel: _ChannelQueue) -> List[Turn]:
+        first = channel.turns.popleft()
+        batch = [first]
+        if not first.coalesce or self.coalesce_window <= 0 or self.max_batch == 1:
+            return batch
+
+        # Chờ thêm một khoảng ngắn để gom các mention đến sát nhau
+        await asyncio.sleep(self.coalesce_window)
+        while channel.turns and channel.turns[0].coalesce and len(batch) < self.max_batch:
+            turn = channel.turns.popleft()
+            turn.primary = False
+            batch.append(turn)
+        return batch
+
+    def _abandon(self, channel_id: str, channel: _ChannelQueue, batch: List[Turn]):
+        error = RuntimeError(f"Worker của kênh {channel_id} đã dừng")
+        for turn in [*batch, *channel.turns]:
+            if not turn.future.done():
+                turn.future.set_exception(error)
+        channel.turns.clear()
+        if self._channels.get(channel_id) is channel:
+            del self._channels[channel_id]
+
+    async def _run(self, channel_id: str, channel: _ChannelQueue):
+        while True:
+            if not channel.turns:
+                channel.wakeup.clear()
+                try:
+                    await asyncio.wait_for(channel.wakeup.wait(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                if not channel.turns:
+                    # Không còn việc, giải phóng worker của kênh
+                    if self._channels.get(channel_id) is channel:
+                        del self._channels[channel_id]
+                    return
+
+            batch = await self._collect(channel)
+            if len(batch) > 1:
+                logging.info(f"Gộp {len(batch)} lượt hỏi trong kênh {channel_id}")
+            try:
+                result = await self.handler(channel_id, batch)
+            except Exception as e:
+                logging.error(f"Lỗi khi xử lý lượt hỏi trong kênh {channel_id}: {e}")
+                for turn in batch:
+                    if not turn.future.done():
+                        turn.future.set_exception(e)
+                continue
+            except BaseException:
+                # Worker bị hủy: các lượt đang chờ phải nhận lỗi thay vì treo mãi
+                logging.error(f"Worker của kênh {channel_id} bị dừng khi đang xử lý lượt hỏi")
+                self._abandon(channel_id, channel, batch)
+                raise
+            for turn in batch:
+                if not turn.future.done():
+                    turn.future.set_result(result)
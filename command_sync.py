@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.10
+
+"""
+Bỏ qua bước sync slash command khi command tree không đổi cho Moon Discord Bot
+
+tree.sync() là REST call global bị giới hạn tốc độ rất chặt, gọi mỗi lần khởi
+động làm chậm restart và dễ dính rate limit. Bot tính sha256 của payload các
+command đã đăng ký và lưu lại theo từng phạm vi (application + global/guild);
+chỉ sync khi fingerprint đổi hoặc khi được yêu cầu sync lại (--force-sync).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Dict
+
+import discord
+from discord import app_commands
+
+
+def tree_fingerprint(tree: app_commands.CommandTree, guild: discord.abc.Snowflake | None = None) -> str:
+    """sha256 của payload mà tree.sync() sẽ gửi cho phạm vi `guild`"""
+    payloads = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda payload: (payload.get("type", 1), payload["name"]),
+    )
+    data = json.dumps(payloads, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def sync_scope(application_id: int | None, guild: discord.abc.Snowflake | None = None) -> str:
+    return f"{application_id}:{f'guild:{guild.id}' if guild else 'global'}"
+
+
+class CommandSyncState:
+    """Fingerprint của lần sync thành công gần nhất, lưu trong file JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fingerprints: Dict[str, str] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._fingerprints = {k: v for k, v in data.items() if isinstance(v, str)}
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f"Không đọc được {path}, sẽ sync lại command: {e}")
+
+    def is_current(self, scope: str, fingerprint: str) -> bool:
+        return self._fingerprints.get(scope) == fingerprint
+
+    def save(self, scope: str, fingerprint: str):
+        self._fingerprints[scope] = fingerprint
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".command_sync.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._fingerprints, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            logging.warning(f"Không lưu được fingerprint command tree: {e}")
+
+
+async def sync_commands(
+    tree: app_commands.CommandTree,
+    state: CommandSyncState,
+    application_id: int | None,
+    guild: discord.abc.Snowflake | None = None,
+    force: bool = False,
+) -> bool:
+    """Sync command tree nếu fingerprint đổi (hoặc force), trả về True nếu đã sync"""
+    scope = sync_scope(application_id, guild)
+    fingerprint = tree_fingerprint(tree, guild)
+    if not force and state.is_current(scope, fingerprint):
+        logging.info(f"Command tree không đổi ({fingerprint[:12]}), bỏ qua sync {scope}")
+        return False
+    await tree.sync(guild=guild)
+    state.save(scope, fingerprint)
+    logging.info(f"Đã sync command tree {scope} ({fingerprint[:12]})")
+    return True
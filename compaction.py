@@ -0,0 +1,123 @@
+#!/usr/bin/env python3.10
+
+"""
+Nén ngữ cảnh hội thoại cho Moon Discord Bot
+
+previous_response_id khiến toàn bộ lịch sử của kênh bị tính lại vào input ở
+mỗi lượt hỏi. Khi ngữ cảnh của một kênh vượt ngưỡng, compactor nhờ một model
+rẻ tóm tắt cuộc trò chuyện ở nền rồi thay chuỗi cũ bằng bản tóm tắt; lượt hỏi
+sau bắt đầu chuỗi mới kèm bản tóm tắt đó. Lượt hỏi của người dùng không bao
+giờ phải chờ việc tóm tắt.
+
+Bản tóm tắt bị bỏ nếu kênh đã có lượt mới trong lúc tóm tắt, nên compactor
+không tóm tắt khi kênh còn lượt đang chờ và giãn dần các lần thử sau mỗi bản
+tóm tắt bị bỏ (kênh bận liên tục không tốn token tóm tắt ở mọi lượt).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict
+
+from conversation_store import ConversationState, ConversationStore
+
+# Tóm tắt (response_id, context_tokens) -> bản tóm tắt
+Summarizer = Callable[[str, int], Awaitable[str]]
+
+# Ước tính thô số token của bản tóm tắt (khớp với budget.CHARS_PER_TOKEN)
+_CHARS_PER_TOKEN = 3
+
+
+class ConversationCompactor:
+    """Lên lịch tóm tắt ở nền cho các kênh có ngữ cảnh vượt ngưỡng"""
+
+    def __init__(
+        self,
+        store: ConversationStore,
+        summarize: Summarizer,
+        threshold: int,
+        pending: Callable[[str], int] | None = None,
+        retry_after: float = 60.0,
+        max_retry_after: float = 900.0,
+    ):
+        self.store = store
+        self.summarize = summarize
+        # Số token ngữ cảnh để bắt đầu nén (0 = tắt)
+        self.threshold = threshold
+        # Số lượt đang chờ của kênh; còn lượt chờ thì chuỗi chắc chắn sẽ đổi trước khi tóm tắt xong
+        self.pending = pending
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # channel_id -> (số bản tóm tắt bị bỏ liên tiếp, thời điểm được thử lại)
+        self._backoff: Dict[str, tuple[int, float]] = {}
+        self._next_prune = 0.0
+        self.compacted = 0
+        self.discarded = 0
+
+    def _prune_backoff(self, now: float):
+        """Bỏ backoff của các kênh đã quá hạn thử lại lâu (kênh bị bỏ tóm tắt rồi im lặng)"""
+        if now < self._next_prune:
+            return
+        self._next_prune = now + self.retry_after
+        expired = [
+            channel_id for channel_id, (_, retry_at) in self._backoff.items()
+            if now - retry_at >= self.max_retry_after
+        ]
+        for channel_id in expired:
+            del self._backoff[channel_id]
+
+    def maybe_compact(self, channel_id: str, state: ConversationState):
+        """Gọi sau mỗi lượt hỏi; chỉ tạo task nền, không chờ"""
+        now = time.monotonic()
+        self._prune_backoff(now)
+        if (
+            self.threshold <= 0
+            or state.response_id is None
+            or state.context_tokens < self.threshold
+            or channel_id in self._tasks
+            or (self.pending is not None and self.pending(channel_id) > 0)
+            or now < self._backoff.get(channel_id, (0, 0.0))[1]
+        ):
+            return
+        task = asyncio.create_task(self._compact(channel_id, state.response_id, state.context_tokens))
+        self._tasks[channel_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(channel_id, None))
+
+    async def _compact(self, channel_id: str, response_id: str, context_tokens: int):
+        logging.info(f"Compacting conversation in channel {channel_id} ({context_tokens} context tokens)")
+        try:
+            summary = (await self.summarize(response_id, context_tokens)).strip()
+        except Exception as e:
+            # Lượt hỏi sau sẽ thử lại
+            logging.error(f"Lỗi khi tóm tắt hội thoại của kênh {channel_id}: {e}")
+            return
+        if not summary:
+            return
+        summary_tokens = len(summary) // _CHARS_PER_TOKEN
+        if await self.store.compact(channel_id, response_id, summary, summary_tokens):
+            self.compacted += 1
+            self._backoff.pop(channel_id, None)
+            logging.info(
+                f"Compacted channel {channel_id}: {context_tokens} -> ~{summary_tokens} context tokens"
+            )
+        else:
+            self.discarded += 1
+            failures = self._backoff.get(channel_id, (0, 0.0))[0] + 1
+            delay = min(self.retry_after * 2 ** (failures - 1), self.max_retry_after)
+            self._backoff[channel_id] = (failures, time.monotonic() + delay)
+            logging.info(
+                f"Channel {channel_id} moved on during compaction, keeping current chain "
+                f"(next attempt in {delay:.0f}s)"
+            )
+
+    async def drain(self, timeout: float):
+        """Chờ các lần tóm tắt đang chạy xong (tối đa `timeout` giây) trước khi tắt bot"""
+        if self._tasks and timeout > 0:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
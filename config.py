@@ -10,15 +10,80 @@ class Config(BaseSettings):
     openai_api_key: str = Field(..., alias="OPENAI_API_KEY")
     openai_base_url: str = Field(..., alias="OPENAI_BASE_URL")
     openai_model: str = Field(default="gpt-5-mini", alias="OPENAI_MODEL")
+    stream_responses: bool = Field(default=True, alias="STREAM_RESPONSES")
+    stream_edit_interval: float = Field(default=1.0, alias="STREAM_EDIT_INTERVAL")
 
     # Models and token limits loaded from environment
     premium_models: set[str] = Field(default_factory=set, alias="PREMIUM_MODELS")
     mini_models: set[str] = Field(default_factory=set, alias="MINI_MODELS")
     token_limits: Dict[str, int] = Field(default_factory=dict, alias="TOKEN_LIMITS")
+    fallback_model: str = Field(default="gpt-5-mini", alias="FALLBACK_MODEL")
     token_usage_file: str = Field(default="token_usage.json", alias="TOKEN_USAGE_FILE")
+    token_usage_flush_interval: float = Field(default=30.0, alias="TOKEN_USAGE_FLUSH_INTERVAL")
+    token_usage_sync_interval: float = Field(default=2.0, alias="TOKEN_USAGE_SYNC_INTERVAL")
+    shard_count: int = Field(default=0, alias="SHARD_COUNT")
+    shard_workers: int = Field(default=2, alias="SHARD_WORKERS")
+    command_sync_file: str = Field(default="command_sync.json", alias="COMMAND_SYNC_FILE")
+    dev_guild_id: int = Field(default=0, alias="DEV_GUILD_ID")
+    functions_reload_interval: float = Field(default=0.0, alias="FUNCTIONS_RELOAD_INTERVAL")
+    drain_timeout: float = Field(default=30.0, alias="DRAIN_TIMEOUT")
+    ready_file: str = Field(default="moon_ready.txt", alias="READY_FILE")
+    conversation_db_file: str = Field(default="conversations.db", alias="CONVERSATION_DB_FILE")
+    conversation_cache_size: int = Field(default=1000, alias="CONVERSATION_CACHE_SIZE")
+    conversation_cache_ttl: float = Field(default=3600.0, alias="CONVERSATION_CACHE_TTL")
+    compaction_threshold: int = Field(default=60000, alias="COMPACTION_THRESHOLD")
+    compaction_model: str = Field(default="gpt-5-mini", alias="COMPACTION_MODEL")
+    compaction_max_tokens: int = Field(default=1500, alias="COMPACTION_MAX_TOKENS")
+    channel_coalesce_ms: int = Field(default=0, alias="CHANNEL_COALESCE_MS")
+    channel_coalesce_max: int = Field(default=5, alias="CHANNEL_COALESCE_MAX")
+    openai_retry_max_attempts: int = Field(default=4, alias="OPENAI_RETRY_MAX_ATTEMPTS")
+    openai_retry_base_delay: float = Field(default=0.5, alias="OPENAI_RETRY_BASE_DELAY")
+    openai_retry_max_delay: float = Field(default=8.0, alias="OPENAI_RETRY_MAX_DELAY")
+    openai_request_deadline: float = Field(default=120.0, alias="OPENAI_REQUEST_DEADLINE")
+    openai_hedge_requests: bool = Field(default=False, alias="OPENAI_HEDGE_REQUESTS")
+    openai_hedge_max_ratio: float = Field(default=0.1, alias="OPENAI_HEDGE_MAX_RATIO")
+    openai_max_concurrency: int = Field(default=8, alias="OPENAI_MAX_CONCURRENCY")
+    admission_queue_size: int = Field(default=32, alias="ADMISSION_QUEUE_SIZE")
+    user_rate_per_minute: float = Field(default=6.0, alias="USER_RATE_PER_MINUTE")
+    user_burst: int = Field(default=3, alias="USER_BURST")
+    guild_rate_per_minute: float = Field(default=30.0, alias="GUILD_RATE_PER_MINUTE")
+    guild_burst: int = Field(default=10, alias="GUILD_BURST")
+    response_cache_enabled: bool = Field(default=False, alias="RESPONSE_CACHE_ENABLED")
+    response_cache_ttl: float = Field(default=3600.0, alias="RESPONSE_CACHE_TTL")
+    response_cache_max_entries: int = Field(default=256, alias="RESPONSE_CACHE_MAX_ENTRIES")
+    attachment_upload: bool = Field(default=True, alias="ATTACHMENT_UPLOAD")
+    attachment_max_bytes: int = Field(default=20 * 1024 * 1024, alias="ATTACHMENT_MAX_BYTES")
+    attachment_cache_size: int = Field(default=512, alias="ATTACHMENT_CACHE_SIZE")
+    attachment_workers: int = Field(default=2, alias="ATTACHMENT_WORKERS")
+    pdf_extract_text: bool = Field(default=True, alias="PDF_EXTRACT_TEXT")
+    pdf_max_pages: int = Field(default=30, alias="PDF_MAX_PAGES")
+    pdf_max_chars: int = Field(default=60000, alias="PDF_MAX_CHARS")
+    pdf_min_chars_per_page: int = Field(default=200, alias="PDF_MIN_CHARS_PER_PAGE")
+    image_max_edge: int = Field(default=1536, alias="IMAGE_MAX_EDGE")
+    image_jpeg_quality: int = Field(default=85, alias="IMAGE_JPEG_QUALITY")
+    tool_max_parallel: int = Field(default=4, alias="TOOL_MAX_PARALLEL")
+    tool_max_rounds: int = Field(default=5, alias="TOOL_MAX_ROUNDS")
+    http_pool_limit: int = Field(default=100, alias="HTTP_POOL_LIMIT")
+    http_pool_limit_per_host: int = Field(default=10, alias="HTTP_POOL_LIMIT_PER_HOST")
+    http_timeout: float = Field(default=15.0, alias="HTTP_TIMEOUT")
+    metrics_host: str = Field(default="127.0.0.1", alias="METRICS_HOST")
+    metrics_port: int = Field(default=0, alias="METRICS_PORT")
+    trace_file: str = Field(default="", alias="TRACE_FILE")
+    trace_sample_rate: float = Field(default=0.1, alias="TRACE_SAMPLE_RATE")
+    trace_max_bytes: int = Field(default=10_000_000, alias="TRACE_MAX_BYTES")
+    trace_backup_count: int = Field(default=3, alias="TRACE_BACKUP_COUNT")
+    cassette_dir: str = Field(default="", alias="CASSETTE_DIR")
     openweathermap_api_key: str = Field(default="", alias="OPENWEATHERMAP_API_KEY")
+    openweathermap_base_url: str = Field(default="https://api.openweathermap.org", alias="OPENWEATHERMAP_BASE_URL")
+    gazetteer_file: str = Field(default="gazetteer_vn.json", alias="GAZETTEER_FILE")
+    weather_cache_ttl: float = Field(default=600.0, alias="WEATHER_CACHE_TTL")
+    geocoding_cache_ttl: float = Field(default=86400.0, alias="GEOCODING_CACHE_TTL")
+    weather_cache_max_entries: int = Field(default=512, alias="WEATHER_CACHE_MAX_ENTRIES")
+    weather_cache_max_bytes: int = Field(default=4_000_000, alias="WEATHER_CACHE_MAX_BYTES")
 
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
         case_sensitive = False
+        # Cấu hình là snapshot bất biến, được chia sẻ cho các function qua RuntimeContext
+        frozen = True
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3.10
+
+"""
+Kho lưu trạng thái hội thoại theo kênh cho Moon Discord Bot
+
+Phía trước là cache LRU/TTL trong bộ nhớ, phía sau là backend bền vững
+(mặc định SQLite). Trạng thái của một kênh chỉ được đọc từ backend khi kênh đó
+được truy cập lần đầu, nên khởi động không phải đọc toàn bộ lịch sử.
+Khi chạy nhiều shard, các process dùng chung file SQLite; mỗi kênh chỉ thuộc
+một shard nên cache trong bộ nhớ của từng process không bị lệch nhau.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict
+
+
+@dataclass
+class ConversationState:
+    """Trạng thái hội thoại của một kênh"""
+    response_id: str | None = None
+    turns: int = 0
+    updated_at: float = 0.0
+    # Số token ngữ cảnh của response cuối (input + output), dùng để ước tính chi phí lượt sau
+    context_tokens: int = 0
+    # Tóm tắt của chuỗi cũ đã được nén, gửi kèm lượt hỏi đầu tiên của chuỗi mới
+    summary: str | None = None
+
+
+class ConversationBackend:
+    """Interface cho backend lưu trữ. Các method chạy đồng bộ trên thread riêng."""
+
+    def load(self, channel_id: str) -> ConversationState | None:
+        raise NotImplementedError
+
+    def save(self, channel_id: str, state: ConversationState):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryConversationBackend(ConversationBackend):
+    """Backend không bền vững, dùng khi không cấu hình file database"""
+
+    def __init__(self):
+        self._data: Dict[str, ConversationState] = {}
+
+    def load(self, channel_id: str) -> ConversationState | None:
+        return self._data.get(channel_id)
+
+    def save(self, channel_id: str, state: ConversationState):
+        self._data[channel_id] = state
+
+
+class SQLiteConversationBackend(ConversationBackend):
+    """Backend SQLite, mỗi kênh là một dòng trong bảng conversations"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Khi chạy nhiều shard, các process khác có thể đang ghi cùng lúc
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                " channel_id TEXT PRIMARY KEY,"
+                " response_id TEXT,"
+                " turns INTEGER NOT NULL DEFAULT 0,"
+                " updated_at REAL NOT NULL)"
+            )
+            # Database tạo từ phiên bản cũ chưa có các cột mới
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+            for column, definition in (
+                ("context_tokens", "INTEGER NOT NULL DEFAULT 0"),
+                ("summary", "TEXT"),
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE conversations ADD COLUMN {column} {definition}")
+            self._conn = conn
+        return self._conn
+
+    def load(self, channel_id: str) -> ConversationState | None:
+        row = self._connect().execute(
+            "SELECT response_id, turns, updated_at, context_tokens, summary"
+            " FROM conversations WHERE channel_id = ?",
+            (channel_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        return ConversationState(
+            response_id=row[0], turns=row[1], updated_at=row[2], context_tokens=row[3], summary=row[4]
+        )
+
+    def save(self, channel_id: str, state: ConversationState):
+        self._connect().execute(
+            "INSERT INTO conversations (channel_id, response_id, turns, updated_at, context_tokens, summary)"
+            " VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(channel_id) DO UPDATE SET"
+            " response_id = excluded.response_id,"
+            " turns = excluded.turns,"
+            " updated_at = excluded.updated_at,"
+            " context_tokens = excluded.context_tokens,"
+            " summary = excluded.summary",
+            (
+                channel_id, state.response_id, state.turns, state.updated_at,
+                state.context_tokens, state.summary,
+            ),
+        )
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ConversationStore:
+    """Cache LRU/TTL trước một ConversationBackend"""
+
+    def __init__(self, backend: ConversationBackend, max_entries: int = 1000, ttl: float = 3600.0):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._cache: OrderedDict[str, tuple[ConversationState, float]] = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        # Một thread duy nhất để backend không phải xử lý truy cập đồng thời
+        # và các lần ghi được thực hiện đúng thứ tự
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="conversation-store")
+        self._pending_writes: set[asyncio.Future] = set()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def _remember(self, channel_id: str, state: ConversationState):
+        now = time.monotonic()
+        self._cache[channel_id] = (state, now)
+        self._cache.move_to_end(channel_id)
+        # Bỏ các kênh lâu không hoạt động (nằm ở đầu OrderedDict) và giữ kích thước tối đa
+        while self._cache:
+            oldest_id, (_, last_access) = next(iter(self._cache.items()))
+            if len(self._cache) > self.max_entries or now - last_access > self.ttl:
+                self._cache.popitem(last=False)
+            else:
+                break
+
+    async def get(self, channel_id: str) -> ConversationState:
+        """Lấy trạng thái của kênh, đọc từ backend nếu chưa có trong cache"""
+        cached = self._cache.get(channel_id)
+        if cached is not None and time.monotonic() - cached[1] <= self.ttl:
+            self._remember(channel_id, cached[0])
+            return cached[0]
+
+        # Gộp các lần đọc đồng thời cho cùng một kênh
+        future = self._loading.get(channel_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, self.backend.load, channel_id)
+            self._loading[channel_id] = future
+            try:
+                state = await future
+            except Exception as e:
+                logging.error(f"Lỗi khi đọc hội thoại của kênh {channel_id}: {e}")
+                state = None
+            finally:
+                self._loading.pop(channel_id, None)
+            state = state or ConversationState()
+            # Có thể đã có update trong lúc chờ đọc, bản trong cache luôn mới hơn
+            cached = self._cache.get(channel_id)
+            if cached is not None:
+                return cached[0]
+            self._remember(channel_id, state)
+            return state
+
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            pass
+        cached = self._cache.get(channel_id)
+        return cached[0] if cached is not None else ConversationState()
+
+    async def get_response_id(self, channel_id: str) -> str | None:
+        """response_id cuối cùng của kênh (dùng làm previous_response_id)"""
+        return (await self.get(channel_id)).response_id
+
+    def _persist(self, channel_id: str, state: ConversationState):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self.backend.save, channel_id, state)
+        self._pending_writes.add(future)
+
+        def _done(f: asyncio.Future):
+            self._pending_writes.discard(f)
+            if not f.cancelled() and f.exception() is not None:
+                logging.error(f"Lỗi khi lưu hội thoại của kênh {channel_id}: {f.exception()}")
+
+        future.add_done_callback(_done)
+
+    async def update(
+        self, channel_id: str, response_id: str | None, context_tokens: int = 0
+    ) -> ConversationState:
+        """Ghi response_id mới cho kênh (cache ngay, backend ở nền)"""
+        previous = await self.get(channel_id)
+        summary = None
+        if response_id is None and previous.summary:
+            # Lượt đầu tiên sau khi nén bị lỗi: giữ bản tóm tắt cho lượt sau
+            summary, context_tokens = previous.summary, previous.context_tokens
+        elif response_id is None:
+            context_tokens = 0
+        state = ConversationState(
+            response_id=response_id,
+            turns=previous.turns + 1 if response_id else 0,
+            updated_at=time.time(),
+            context_tokens=context_tokens,
+            summary=summary,
+        )
+        self._remember(channel_id, state)
+        self._persist(channel_id, state)
+        return state
+
+    async def compact(
+        self, channel_id: str, expected_response_id: str, summary: str, context_tokens: int
+    ) -> bool:
+        """Thay chuỗi hội thoại bằng bản tóm tắt nếu kênh vẫn đang ở expected_response_id"""
+        previous = await self.get(channel_id)
+        if previous.response_id != expected_response_id:
+            # Đã có lượt hỏi mới hoặc /new_chat trong lúc tóm tắt, bỏ kết quả
+            return False
+        state = ConversationState(
+            response_id=None,
+            turns=0,
+            updated_at=time.time(),
+            context_tokens=context_tokens,
+            summary=summary,
+        )
+        self._remember(channel_id, state)
+        self._persist(channel_id, state)
+        return True
+
+    async def reset(self, channel_id: str) -> ConversationState:
+        """Bắt đầu chủ đề mới cho kênh"""
+        state = ConversationState(updated_at=time.time())
+        self._remember(channel_id, state)
+        self._persist(channel_id, state)
+        return state
+
+    async def close(self):
+        """Chờ các lần ghi còn dang dở rồi đóng backend"""
+        if self._pending_writes:
+            await asyncio.gather(*self._pending_writes, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self.backend.close)
+        self._executor.shutdown(wait=True)
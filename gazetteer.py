@@ -0,0 +1,243 @@
+#!/usr/bin/env python3.10
+
+"""
+Gazetteer offline cho Moon Discord Bot
+
+Chỉ mục tên tỉnh/thành phố Việt Nam và các quận, huyện, thành phố trực thuộc
+kèm tọa độ, để get_weather không phải gọi geocoding API cho các địa danh phổ
+biến. Hỗ trợ tra cứu chính xác, theo tiền tố và gần đúng (n-gram).
+"""
+
+import bisect
+import json
+import logging
+import re
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+# Tiền tố hành chính được bỏ đi khi so khớp (đã bỏ dấu)
+CITY_PREFIXES = ("thanh pho ", "tp ", "tinh ")
+DISTRICT_PREFIXES = ("thanh pho ", "thi xa ", "thi tran ", "quan ", "huyen ", "phuong ", "xa ", "tp ")
+
+# Phần cuối địa chỉ chỉ tên nước Việt Nam
+COUNTRY_NAMES = {"viet nam", "vietnam", "vn", "nuoc viet nam"}
+# Tên tiếng Việt của nước/thành phố nước ngoài gần giống tên tỉnh ("Bắc Kinh" ~ Bắc Ninh, "Lào" ~ Lào Cai)
+FOREIGN_NAMES = {
+    "lao", "trung quoc", "bac kinh", "thuong hai", "quang chau", "hong kong", "dai loan", "dai bac",
+    "campuchia", "cam pu chia", "phnom penh", "nam vang", "vieng chan", "thai lan", "nhat ban",
+    "han quoc", "trieu tien", "binh nhuong", "an do", "nga", "phap", "anh", "duc", "my", "hoa ky", "uc",
+}
+
+# So khớp gần đúng chỉ nhận khi rất giống (hệ số Dice trên trigram)
+FUZZY_THRESHOLD = 0.8
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_NUMBERED_DISTRICT = re.compile(r"^quan (\d+)$")
+
+
+def normalize(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt, bỏ dấu câu và khoảng trắng thừa"""
+    text = text.lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def _strip_prefix(text: str, prefixes: Iterable[str]) -> str:
+    for prefix in prefixes:
+        if text.startswith(prefix):
+            return text[len(prefix):]
+    return text
+
+
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass(frozen=True)
+class Place:
+    name: str
+    lat: float
+    lon: float
+    country: str = "VN"
+    parent: str | None = None
+
+    @property
+    def display_name(self) -> str:
+        return f"{self.name}, {self.parent}" if self.parent else self.name
+
+
+class Gazetteer:
+    """Chỉ mục địa danh trong bộ nhớ"""
+
+    def __init__(self, places: List[dict], country: str = "VN"):
+        # alias đã chuẩn hóa -> tỉnh/thành phố
+        self._cities: Dict[str, Place] = {}
+        # tỉnh/thành phố -> danh sách (alias, địa danh con), alias dài xếp trước
+        self._districts: Dict[Place, List[Tuple[str, Place]]] = {}
+        # alias của địa danh con -> các địa danh con (có thể trùng tên giữa các tỉnh)
+        self._district_aliases: Dict[str, List[Place]] = {}
+        self._city_aliases_by_length: List[str] = []
+        self._sorted_city_aliases: List[str] = []
+        self._trigram_index: Dict[str, set[str]] = {}
+
+        for entry in places:
+            city = Place(entry["name"], entry["lat"], entry["lon"], country)
+            for alias in self._aliases(entry, CITY_PREFIXES):
+                self._cities.setdefault(alias, city)
+            districts = []
+            for sub in entry.get("districts", []):
+                place = Place(sub["name"], sub["lat"], sub["lon"], country, parent=city.name)
+                for alias in self._aliases(sub, DISTRICT_PREFIXES):
+                    districts.append((alias, place))
+                    self._district_aliases.setdefault(alias, []).append(place)
+            districts.sort(key=lambda item: len(item[0]), reverse=True)
+            self._districts[city] = districts
+
+        self._city_aliases_by_length = sorted(self._cities, key=len, reverse=True)
+        self._sorted_city_aliases = sorted(self._cities)
+        for alias in self._cities:
+            for gram in _trigrams(alias):
+                self._trigram_index.setdefault(gram, set()).add(alias)
+
+    @staticmethod
+    def _aliases(entry: dict, prefixes: Tuple[str, ...]) -> set[str]:
+        aliases = set()
+        for raw in [entry["name"], *entry.get("aliases", [])]:
+            alias = normalize(raw)
+            if not alias:
+                continue
+            aliases.add(alias)
+            aliases.add(alias.replace(" ", ""))
+            stripped = _strip_prefix(alias, prefixes)
+            numbered = _NUMBERED_DISTRICT.match(alias)
+            if numbered:
+                # "Quận 1" -> "q1", "q 1", "district 1" (không bỏ tiền tố vì "1" quá mơ hồ)
+                number = numbered.group(1)
+                aliases.update({f"q{number}", f"q {number}", f"district {number}"})
+            elif stripped != alias:
+                aliases.add(stripped)
+        return aliases
+
+    @classmethod
+    def load(cls, path: str) -> "Gazetteer":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        gazetteer = cls(data["places"], data.get("country", "VN"))
+        logging.info(
+            f"Đã tải gazetteer: {len(gazetteer._districts)} tỉnh/thành phố, "
+            f"{len(gazetteer._district_aliases)} tên địa danh con"
+        )
+        return gazetteer
+
+    # --- Tra cứu tỉnh/thành phố ---
+    def _match_city_exact(self, segment: str) -> Place | None:
+        return self._cities.get(segment) or self._cities.get(_strip_prefix(segment, CITY_PREFIXES))
+
+    def _match_city_prefix(self, segment: str) -> Place | None:
+        # Tên đầy đủ của một địa danh khác không phải tiền tố ("lao" là Lào, không phải Lào Cai)
+        if len(segment) < 3 or segment in FOREIGN_NAMES or segment in self._district_aliases:
+            return None
+        index = bisect.bisect_left(self._sorted_city_aliases, segment)
+        matches = set()
+        while index < len(self._sorted_city_aliases) and self._sorted_city_aliases[index].startswith(segment):
+            alias = self._sorted_city_aliases[index]
+            # Chỉ nhận tiền tố gồm nguyên các từ ("ba ria" -> "ba ria vung tau", không nhận "ba r")
+            if alias.startswith(f"{segment} "):
+                matches.add(self._cities[alias])
+            index += 1
+        return matches.pop() if len(matches) == 1 else None
+
+    def _match_city_fuzzy(self, segment: str, threshold: float = FUZZY_THRESHOLD) -> Place | None:
+        if len(segment) < 3 or segment in FOREIGN_NAMES:
+            return None
+        words = len(segment.split())
+        grams = _trigrams(segment)
+        counts: Dict[str, int] = {}
+        for gram in grams:
+            for alias in self._trigram_index.get(gram, ()):
+                counts[alias] = counts.get(alias, 0) + 1
+        best_alias, best_score = None, threshold
+        for alias, shared in counts.items():
+            # Số từ phải bằng nhau: "bac kinh" không được khớp với "bac ninh" chỉ vì chung "bac"
+            if len(alias.split()) != words:
+                continue
+            # Hệ số Dice trên tập trigram
+            score = 2 * shared / (len(grams) + len(_trigrams(alias)))
+            if score > best_score:
+                best_alias, best_score = alias, score
+        return self._cities[best_alias] if best_alias else None
+
+    def _contained_city(self, text: str) -> Place | None:
+        padded = f" {text} "
+        for alias in self._city_aliases_by_length:
+            if f" {alias} " in padded:
+                return self._cities[alias]
+        return None
+
+    # --- Tra cứu quận/huyện ---
+    def _contained_district(self, city: Place, text: str) -> Place | None:
+        padded = f" {text} "
+        for alias, place in self._districts.get(city, ()):
+            if f" {alias} " in padded:
+                return place
+        return None
+
+    def _unique_district(self, segments: List[str]) -> Place | None:
+        for segment in segments:
+            for candidate in (segment, _strip_prefix(segment, DISTRICT_PREFIXES)):
+                places = self._district_aliases.get(candidate)
+                if places and len(places) == 1:
+                    return places[0]
+        return None
+
+    def _is_vietnamese(self, segment: str) -> bool:
+        """Phần địa chỉ là Việt Nam hoặc một địa danh trong gazetteer"""
+        return bool(
+            segment in COUNTRY_NAMES
+            or self._match_city_exact(segment)
+            or self._contained_city(segment)
+            or self._district_aliases.get(segment)
+            or self._district_aliases.get(_strip_prefix(segment, DISTRICT_PREFIXES))
+            or self._match_city_prefix(segment)
+            or self._match_city_fuzzy(segment)
+        )
+
+    def lookup(self, address: str) -> Place | None:
+        """Tìm tọa độ cho một địa chỉ, trả về None nếu không chắc chắn"""
+        full = normalize(address)
+        if not full:
+            return None
+        segments = [s for s in (normalize(part) for part in re.split(r"[,;/\-]", address)) if s]
+        # Địa danh nước ngoài có tên tiếng Việt: để geocoding xử lý
+        if full in FOREIGN_NAMES or any(segment in FOREIGN_NAMES for segment in segments):
+            return None
+        # Phần cuối (nước/bang/vùng) không phải Việt Nam, ví dụ "Hue, Texas": để geocoding xử lý
+        if len(segments) > 1 and not self._is_vietnamese(segments[-1]):
+            return None
+
+        # Tỉnh/thành phố thường nằm ở cuối địa chỉ
+        city = None
+        for segment in reversed(segments):
+            city = self._match_city_exact(segment)
+            if city:
+                break
+        if city is None:
+            city = self._contained_city(full)
+        if city is not None:
+            return self._contained_district(city, full) or city
+
+        # Chỉ có tên quận/huyện/thành phố trực thuộc (ví dụ "Vũng Tàu", "Đà Lạt")
+        place = self._unique_district(segments)
+        if place is not None:
+            return place
+
+        # Cuối cùng mới thử tiền tố và so khớp gần đúng để tránh nhận nhầm
+        for segment in reversed(segments):
+            city = self._match_city_prefix(segment) or self._match_city_fuzzy(segment)
+            if city:
+                return self._contained_district(city, full) or city
+        return None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3.10
+
+"""
+Vòng đời nhận việc của Moon Discord Bot (standby -> running -> draining)
+
+Khi nhận SIGTERM, bot ngừng nhận lượt hỏi mới nhưng vẫn trả lời xong các lượt
+đang chạy (đã tốn token) trong thời hạn cho phép, rồi mới đóng kết nối và flush
+token usage/hội thoại. Process mới khởi động với --takeover ở trạng thái
+standby: nó kết nối gateway nhưng bỏ qua mọi sự kiện cho tới khi sẵn sàng, rồi
+gửi SIGTERM cho process cũ và chỉ bắt đầu nhận việc khi process cũ đã thoát,
+nên không có sự kiện nào được hai process cùng xử lý và chuỗi hội thoại trong
+SQLite không bị hai process ghi chồng.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+STANDBY = "standby"
+RUNNING = "running"
+DRAINING = "draining"
+
+
+class Lifecycle:
+    """Trạng thái nhận việc và số lượt hỏi đang chạy"""
+
+    def __init__(self):
+        self.state = RUNNING
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def accepting(self) -> bool:
+        return self.state == RUNNING
+
+    def standby(self):
+        """Chưa nhận việc (process cũ vẫn đang phục vụ)"""
+        self.state = STANDBY
+
+    def activate(self):
+        if self.state == STANDBY:
+            self.state = RUNNING
+
+    def begin_drain(self) -> bool:
+        """Ngừng nhận việc mới, trả về False nếu đã drain từ trước"""
+        if self.state == DRAINING:
+            return False
+        self.state = DRAINING
+        return True
+
+    @contextmanager
+    def track(self) -> Iterator[None]:
+        """Đánh dấu một lượt hỏi đang chạy (drain sẽ chờ lượt này xong)"""
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Chờ các lượt hỏi đang chạy xong, trả về False nếu hết `timeout` giây"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+def write_ready_file(path: str, pid: int | None = None):
+    """Ghi PID vào file ready (ghi nguyên tử) để script restart biết process đã sẵn sàng"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".moon_ready.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(str(pid or os.getpid()))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        logging.warning(f"Không ghi được file ready {path}: {e}")
+
+
+def read_ready_file(path: str) -> int | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def clear_ready_file(path: str, pid: int | None = None):
+    """Xóa file ready nếu nó vẫn là của process này (process mới có thể đã ghi đè)"""
+    if read_ready_file(path) == (pid or os.getpid()):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def terminate(pid: int) -> bool:
+    """Gửi SIGTERM cho process cũ, trả về False nếu process không còn"""
+    try:
+        os.kill(pid, signal.SIGTERM)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError as e:
+        logging.error(f"Không gửi được SIGTERM cho pid {pid}: {e}")
+        return False
+
+
+async def wait_exit(pid: int, timeout: float, interval: float = 0.5) -> bool:
+    """Chờ process `pid` thoát, trả về False nếu hết `timeout` giây"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        await asyncio.sleep(interval)
+    return False
@@ -1,20 +1,49 @@
 #!/usr/bin/env python3.10
 
+import argparse
 import asyncio
-import json
+import hashlib
 import logging
 import os
 import random
-import inspect
-from datetime import datetime
-from typing import Dict, List, Any, Callable
+import re
+import signal
+import time
+from dataclasses import asdict
+from typing import Any, Callable
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
+from admission import PRIORITY_COMMAND, PRIORITY_MENTION, AdmissionController, AdmissionRejected
+from attachments import IMAGE, PDF, Attachment, AttachmentPipeline
+from budget import CHARS_PER_TOKEN, BudgetRouter, Route
+from cassettes import CassetteRecorder
+from cache import TTLCache
+from channel_queue import ChannelDispatcher, Turn
+from command_sync import CommandSyncState, sync_commands
+from compaction import ConversationCompactor
 from config import Config
+from conversation_store import ConversationStore, MemoryConversationBackend, SQLiteConversationBackend
+from gazetteer import Gazetteer
+from lifecycle import Lifecycle, clear_ready_file, terminate, wait_exit, write_ready_file
+from metrics import (
+    CACHE_REQUESTS_TOTAL,
+    ERRORS_TOTAL,
+    INTERACTION_DEFER_SECONDS,
+    OPENAI_REQUEST_SECONDS,
+    QUEUE_DEPTH,
+    REGISTRY,
+    MetricsServer,
+)
+from registry import FunctionRegistry, ModuleWatcher, RuntimeContext, load_functions
+from retry import Hedger, RetryPolicy, with_retry
+from streaming import StreamingReply, timed_send
+from supervisor import ShardSupervisor, current_worker, shard_ids_for, watch_parent
+from tracing import TRACER, SpanWriter, current_span
+from token_usage import SQLiteTokenUsageLedger, TokenUsageLedger
 
 # --- Load configuration ---
 config = Config()
@@ -24,12 +53,127 @@ INSTRUCTIONS = config.instructions
 OPENAI_API_KEY = config.openai_api_key
 OPENAI_BASE_URL = config.openai_base_url
 OPENAI_MODEL = config.openai_model
+STREAM_RESPONSES = config.stream_responses
+STREAM_EDIT_INTERVAL = config.stream_edit_interval
+TOOL_MAX_PARALLEL = config.tool_max_parallel
+TOOL_MAX_ROUNDS = config.tool_max_rounds
+HTTP_POOL_LIMIT = config.http_pool_limit
+HTTP_POOL_LIMIT_PER_HOST = config.http_pool_limit_per_host
+HTTP_TIMEOUT = config.http_timeout
+# Module chứa các function (nạp lại được khi bot đang chạy)
+FUNCTIONS_MODULE = "functions"
+# Chu kỳ (giây) kiểm tra functions.py để tự nạp lại, 0 = chỉ nạp lại bằng /reload_functions
+FUNCTIONS_RELOAD_INTERVAL = config.functions_reload_interval
+GAZETTEER_FILE = (
+    os.path.join(os.path.dirname(__file__), config.gazetteer_file)
+    if config.gazetteer_file else None
+)
 
 # --- Model tiers and token limits from config ---
 PREMIUM_MODELS = config.premium_models
 MINI_MODELS = config.mini_models
 TOKEN_LIMITS = config.token_limits
 TOKEN_USAGE_FILE = os.path.join(os.path.dirname(__file__), config.token_usage_file)
+TOKEN_USAGE_FLUSH_INTERVAL = config.token_usage_flush_interval
+FALLBACK_MODEL = config.fallback_model
+
+# --- Conversation store ---
+CONVERSATION_DB_FILE = (
+    os.path.join(os.path.dirname(__file__), config.conversation_db_file)
+    if config.conversation_db_file else None
+)
+CONVERSATION_CACHE_SIZE = config.conversation_cache_size
+CONVERSATION_CACHE_TTL = config.conversation_cache_ttl
+
+# --- Sharding (supervisor + nhiều worker process) ---
+SHARD_COUNT = config.shard_count
+SHARD_WORKERS = max(1, min(config.shard_workers, SHARD_COUNT)) if SHARD_COUNT else 1
+# Chỉ số worker do supervisor truyền vào, None khi chạy một process
+SHARD_WORKER = current_worker() if SHARD_COUNT else None
+SHARD_IDS = shard_ids_for(SHARD_WORKER, SHARD_COUNT, SHARD_WORKERS) if SHARD_WORKER is not None else None
+# Token usage dùng chung qua bảng token_usage trong database hội thoại
+TOKEN_USAGE_SYNC_INTERVAL = config.token_usage_sync_interval
+
+# --- Sync slash command (chỉ khi command tree đổi) ---
+COMMAND_SYNC_FILE = os.path.join(os.path.dirname(__file__), config.command_sync_file)
+# Guild dùng khi phát triển: sync vào guild này (có hiệu lực ngay) thay cho global
+DEV_GUILD = discord.Object(id=config.dev_guild_id) if config.dev_guild_id else None
+# Bật bởi --force-sync
+FORCE_COMMAND_SYNC = False
+
+# --- Tắt êm (drain) và khởi động lại không gián đoạn ---
+# Thời gian tối đa (giây) chờ các lượt hỏi đang chạy khi nhận SIGTERM
+DRAIN_TIMEOUT = config.drain_timeout
+# File chứa PID của process đã sẵn sàng (restart_moon.sh chờ file này)
+READY_FILE = os.path.join(os.path.dirname(__file__), config.ready_file)
+# Worker ghi file ready riêng, supervisor ghi READY_FILE khi mọi worker đã sẵn sàng
+WORKER_READY_FILE = f"{READY_FILE}.{SHARD_WORKER}" if SHARD_WORKER is not None else READY_FILE
+# PID của process cũ cần tiếp quản (--takeover)
+TAKEOVER_PID = None
+
+# --- Nén ngữ cảnh hội thoại ---
+COMPACTION_THRESHOLD = config.compaction_threshold
+COMPACTION_MODEL = config.compaction_model
+COMPACTION_MAX_TOKENS = config.compaction_max_tokens
+COMPACTION_INSTRUCTIONS = (
+    "Bạn tóm tắt cuộc trò chuyện để chuyển sang một phiên mới. Giữ lại các sự kiện, "
+    "quyết định, thông tin về người dùng (kèm mention <@id>), câu hỏi còn dang dở và "
+    "ngôn ngữ/giọng điệu đang dùng. Viết ngắn gọn dạng gạch đầu dòng, không chào hỏi."
+)
+
+# --- Per-channel queue ---
+CHANNEL_COALESCE_WINDOW = config.channel_coalesce_ms / 1000
+CHANNEL_COALESCE_MAX = config.channel_coalesce_max
+
+# --- Admission control cho các lượt gọi OpenAI ---
+OPENAI_MAX_CONCURRENCY = config.openai_max_concurrency
+ADMISSION_QUEUE_SIZE = config.admission_queue_size
+
+# --- Retry và hedging cho Responses API ---
+OPENAI_RETRY_POLICY = RetryPolicy(
+    max_attempts=config.openai_retry_max_attempts,
+    base_delay=config.openai_retry_base_delay,
+    max_delay=config.openai_retry_max_delay,
+    deadline=config.openai_request_deadline,
+)
+OPENAI_HEDGE_REQUESTS = config.openai_hedge_requests
+OPENAI_HEDGE_MAX_RATIO = config.openai_hedge_max_ratio
+
+# --- Cache câu trả lời cho lượt hỏi đầu tiên ---
+RESPONSE_CACHE_ENABLED = config.response_cache_enabled
+RESPONSE_CACHE_TTL = config.response_cache_ttl
+RESPONSE_CACHE_MAX_ENTRIES = config.response_cache_max_entries
+INSTRUCTIONS_HASH = hashlib.sha256((INSTRUCTIONS or "").encode("utf-8")).hexdigest()[:16]
+
+# --- File đính kèm ---
+ATTACHMENT_UPLOAD = config.attachment_upload
+ATTACHMENT_MAX_BYTES = config.attachment_max_bytes
+ATTACHMENT_CACHE_SIZE = config.attachment_cache_size
+ATTACHMENT_WORKERS = config.attachment_workers
+IMAGE_MAX_EDGE = config.image_max_edge
+IMAGE_JPEG_QUALITY = config.image_jpeg_quality
+PDF_EXTRACT_TEXT = config.pdf_extract_text
+PDF_MAX_PAGES = config.pdf_max_pages
+PDF_MAX_CHARS = config.pdf_max_chars
+PDF_MIN_CHARS_PER_PAGE = config.pdf_min_chars_per_page
+
+# --- Metrics endpoint (Prometheus) ---
+METRICS_HOST = config.metrics_host
+# Mỗi worker mở một cổng riêng: METRICS_PORT + chỉ số worker
+METRICS_PORT = config.metrics_port + (SHARD_WORKER or 0) if config.metrics_port else 0
+
+# --- Tracing (JSONL) ---
+# Mỗi worker ghi một file riêng (RotatingFileHandler không dùng chung được giữa các process)
+TRACE_FILE = config.trace_file
+if TRACE_FILE and SHARD_WORKER is not None:
+    trace_root, trace_ext = os.path.splitext(TRACE_FILE)
+    TRACE_FILE = f"{trace_root}.{SHARD_WORKER}{trace_ext}"
+TRACE_SAMPLE_RATE = config.trace_sample_rate
+TRACE_MAX_BYTES = config.trace_max_bytes
+TRACE_BACKUP_COUNT = config.trace_backup_count
+
+# --- Ghi cassette để phát lại offline (benchmarks/replay.py) ---
+CASSETTE_DIR = config.cassette_dir
 
 # --- Setup logging ---
 logging.basicConfig(
@@ -37,8 +181,12 @@ logging.basicConfig(
 )
 logging.info("Starting Moon Discord Bot...")
 
-# --- Initialize channel chat IDs dictionary ---
-CHANNEL_CHAT_IDS: dict[str, str | None] = {}
+# --- Conversation state theo kênh (cache LRU/TTL + SQLite) ---
+conversation_store = ConversationStore(
+    SQLiteConversationBackend(CONVERSATION_DB_FILE) if CONVERSATION_DB_FILE else MemoryConversationBackend(),
+    max_entries=CONVERSATION_CACHE_SIZE,
+    ttl=CONVERSATION_CACHE_TTL,
+)
 
 # --- Random messages for new chat ---
 NEW_CHAT_MESSAGES = [
@@ -67,129 +215,275 @@ SUPPORT_MESSAGES = [
     "{user}, có câu hỏi hay chủ đề nào bạn muốn thảo luận không? 🌸",
 ]
 
+# --- Random backpressure messages ---
+RATE_LIMIT_MESSAGES = {
+    "user_rate": "⏳ {user} hỏi hơi nhanh rồi, đợi khoảng {seconds} giây rồi hỏi tiếp Moon nhé!",
+    "guild_rate": "⏳ Server đang gửi quá nhiều câu hỏi, {user} thử lại sau khoảng {seconds} giây nhé!",
+    "queue_full": "🌙 Moon đang bận trả lời quá nhiều câu hỏi, {user} thử lại sau ít phút nhé!",
+}
+
+# --- Trạng thái nhận việc (standby/running/draining) ---
+lifecycle = Lifecycle()
+shutdown_task: asyncio.Task | None = None
+takeover_task: asyncio.Task | None = None
+
+# --- Admission controller (giới hạn đồng thời, tốc độ và hàng đợi ưu tiên) ---
+admission = AdmissionController(
+    max_concurrent=OPENAI_MAX_CONCURRENCY,
+    max_queue=ADMISSION_QUEUE_SIZE,
+    user_rate_per_minute=config.user_rate_per_minute,
+    user_burst=config.user_burst,
+    guild_rate_per_minute=config.guild_rate_per_minute,
+    guild_burst=config.guild_burst,
+)
+
+# --- Token usage ledger (giữ trong bộ nhớ, ghi file ở nền; dùng chung qua SQLite khi sharding) ---
+token_ledger = (
+    SQLiteTokenUsageLedger(CONVERSATION_DB_FILE, flush_interval=TOKEN_USAGE_SYNC_INTERVAL)
+    if SHARD_COUNT and CONVERSATION_DB_FILE
+    else TokenUsageLedger(TOKEN_USAGE_FILE, flush_interval=TOKEN_USAGE_FLUSH_INTERVAL)
+)
+
+# --- Chọn model theo ngân sách (giữ chỗ token trước khi gọi) ---
+budget_router = BudgetRouter(
+    token_ledger,
+    limits=TOKEN_LIMITS,
+    premium_models=PREMIUM_MODELS,
+    mini_models=MINI_MODELS,
+    fallback_model=FALLBACK_MODEL,
+    instructions=INSTRUCTIONS,
+)
+
+# --- Response cache (chỉ dùng cho lượt hỏi chưa có chuỗi hội thoại) ---
+response_cache = TTLCache(
+    "responses",
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    default_ttl=RESPONSE_CACHE_TTL,
+) if RESPONSE_CACHE_ENABLED else None
+
 # --- Initialize OpenAI client ---
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
-
-# --- Function calling system ---
-class FunctionRegistry:
-    """Registry để quản lý các function có thể gọi từ OpenAI"""
-    
-    def __init__(self):
-        self.functions: Dict[str, Callable] = {}
-        self.function_schemas: List[Dict[str, Any]] = []
-    
-    def register(self, name: str = None, description: str = "", parameters: Dict[str, Any] = None):
-        """Decorator để đăng ký function"""
-        def decorator(func: Callable):
-            func_name = name or func.__name__
-            
-            # Tạo schema cho OpenAI API với format mới
-            schema = {
-                "type": "function",
-                "name": func_name,
-                "description": description or func.__doc__ or f"Function {func_name}",
-                "parameters": parameters or {
-                    "type": "object",
-                    "properties": {},
-                    "additionalProperties": False
-                },
-                "strict": True
-            }
-            
-            if not parameters:
-                # Tự động tạo parameters từ function signature
-                sig = inspect.signature(func)
-                props = {}
-                required = []
-                
-                for param_name, param in sig.parameters.items():
-                    if param_name == 'self':
-                        continue
-                        
-                    param_type = "string"  # default
-                    if param.annotation != inspect.Parameter.empty:
-                        if param.annotation == int:
-                            param_type = "integer"
-                        elif param.annotation == float:
-                            param_type = "number"
-                        elif param.annotation == bool:
-                            param_type = "boolean"
-                        elif param.annotation == list:
-                            param_type = "array"
-                        elif param.annotation == dict:
-                            param_type = "object"
-                    
-                    props[param_name] = {"type": param_type}
-                    
-                    # Trong strict mode, tất cả properties đều phải có trong required
-                    required.append(param_name)
-                
-                if props:
-                    schema["parameters"] = {
-                        "type": "object",
-                        "properties": props,
-                        "required": required,
-                        "additionalProperties": False
-                    }
-            
-            self.functions[func_name] = func
-            self.function_schemas.append(schema)
-            return func
-        return decorator
-    
-    async def call_function(self, name: str, arguments: Dict[str, Any]) -> str:
-        """Gọi function và trả về kết quả"""
-        if name not in self.functions:
-            return f"Function '{name}' not found"
-        
-        try:
-            func = self.functions[name]
-            logging.info(f"Calling function {name} with arguments: {arguments}")
-            
-            if inspect.iscoroutinefunction(func):
-                result = await func(**arguments)
-            else:
-                result = func(**arguments)
-            
-            logging.info(f"Function {name} returned: {result}")
-            return str(result)
-        except Exception as e:
-            logging.error(f"Error calling function {name}: {e}")
-            logging.error(f"Arguments were: {arguments}")
-            return f"Error executing {name}: {str(e)}"
-    
-    def get_schemas(self) -> List[Dict[str, Any]]:
-        """Lấy danh sách schemas cho OpenAI"""
-        return self.function_schemas
+# SDK không tự retry, việc thử lại do with_retry đảm nhận (tránh retry chồng retry)
+cassette_recorder = CassetteRecorder(
+    CASSETTE_DIR, [OPENAI_API_KEY, DISCORD_TOKEN, config.openweathermap_api_key]
+) if CASSETTE_DIR else None
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=OPENAI_BASE_URL,
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(transport=cassette_recorder.transport()) if cassette_recorder else None,
+)
+hedger = Hedger(max_ratio=OPENAI_HEDGE_MAX_RATIO) if OPENAI_HEDGE_REQUESTS else None
+
+# --- Attachment pipeline (tải, thu nhỏ và upload file đính kèm một lần) ---
+attachment_pipeline = AttachmentPipeline(
+    openai_client,
+    max_bytes=ATTACHMENT_MAX_BYTES,
+    image_max_edge=IMAGE_MAX_EDGE,
+    image_quality=IMAGE_JPEG_QUALITY,
+    cache_size=ATTACHMENT_CACHE_SIZE,
+    workers=ATTACHMENT_WORKERS,
+    pdf_extract_text=PDF_EXTRACT_TEXT,
+    pdf_max_pages=PDF_MAX_PAGES,
+    pdf_max_chars=PDF_MAX_CHARS,
+    pdf_min_chars_per_page=PDF_MIN_CHARS_PER_PAGE,
+) if ATTACHMENT_UPLOAD else None
+
+# --- Metrics endpoint ---
+metrics_server = MetricsServer(REGISTRY, METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+# --- Tracing ---
+TRACER.configure(
+    SpanWriter(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT) if TRACE_FILE else None,
+    TRACE_SAMPLE_RATE,
+)
 
 # Khởi tạo registry
 function_registry = FunctionRegistry()
+runtime_context = RuntimeContext(
+    config,
+    pool_limit=HTTP_POOL_LIMIT,
+    pool_limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+    timeout=HTTP_TIMEOUT,
+    # Span cho các request HTTP của function (get_weather...)
+    trace_configs=[
+        trace_config
+        for trace_config in (
+            TRACER.aiohttp_trace_config() if TRACER.enabled else None,
+            cassette_recorder.aiohttp_trace_config() if cassette_recorder else None,
+        )
+        if trace_config
+    ],
+)
+if cassette_recorder:
+    runtime_context.on_cache_hit = cassette_recorder.cache_hit
 
 # Import và đăng ký tất cả functions
 try:
-    from functions import register_all_functions
-    register_all_functions(function_registry)
+    function_registry = load_functions(FUNCTIONS_MODULE)
     logging.info(f"Đã tải {len(function_registry.get_schemas())} functions")
 except ImportError:
     logging.warning("Không tìm thấy functions.py")
 except Exception as e:
     logging.error(f"Lỗi khi tải functions: {e}")
 
+def reload_functions() -> tuple[FunctionRegistry, FunctionRegistry]:
+    """Nạp lại functions.py vào registry mới rồi thay registry đang dùng
+
+    Trả về (registry cũ, registry mới). Lượt hỏi đang chạy giữ registry cũ tới khi
+    xong; nạp lại lỗi thì ném exception và registry hiện tại được giữ nguyên.
+    """
+    global function_registry
+    registry = load_functions(FUNCTIONS_MODULE, reload=True)
+    registry.context = runtime_context
+    old, function_registry = function_registry, registry
+    logging.info(
+        f"Đã nạp lại {len(registry.get_schemas())} functions "
+        f"(schema {old.schema_version} -> {registry.schema_version})"
+    )
+    return old, registry
+
+def reload_functions_on_change():
+    try:
+        reload_functions()
+    except Exception as e:
+        logging.error(f"Nạp lại functions thất bại, giữ bản đang chạy: {e}")
+
+functions_watcher = ModuleWatcher(
+    os.path.join(os.path.dirname(__file__), f"{FUNCTIONS_MODULE}.py"),
+    reload_functions_on_change,
+    interval=FUNCTIONS_RELOAD_INTERVAL,
+) if FUNCTIONS_RELOAD_INTERVAL > 0 else None
+
 # --- Helper function to mention user ---
 def mention_user(user: discord.abc.User) -> str:
     return user.mention if hasattr(user, "mention") else f"<@{user.id}>"
 
+# --- Helper function to build response cache key ---
+MENTION_PREFIX = re.compile(r"^\s*<@!?\d+>\s*:?\s*", re.MULTILINE)
+USER_MENTION = re.compile(r"<@!?(\d+)>")
+
+def response_cache_key(
+    model: str,
+    prompt: str,
+    schema_version: str,
+    attachment_hashes: tuple[str, ...] = (),
+) -> tuple:
+    # Bỏ mention người hỏi và chuẩn hóa khoảng trắng/hoa thường để câu hỏi giống nhau dùng chung cache
+    text = " ".join(MENTION_PREFIX.sub("", prompt).casefold().split())
+    return (model, INSTRUCTIONS_HASH, text, attachment_hashes, schema_version)
+
+def cached_answer_key(prompt: str, attachments: list[Attachment], registry: FunctionRegistry) -> tuple | None:
+    """Key cache cho lượt hỏi đầu tiên của chuỗi (None nếu lượt này không dùng được cache)
+
+    File đính kèm chỉ được tính vào key khi đã có hash nội dung.
+    """
+    if response_cache is None or not all(attachment.sha256 for attachment in attachments or ()):
+        return None
+    return response_cache_key(
+        OPENAI_MODEL,
+        prompt,
+        registry.schema_version,
+        tuple(attachment.sha256 for attachment in attachments or ()),
+    )
+
+def is_user_specific(answer: str, prompt: str) -> bool:
+    """Câu trả lời nhắc tới người hỏi (mention hoặc ID) thì không dùng chung cho người khác"""
+    if USER_MENTION.search(answer):
+        return True
+    return any(user_id in answer for user_id in USER_MENTION.findall(prompt))
+
+# --- Helper function to build backpressure message ---
+def backpressure_message(error: AdmissionRejected, user: discord.abc.User) -> str:
+    return RATE_LIMIT_MESSAGES[error.reason].format(
+        user=mention_user(user), seconds=max(1, round(error.retry_after))
+    )
+
+# --- Khởi động / dừng các dịch vụ nền (dùng chung cho bot và benchmark) ---
+async def start_services():
+    token_ledger.start()
+    TRACER.start()
+    await runtime_context.start()
+    if attachment_pipeline:
+        attachment_pipeline.start(runtime_context.session)
+    if GAZETTEER_FILE:
+        try:
+            runtime_context.gazetteer = await asyncio.to_thread(Gazetteer.load, GAZETTEER_FILE)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Không tải được gazetteer, dùng geocoding API: {e}")
+    function_registry.context = runtime_context
+    if functions_watcher:
+        functions_watcher.start()
+    if metrics_server:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logging.error(f"Không mở được metrics endpoint: {e}")
+
+async def stop_services():
+    if functions_watcher:
+        await functions_watcher.close()
+    if metrics_server:
+        await metrics_server.close()
+    if attachment_pipeline:
+        await attachment_pipeline.close()
+    await runtime_context.close()
+    await token_ledger.close()
+    await compactor.close()
+    await conversation_store.close()
+    if cassette_recorder:
+        await cassette_recorder.close()
+    TRACER.close()
+
+# --- Command tree bỏ qua interaction khi bot chưa/không còn nhận việc ---
+class MoonCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # Lúc standby/draining, process còn lại (cũ hoặc mới) sẽ trả lời các interaction sau đó
+        return lifecycle.accepting
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if isinstance(error, app_commands.CheckFailure) and not lifecycle.accepting:
+            return
+        await super().on_error(interaction, error)
+
 # --- Custom Bot with setup_hook for slash commands ---
-class MoonBot(commands.Bot):
+# Worker của supervisor là AutoShardedBot chỉ giữ các shard được giao
+class MoonBot(commands.AutoShardedBot if SHARD_IDS is not None else commands.Bot):
     async def setup_hook(self):
         await self.add_cog(ChatCommand(self))
-        await self.tree.sync()
+        # Command tree là global nên chỉ một worker cần sync
+        if not SHARD_WORKER:
+            await self.sync_command_tree()
         self.tree_synced = True
+        await start_services()
+
+    async def sync_command_tree(self):
+        if DEV_GUILD:
+            self.tree.copy_global_to(guild=DEV_GUILD)
+        try:
+            await sync_commands(
+                self.tree,
+                CommandSyncState(COMMAND_SYNC_FILE),
+                self.application_id,
+                guild=DEV_GUILD,
+                force=FORCE_COMMAND_SYNC,
+            )
+        except discord.HTTPException as e:
+            # Bot vẫn chạy với command đã sync trước đó, lần khởi động sau sẽ thử lại
+            logging.error(f"Không sync được command tree: {e}")
+
+    async def close(self):
+        await super().close()
+        await stop_services()
 
 # --- Initialize bot with intents ---
 intents = discord.Intents.default()
 intents.message_content = True
-bot = MoonBot(command_prefix="!", intents=intents)
+bot = MoonBot(
+    command_prefix="!",
+    intents=intents,
+    tree_cls=MoonCommandTree,
+    **({"shard_ids": SHARD_IDS, "shard_count": SHARD_COUNT} if SHARD_IDS is not None else {}),
+)
 
 # --- Slash command for chat ---
 class ChatCommand(commands.Cog):
@@ -208,12 +502,29 @@ class ChatCommand(commands.Cog):
         attachment: discord.Attachment = None
     ):
         channel_id = str(interaction.channel_id)
-        chat_id = CHANNEL_CHAT_IDS.get(channel_id)
-        await interaction.response.defer(thinking=True)
+        try:
+            admission.check_rate(str(interaction.user.id), str(interaction.guild_id) if interaction.guild_id else None)
+        except AdmissionRejected as e:
+            await interaction.response.send_message(backpressure_message(e, interaction.user), ephemeral=True)
+            return
+        with TRACER.trace("chat", channel_id=channel_id, user_id=str(interaction.user.id)), lifecycle.track():
+            await self._chat(interaction, channel_id, question, attachment)
+
+    async def _chat(
+        self,
+        interaction: discord.Interaction,
+        channel_id: str,
+        question: str,
+        attachment: discord.Attachment | None
+    ):
+        defer_started = time.perf_counter()
+        with TRACER.span("discord.defer"):
+            await interaction.response.defer(thinking=True)
+        INTERACTION_DEFER_SECONDS.observe(time.perf_counter() - defer_started)
         prompt = f"<@{interaction.user.id}>: {question.strip()}"
         
-        image_urls = None
-        pdf_urls = None
+        image_urls = []
+        pdf_urls = []
         
         if attachment:
             if (attachment.content_type and attachment.content_type.startswith("image/")) or \
@@ -223,24 +534,41 @@ class ChatCommand(commands.Cog):
                  attachment.filename.lower().endswith(".pdf"):
                 pdf_urls = [attachment.url]
         
-        answer, new_chat_id = await ask_openai(
-            prompt, 
-            chat_id=chat_id,
-            images=image_urls,
-            pdfs=pdf_urls
-        )
-        CHANNEL_CHAT_IDS[channel_id] = new_chat_id
+        reply = StreamingReply(
+            send=lambda content: interaction.followup.send(content, wait=True),
+            edit_interval=STREAM_EDIT_INTERVAL
+        ) if STREAM_RESPONSES else None
+        
+        try:
+            # /chat đã defer (còn 15 phút) nên nhường chỗ cho mention
+            answer = await channel_dispatcher.submit(
+                channel_id,
+                Turn(
+                    prompt=prompt,
+                    images=image_urls,
+                    pdfs=pdf_urls,
+                    on_delta=reply.feed if reply else None,
+                    priority=PRIORITY_COMMAND,
+                    trace=current_span()
+                )
+            )
+        except AdmissionRejected as e:
+            await interaction.followup.send(backpressure_message(e, interaction.user))
+            return
         
         # Đảm bảo không gửi tin nhắn rỗng
         if not answer or not answer.strip():
             answer = "Xin lỗi, Moon gặp sự cố khi xử lý câu hỏi. Hãy thử lại nhé! 🌙"
         
-        await interaction.followup.send(f"{answer}")
+        if reply:
+            await reply.finish(answer)
+        else:
+            await timed_send("send", interaction.followup.send(f"{answer}"))
 
     @app_commands.command(name="new_chat", description="🆕 Bắt đầu chủ đề mới với Moon")
     async def new_chat(self, interaction: discord.Interaction):
         channel_id = str(interaction.channel_id)
-        CHANNEL_CHAT_IDS[channel_id] = None
+        await conversation_store.reset(channel_id)
         message = random.choice(NEW_CHAT_MESSAGES).format(
             user=mention_user(interaction.user)
         )
@@ -316,6 +644,17 @@ class ChatCommand(commands.Cog):
             
             functions_text += "\n"
         
+        # Thống kê cache của các function (số lần tiết kiệm được request ra upstream)
+        cache_stats = runtime_context.cache_stats()
+        if cache_stats:
+            functions_text += "**📊 Cache:**\n"
+            for cache_name, stats in cache_stats.items():
+                functions_text += (
+                    f"  • {cache_name}: {stats['hits']} hit / {stats['misses']} miss"
+                    f" / {stats['shared']} dùng chung ({stats['entries']} mục)\n"
+                )
+            functions_text += "\n"
+        
         functions_text += (
             "**💡 Cách sử dụng:**\n"
             "- Moon sẽ **tự động** sử dụng function phù hợp khi cần\n"
@@ -326,57 +665,200 @@ class ChatCommand(commands.Cog):
         
         await interaction.response.send_message(functions_text, ephemeral=True)
 
+    @app_commands.command(name="reload_functions", description="🔄 Nạp lại functions (chỉ admin)")
+    @app_commands.default_permissions(administrator=True)
+    async def reload_functions(self, interaction: discord.Interaction):
+        permissions = getattr(interaction.user, "guild_permissions", None)
+        if not (permissions and permissions.administrator) and not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message("⛔ Chỉ admin mới dùng được lệnh này.", ephemeral=True)
+            return
+        started = time.perf_counter()
+        try:
+            old, registry = reload_functions()
+        except Exception as e:
+            logging.error(f"Nạp lại functions thất bại, giữ bản đang chạy: {e}")
+            await interaction.response.send_message(
+                f"❌ Nạp lại functions thất bại, Moon vẫn dùng bản đang chạy:\n```{e}```", ephemeral=True
+            )
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        names = ", ".join(schema["name"] for schema in registry.get_schemas())
+        await interaction.response.send_message(
+            f"✅ Đã nạp lại {len(registry.get_schemas())} functions trong {elapsed:.1f}ms: {names}\n"
+            f"Schema: `{old.schema_version}` → `{registry.schema_version}`",
+            ephemeral=True
+        )
+
+# --- Loại lượt gọi Responses API (nhãn cho metrics và hedging) ---
+def response_call_kind(params: dict) -> str:
+    if params.get("store") is False:
+        return "summary"
+    inputs = params.get("input") or [{}]
+    return "tool" if inputs[0].get("type") == "function_call_output" else "first"
+
+# --- Gọi Responses API, ghi độ trễ và lỗi vào metrics ---
+async def create_response(
+    on_delta: Callable[[str], None] = None,
+    on_abandoned: Callable[[Any], None] = None,
+    **params,
+):
+    kind = response_call_kind(params)
+    started = time.perf_counter()
+    try:
+        with TRACER.span("openai.responses", call=kind, model=params["model"]) as span:
+            response = await _create_response(on_delta, on_abandoned, kind, **params)
+            usage = getattr(response, "usage", None)
+            span.set(
+                response_id=getattr(response, "id", None),
+                input_tokens=getattr(usage, "input_tokens", None),
+                output_tokens=getattr(usage, "output_tokens", None),
+            )
+            return response
+    except Exception as e:
+        ERRORS_TOTAL.inc("openai", type(e).__name__)
+        raise
+    finally:
+        OPENAI_REQUEST_SECONDS.observe(time.perf_counter() - started, kind, params["model"])
+
+# --- Gọi Responses API, dùng event stream nếu có callback nhận delta ---
+async def _create_response(
+    on_delta: Callable[[str], None],
+    on_abandoned: Callable[[Any], None],
+    kind: str,
+    **params,
+):
+    if on_delta is None:
+        async def attempt(timeout: float):
+            call = lambda: openai_client.responses.create(timeout=timeout, **params)
+            if hedger is None:
+                return await call()
+            # Lượt gửi kết quả function có độ trễ khác lượt hỏi đầu, tính p95 riêng
+            return await hedger.run(f"{params['model']}:{kind}", call, on_abandoned)
+        return await with_retry(attempt, OPENAI_RETRY_POLICY)
+
+    # Chỉ thử lại khi chưa có text nào được gửi tới người dùng
+    emitted = False
+
+    async def stream_attempt(timeout: float):
+        nonlocal emitted
+        stream = await openai_client.responses.create(stream=True, timeout=timeout, **params)
+        final_response = None
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                emitted = True
+                on_delta(event.delta)
+            elif event.type in ("response.completed", "response.incomplete"):
+                # Response đầy đủ (output, function_call, usage) nằm trong event cuối
+                final_response = event.response
+            elif event.type == "response.failed":
+                error = getattr(event.response, "error", None)
+                raise RuntimeError(getattr(error, "message", None) or "Response failed")
+            elif event.type == "error":
+                raise RuntimeError(event.message)
+        if final_response is None:
+            raise RuntimeError("Stream kết thúc mà không có response hoàn chỉnh")
+        return final_response
+
+    return await with_retry(stream_attempt, OPENAI_RETRY_POLICY, can_retry=lambda: not emitted)
+
 # --- Function to send prompt to OpenAI and return the response ---
 async def ask_openai(
     prompt: str,
     chat_id: str = None,
-    images: list[str] = None,
-    pdfs: list[str] = None,
+    attachments: list[Attachment] = None,
     force_model: str = None,
-) -> tuple[str, str]:
-    usage = load_token_usage()
-    model = force_model or OPENAI_MODEL
-
-    # Xác định tier của model và kiểm tra giới hạn
-    model_tier = None
-    if model in PREMIUM_MODELS:
-        model_tier = "premium"
-    elif model in MINI_MODELS:
-        model_tier = "mini"
-
-    # Nếu model premium hết hạn, chuyển sang gpt-5-mini
-    if model_tier == "premium" and usage.get("premium", 0) >= TOKEN_LIMITS["premium"]:
-        logging.warning(f"Premium model limit reached. Falling back to gpt-5-mini.")
-        model = "gpt-5-mini"
-        model_tier = "mini"
-
-    tools = []
-    
-    function_tools = function_registry.get_schemas()
-    if function_tools:
-        tools.extend(function_tools)
-    if images or pdfs:
+    on_delta: Callable[[str], None] = None,
+    context_tokens: int = 0,
+    summary: str = None,
+    cache_key: tuple = None,
+) -> tuple[str, str, int]:
+    """Trả về (câu trả lời, response_id mới, số token ngữ cảnh của chuỗi hội thoại)
+
+    `cache_key` (từ cached_answer_key) cho phép lưu câu trả lời vào response cache.
+    """
+    routing = budget_router.snapshot() if cassette_recorder else None
+    # Ước tính chi phí và giữ chỗ ngân sách trước khi gọi, chọn model mini nếu premium không đủ
+    route = budget_router.route(
+        force_model or OPENAI_MODEL,
+        budget_router.estimate(prompt, attachments, context_tokens, len(function_registry.schemas_json)),
+    )
+    with TRACER.span("ask_openai", model=route.model, tier=route.tier, estimated_tokens=route.reserved) as span:
+        try:
+            if cassette_recorder is None:
+                return await _ask_openai(route, prompt, chat_id, attachments, on_delta, context_tokens, summary, cache_key)
+            call = {
+                "prompt": prompt,
+                "chat_id": chat_id,
+                "attachments": [asdict(attachment) for attachment in attachments or ()],
+                "force_model": force_model,
+                "model": force_model or OPENAI_MODEL,
+                "stream": on_delta is not None,
+                "context_tokens": context_tokens,
+                "summary": summary,
+                # get_weather bỏ qua geocoding khi có gazetteer, phát lại phải giống lúc ghi
+                "gazetteer": runtime_context.gazetteer is not None,
+            }
+            started = time.perf_counter()
+            with cassette_recorder.record(call, routing) as cassette:
+                result = await _ask_openai(route, prompt, chat_id, attachments, on_delta, context_tokens, summary, cache_key)
+            cassette_recorder.save(cassette, {
+                "answer": result[0],
+                "chat_id": result[1],
+                "context_tokens": result[2],
+                "model": route.model,
+                "tokens": route.used,
+                "elapsed": round(time.perf_counter() - started, 4),
+            })
+            return result
+        finally:
+            span.set(used_tokens=route.used)
+            budget_router.settle(route)
+
+async def _ask_openai(
+    route: Route,
+    prompt: str,
+    chat_id: str,
+    attachments: list[Attachment],
+    on_delta: Callable[[str], None],
+    context_tokens: int,
+    summary: str | None,
+    cache_key: tuple | None = None,
+) -> tuple[str, str, int]:
+    model = route.model
+    # Giữ registry của lượt này: nạp lại functions giữa chừng không đổi tool giữa các vòng
+    registry = function_registry
+
+    # Payload tools được registry dựng sẵn một lần, dùng lại cho mọi request
+    tools = registry.tools_payload()
+    if attachments:
         input_blocks = [
             {"role": "user", "content": []},
         ]
-        logging.info(f"Preparing input blocks for OpenAI with images: {images}, pdfs: {pdfs}")
+        logging.info(f"Preparing input blocks for OpenAI with attachments: {attachments}")
         input_blocks[0]["content"].append({"type": "input_text", "text": prompt})
-        if images:
-            for img_url in images:
-                input_blocks[0]["content"].append(
-                    {"type": "input_image", "image_url": img_url}
-                )
-        if pdfs:
-            for pdf_url in pdfs:
-                input_blocks[0]["content"].append(
-                    {"type": "input_file", "file_url": pdf_url}
-                )
+        for attachment in attachments:
+            input_blocks[0]["content"].append(attachment.input_block())
     else:
         input_blocks = [
             {"role": "user", "content": [{"type": "input_text", "text": prompt}]}   
         ]
+    if summary:
+        # Chuỗi cũ đã được nén: bản tóm tắt mở đầu chuỗi mới
+        input_blocks.insert(0, {
+            "role": "developer",
+            "content": [{"type": "input_text", "text": f"Tóm tắt cuộc trò chuyện trước đó trong kênh:\n{summary}"}]
+        })
+
+    def record_usage(resp):
+        budget_router.record(route, resp)
+
+    def record_abandoned(resp):
+        budget_router.record_abandoned(route, resp)
+
     try:
-        response = await openai_client.responses.create(
+        response = await create_response(
+            on_delta,
+            record_abandoned,
             model=model,
             instructions=INSTRUCTIONS,
             previous_response_id=chat_id,
@@ -384,213 +866,365 @@ async def ask_openai(
             tools=tools if tools else None,
             tool_choice="auto"
         )
-    
-        output_text = getattr(response, 'output_text', "").strip()
-        resp_usage = getattr(response, "usage", None)
-        if resp_usage:
-            used = getattr(resp_usage, "total_tokens", None)
-            if used and model_tier:
-                usage[model_tier] = usage.get(model_tier, 0) + used
-                save_token_usage(usage)
-                logging.info(
-                    f"Used {used} tokens for model {model} (tier: {model_tier}). Total tier usage: {usage[model_tier]} tokens."
-                )
-        
+
+        record_usage(response)
         function_results = []
-        function_calls_found = False
-        
-        if hasattr(response, 'output') and response.output:
-            for output_item in response.output:
-                if hasattr(output_item, 'type') and output_item.type == "function_call":
-                    func_name = getattr(output_item, 'name', None)
-                    func_args_str = getattr(output_item, 'arguments', '{}')
-                    call_id = getattr(output_item, 'call_id', None)
-                    
-                    if func_name:
-                        function_calls_found = True
-                        try:
-                            func_args = json.loads(func_args_str) if func_args_str else {}
-                        except json.JSONDecodeError as e:
-                            func_args = {}
-
-                        result = await function_registry.call_function(func_name, func_args)
-                        function_results.append({
-                            "call_id": call_id,
-                            "name": func_name,
-                            "result": result
-                        })
-        
-        # Nếu có function calls, gửi kết quả lên OpenAI để có response tự nhiên
-        if function_calls_found and function_results:
-            try:
-                tool_call = None
+        tool_rounds = 0
 
-                for output in response.output:
-                    if output.type == "reasoning":
-                        input_blocks.append(output)
-                    else:
-                        tool_call = output if hasattr(output, 'type') and output.type == "function_call" else None
+        # Chạy tool cho tới khi model không gọi function nữa hoặc hết số vòng cho phép
+        while True:
+            function_calls = [
+                item for item in (getattr(response, "output", None) or [])
+                if getattr(item, "type", None) == "function_call"
+            ]
+            if not function_calls:
+                break
+            if tool_rounds >= TOOL_MAX_ROUNDS:
+                logging.warning(f"Reached max tool rounds ({TOOL_MAX_ROUNDS}), stopping tool loop.")
+                break
+            tool_rounds += 1
 
-                if not tool_call:
-                    logging.warning("No function call found in response output.")
-                    original_response = str(output_text).strip() if output_text else ""
-                    func_display = "\n".join(
-                        [f"**{r['name']}**: {r['result']}" for r in function_results]
-                    )
-                    final_response = f"{original_response}\n\n{func_display}" if original_response else func_display
-                    return final_response, chat_id
-
-                input_blocks.append({
-                    "type": "function_call",
-                    "call_id": tool_call.call_id,
-                    "name": tool_call.name,
-                    "arguments": tool_call.arguments,
-                    "id": tool_call.id,
-                    "status": tool_call.status
-                })
-
-                input_blocks.append({
-                    "type": "function_call_output",
-                    "call_id": tool_call.call_id,
-                    "output": str(result)
-                })
-
-                follow_up_response = await openai_client.responses.create(
+            results = await registry.call_functions(function_calls, max_parallel=TOOL_MAX_PARALLEL)
+            function_results.extend(results)
+
+            # previous_response_id giữ sẵn reasoning và function_call của response trước,
+            # chỉ cần gửi kết quả của từng call_id
+            try:
+                response = await create_response(
+                    on_delta,
+                    record_abandoned,
                     model=model,
                     instructions=INSTRUCTIONS,
-                    input=input_blocks,
-                    previous_response_id=chat_id,
+                    previous_response_id=response.id,
+                    input=[
+                        {"type": "function_call_output", "call_id": r["call_id"], "output": r["result"]}
+                        for r in results
+                    ],
                     tools=tools if tools else None,
                     tool_choice="auto",
-                    reasoning={"effort": "minimal"} if OPENAI_MODEL.startswith("gpt-5") else None
+                    reasoning={"effort": "minimal"} if model.startswith("gpt-5") else None
                 )
-
-                final_response = getattr(follow_up_response, 'output_text', "").strip()
-                new_chat_id = getattr(follow_up_response, "id", chat_id)
-                resp_usage = getattr(follow_up_response, "usage", None)
-                if resp_usage:
-                    used = getattr(resp_usage, "total_tokens", None)
-                    if used and model_tier:
-                        usage[model_tier] = usage.get(model_tier, 0) + used
-                        save_token_usage(usage)
-                        logging.info(
-                            f"Used {used} tokens for model {model} (tier: {model_tier}). Total tier usage: {usage[model_tier]} tokens."
-                        )
-                
             except Exception as e:
                 logging.error(f"Error getting follow-up response from OpenAI: {e}")
-                original_response = str(output_text).strip() if output_text else ""
-                func_display = "\n".join(
-                    [f"**{r['name']}**: {r['result']}" for r in function_results]
-                )
-                final_response = f"{original_response}\n\n{func_display}" if original_response else func_display
-                new_chat_id = getattr(response, "id", chat_id)
+                response = None
+                break
+            record_usage(response)
 
-        else:
-            final_response = str(output_text).strip() if output_text else ""
+        output_text = getattr(response, "output_text", "").strip() if response else ""
+        if response is not None and not function_calls:
+            final_response = output_text
             new_chat_id = getattr(response, "id", chat_id)
-        
-        # Kiểm tra lại giới hạn sau khi gọi và thử lại với model mini nếu cần
-        if model_tier == "premium" and usage.get("premium", 0) > TOKEN_LIMITS["premium"]:
-            logging.warning(f"Premium model limit reached after call. Retrying with gpt-5-mini.")
-            return await ask_openai(
-                prompt, chat_id, images, force_model="gpt-5-mini"
+            usage = getattr(response, "usage", None)
+            if usage:
+                # Ngữ cảnh của lượt sau = input + output của response cuối
+                context_tokens = (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+        else:
+            # Không có câu trả lời hoàn chỉnh: hiển thị kết quả function và giữ nguyên chuỗi hội thoại cũ
+            func_display = "\n".join(
+                [f"**{r['name']}**: {r['result']}" for r in function_results]
             )
+            final_response = f"{output_text}\n\n{func_display}" if output_text else func_display
+            new_chat_id = chat_id
+        
+        # Chỉ cache câu trả lời hoàn chỉnh, không dùng function phụ thuộc thời điểm và không nhắc tới người hỏi
+        # Key phải khớp model đã dùng (không phải model dự phòng) và registry của lượt này
+        if (
+            cache_key is not None
+            and cache_key[0] == model
+            and cache_key[-1] == registry.schema_version
+            and response is not None
+            and not function_calls
+            and final_response
+            and not any(r["name"] in registry.time_sensitive for r in function_results)
+            and not is_user_specific(final_response, prompt)
+        ):
+            response_cache.set(cache_key, final_response)
         
-        return final_response, new_chat_id
+        return final_response, new_chat_id, context_tokens
     except Exception as e:
         logging.error(f"OpenAI API error: {e}")
-        return f"Xin lỗi, mình gặp lỗi khi kết nối tới OpenAI: {e}", chat_id
+        return f"Xin lỗi, mình gặp lỗi khi kết nối tới OpenAI: {e}", chat_id, context_tokens
 
-# --- Token usage tracking ---
-def load_token_usage():
-    """Tải thông tin sử dụng token từ file JSON, reset nếu sang ngày mới hoặc file không hợp lệ."""
-    today = datetime.now().strftime("%Y-%m-%d")
-    default_usage = {"date": today, "premium": 0, "mini": 0}
+# --- Xử lý các lượt hỏi của một kênh (được gọi tuần tự bởi ChannelDispatcher) ---
+async def run_channel_turns(channel_id: str, turns: list[Turn]) -> str:
+    # Worker của kênh chạy ngoài context của handler, nối lại trace của lượt đầu tiên
+    with TRACER.resume(turns[0].trace, "channel_turn", channel_id=channel_id, batch=len(turns)) as span:
+        if len(turns) > 1:
+            span.set(coalesced_traces=[turn.trace.trace_id for turn in turns[1:] if turn.trace])
+        return await _run_channel_turns(channel_id, turns)
 
-    if not os.path.exists(TOKEN_USAGE_FILE):
-        with open(TOKEN_USAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(default_usage, f)
-        return default_usage
+async def _run_channel_turns(channel_id: str, turns: list[Turn]) -> str:
+    prompt = "\n".join(turn.prompt for turn in turns)
+    images = [url for turn in turns for url in turn.images]
+    pdfs = [url for turn in turns for url in turn.pdfs]
+
+    # Tải và upload file đính kèm trước khi giữ chỗ gọi OpenAI
+    if attachment_pipeline and (images or pdfs):
+        with TRACER.span("attachments", images=len(images), pdfs=len(pdfs)):
+            attachments = await attachment_pipeline.prepare_all(images, pdfs)
+    else:
+        attachments = [Attachment(IMAGE, url) for url in images] + [Attachment(PDF, url) for url in pdfs]
 
+    state = await conversation_store.get(channel_id)
+    summary = state.summary if state.response_id is None else None
+
+    # Lượt hỏi đầu tiên lặp lại (FAQ) được trả lời từ cache ngay, không chờ admission và không giữ ngân sách
+    cache_key = None
+    if state.response_id is None and summary is None:
+        cache_key = cached_answer_key(prompt, attachments, function_registry)
+        answer = response_cache.get(cache_key, None) if cache_key is not None else None
+        if answer is not None:
+            logging.info(f"Response cache hit for model {OPENAI_MODEL}")
+            span = current_span()
+            if span:
+                span.set(cache_hit=True)
+            # Không có response_id của OpenAI để nối tiếp: ghi câu hỏi/trả lời làm tóm tắt mở đầu chuỗi mới
+            seed = f"Người dùng hỏi:\n{prompt}\n\nMoon đã trả lời:\n{answer}"
+            await conversation_store.compact(channel_id, None, seed, len(seed) // CHARS_PER_TOKEN)
+            return answer
+
+    waiting = TRACER.start_span("admission.wait")
     try:
-        with open(TOKEN_USAGE_FILE, "r", encoding="utf-8") as f:
-            usage = json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        usage = default_usage
-
-    if usage.get("date") != today or "premium" not in usage or "mini" not in usage:
-        usage = default_usage
-        with open(TOKEN_USAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(usage, f)
-            
-    return usage
+        async with admission.slot(min(turn.priority for turn in turns)):
+            TRACER.end_span(waiting)
+            waiting = None
+            answer, new_chat_id, context_tokens = await ask_openai(
+                prompt,
+                chat_id=state.response_id,
+                attachments=attachments or None,
+                on_delta=turns[0].on_delta,
+                context_tokens=state.context_tokens,
+                summary=summary,
+                cache_key=cache_key,
+            )
+    except BaseException as e:
+        # Bị từ chối (AdmissionRejected) hoặc bị hủy lúc đang chờ: span chờ vẫn phải được ghi
+        TRACER.end_span(waiting, error=type(e).__name__)
+        raise
+    new_state = await conversation_store.update(channel_id, new_chat_id, context_tokens)
+    # Tóm tắt ở nền nếu ngữ cảnh đã quá dài, lượt sau không phải chờ
+    compactor.maybe_compact(channel_id, new_state)
+    return answer
+
+# --- Tóm tắt một chuỗi hội thoại bằng model rẻ (chạy ở nền) ---
+async def summarize_chain(response_id: str, context_tokens: int) -> str:
+    route = budget_router.route(COMPACTION_MODEL, context_tokens + COMPACTION_MAX_TOKENS)
+    try:
+        response = await create_response(
+            on_abandoned=lambda resp: budget_router.record_abandoned(route, resp),
+            model=route.model,
+            instructions=COMPACTION_INSTRUCTIONS,
+            previous_response_id=response_id,
+            input=[{
+                "role": "user",
+                "content": [{"type": "input_text", "text": "Tóm tắt toàn bộ cuộc trò chuyện ở trên."}]
+            }],
+            max_output_tokens=COMPACTION_MAX_TOKENS,
+            # Lượt tóm tắt không cần nằm trong lịch sử của OpenAI
+            store=False,
+            reasoning={"effort": "minimal"} if route.model.startswith("gpt-5") else None
+        )
+        budget_router.record(route, response)
+        return getattr(response, "output_text", "") or ""
+    finally:
+        budget_router.settle(route)
+
+compactor = ConversationCompactor(
+    conversation_store,
+    summarize_chain,
+    COMPACTION_THRESHOLD,
+    pending=lambda channel_id: channel_dispatcher.pending(channel_id),
+)
+
+# --- Metrics đọc lúc scrape (không tốn chi phí trên hot path) ---
+def cache_metrics() -> dict:
+    caches = list(runtime_context.caches.values())
+    if response_cache is not None:
+        caches.append(response_cache)
+    if attachment_pipeline:
+        caches.extend([attachment_pipeline.file_ids, attachment_pipeline.pdf_texts])
+    values = {}
+    for cache in caches:
+        stats = cache.stats()
+        for key, result in (("hits", "hit"), ("misses", "miss"), ("shared", "shared")):
+            values[(cache.name, result)] = stats[key]
+    return values
 
-def save_token_usage(usage):
-    with open(TOKEN_USAGE_FILE, "w", encoding="utf-8") as f:
-        json.dump(usage, f)
+CACHE_REQUESTS_TOTAL.set_function(cache_metrics)
+QUEUE_DEPTH.set_function(lambda: {
+    ("channel",): channel_dispatcher.queue_depth(),
+    ("admission",): admission.waiting,
+})
+
+channel_dispatcher = ChannelDispatcher(
+    run_channel_turns,
+    coalesce_window=CHANNEL_COALESCE_WINDOW,
+    max_batch=CHANNEL_COALESCE_MAX,
+)
+
+# --- Tiếp quản từ process cũ (--takeover) ---
+async def take_over(pid: int):
+    """Cho process cũ drain và chỉ nhận việc khi nó đã thoát
+
+    Hai process cùng nhận việc thì một sự kiện có thể được trả lời hai lần và
+    chuỗi previous_response_id của một kênh bị rẽ nhánh (mỗi process có cache
+    hội thoại riêng trên cùng file SQLite).
+    """
+    logging.info(f"Tiếp quản từ process cũ (pid {pid}), chờ process cũ drain xong")
+    if terminate(pid) and not await wait_exit(pid, DRAIN_TIMEOUT + 15):
+        logging.warning(f"Process cũ (pid {pid}) chưa thoát sau {DRAIN_TIMEOUT + 15:.0f}s, vẫn bắt đầu nhận việc")
+    lifecycle.activate()
 
 # --- Discord bot events ---
 @bot.event
 async def on_ready():
+    global TAKEOVER_PID, takeover_task
     logging.info(f"{bot.user} is online and ready to chat!")
     if STATUS:
         await bot.change_presence(activity=discord.Game(STATUS))
+    write_ready_file(WORKER_READY_FILE)
+    if TAKEOVER_PID:
+        # Đã kết nối xong: cho process cũ drain, nhận việc sau khi nó thoát
+        takeover_task = asyncio.create_task(take_over(TAKEOVER_PID))
+        TAKEOVER_PID = None
+    elif takeover_task is None or takeover_task.done():
+        lifecycle.activate()
 
 @bot.event
 async def on_message(message: discord.Message):
-    if message.author == bot.user:
+    if message.author == bot.user or not lifecycle.accepting:
         return
     if bot.user in message.mentions:
         channel_id = str(message.channel.id)
-        chat_id = CHANNEL_CHAT_IDS.get(channel_id)
-        async with message.channel.typing():
-            user_mention = mention_user(message.author)
-            prompt_content = (
-                message.content.replace(f"<@{bot.user.id}>", "")
-                .replace(f"<@!{bot.user.id}>", "")
-                .strip()
-            )
-            image_urls = [
-                att.url
-                for att in message.attachments
-                if (att.content_type and att.content_type.startswith("image/"))
-                or att.filename.lower().endswith(
-                    (".png", ".jpg", ".jpeg", ".webp", ".gif")
+        try:
+            admission.check_rate(str(message.author.id), str(message.guild.id) if message.guild else None)
+        except AdmissionRejected as e:
+            await message.reply(backpressure_message(e, message.author))
+            return
+        with TRACER.trace("mention", channel_id=channel_id, user_id=str(message.author.id)), lifecycle.track():
+            async with message.channel.typing():
+                user_mention = mention_user(message.author)
+                prompt_content = (
+                    message.content.replace(f"<@{bot.user.id}>", "")
+                    .replace(f"<@!{bot.user.id}>", "")
+                    .strip()
                 )
-            ]
-            pdf_urls = [
-                att.url
-                for att in message.attachments
-                if (att.content_type and att.content_type == "application/pdf")
-                or att.filename.lower().endswith(".pdf")
-            ]
-            if not prompt_content and not image_urls and not pdf_urls:
-                support_message = random.choice(SUPPORT_MESSAGES).format(
-                    user=user_mention
+                image_urls = [
+                    att.url
+                    for att in message.attachments
+                    if (att.content_type and att.content_type.startswith("image/"))
+                    or att.filename.lower().endswith(
+                        (".png", ".jpg", ".jpeg", ".webp", ".gif")
+                    )
+                ]
+                pdf_urls = [
+                    att.url
+                    for att in message.attachments
+                    if (att.content_type and att.content_type == "application/pdf")
+                    or att.filename.lower().endswith(".pdf")
+                ]
+                if not prompt_content and not image_urls and not pdf_urls:
+                    support_message = random.choice(SUPPORT_MESSAGES).format(
+                        user=user_mention
+                    )
+                    await message.reply(support_message)
+                    return
+                prompt = (
+                    f"<@{message.author.id}>: {prompt_content}"
+                    if prompt_content
+                    else f"<@{message.author.id}> gửi {'ảnh' if image_urls else 'file PDF'}:"
                 )
-                await message.reply(support_message)
-                return
-            prompt = (
-                f"<@{message.author.id}>: {prompt_content}"
-                if prompt_content
-                else f"<@{message.author.id}> gửi {'ảnh' if image_urls else 'file PDF'}:"
-            )
-            answer, new_chat_id = await ask_openai(
-                prompt, chat_id=chat_id, 
-                images=image_urls if image_urls else None,
-                pdfs=pdf_urls if pdf_urls else None
-            )
-            CHANNEL_CHAT_IDS[channel_id] = new_chat_id
-            await message.reply(f"{answer}")
+                reply = StreamingReply(
+                    send=message.reply,
+                    send_more=message.channel.send,
+                    edit_interval=STREAM_EDIT_INTERVAL
+                ) if STREAM_RESPONSES else None
+                turn = Turn(
+                    prompt=prompt,
+                    images=image_urls,
+                    pdfs=pdf_urls,
+                    coalesce=True,
+                    on_delta=reply.feed if reply else None,
+                    priority=PRIORITY_MENTION,
+                    trace=current_span()
+                )
+                try:
+                    answer = await channel_dispatcher.submit(channel_id, turn)
+                except AdmissionRejected as e:
+                    if turn.primary:
+                        await message.reply(backpressure_message(e, message.author))
+                    return
+                # Các mention được gộp chung chỉ cần một câu trả lời
+                if turn.primary:
+                    if reply:
+                        await reply.finish(answer)
+                    else:
+                        await timed_send("send", message.reply(f"{answer}"))
     await bot.process_commands(message)
 
+# --- Tắt êm: ngừng nhận việc, chờ lượt hỏi đang chạy rồi flush trạng thái ---
+async def shutdown():
+    if not lifecycle.begin_drain():
+        return
+    logging.info(
+        f"Đang dừng: ngừng nhận lượt hỏi mới, chờ {lifecycle.in_flight} lượt đang chạy"
+        f" (tối đa {DRAIN_TIMEOUT:.0f}s)"
+    )
+    started = time.monotonic()
+    if not await lifecycle.wait_idle(DRAIN_TIMEOUT):
+        logging.warning(f"Hết thời gian drain, bỏ {lifecycle.in_flight} lượt hỏi chưa xong")
+    # Bản tóm tắt đang tạo đã tốn token, cho nó xong nếu còn thời gian
+    await compactor.drain(DRAIN_TIMEOUT - (time.monotonic() - started))
+    clear_ready_file(WORKER_READY_FILE)
+    # close() dừng gateway rồi stop_services() flush token usage và hội thoại
+    await bot.close()
+
+def request_shutdown():
+    global shutdown_task
+    if shutdown_task is None:
+        shutdown_task = asyncio.ensure_future(shutdown())
+
 async def main():
+    loop = asyncio.get_running_loop()
+    # restart_moon.sh, process mới (--takeover) và supervisor đều dừng bot bằng SIGTERM
+    loop.add_signal_handler(signal.SIGTERM, request_shutdown)
+    if TAKEOVER_PID:
+        # Process cũ vẫn phục vụ cho tới khi process này kết nối xong
+        lifecycle.standby()
+    # Worker tự tắt nếu supervisor chết
+    parent_watch = asyncio.create_task(watch_parent(shutdown)) if SHARD_WORKER is not None else None
     try:
-        await bot.start(DISCORD_TOKEN)
+        async with bot:
+            await bot.start(DISCORD_TOKEN)
     except discord.errors.HTTPException as e:
         logging.error(e)
         logging.error("\n\n\nBLOCKED BY RATE LIMITS\n\n\n")
+    finally:
+        if parent_watch:
+            parent_watch.cancel()
+
+async def supervise():
+    await ShardSupervisor(
+        os.path.abspath(__file__),
+        SHARD_COUNT,
+        SHARD_WORKERS,
+        args=["--force-sync"] if FORCE_COMMAND_SYNC else [],
+        ready_file=READY_FILE,
+        takeover_pid=TAKEOVER_PID,
+        # Worker cần đủ thời gian drain trước khi bị kill
+        stop_timeout=DRAIN_TIMEOUT + 15,
+    ).run()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Moon Discord Bot")
+    parser.add_argument("--force-sync", action="store_true", help="sync slash command kể cả khi command tree không đổi")
+    parser.add_argument("--takeover", type=int, metavar="PID", help="tiếp quản từ process đang chạy: kết nối xong mới cho process cũ drain")
+    args = parser.parse_args()
+    FORCE_COMMAND_SYNC = args.force_sync
+    TAKEOVER_PID = args.takeover
+    if SHARD_COUNT and SHARD_WORKER is None:
+        if not CONVERSATION_DB_FILE:
+            raise SystemExit("SHARD_COUNT cần CONVERSATION_DB_FILE để các shard dùng chung trạng thái")
+        asyncio.run(supervise())
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3.10
+
+"""
+Metrics trong process cho Moon Discord Bot
+
+Counter, Gauge và Histogram đơn giản lưu trong bộ nhớ (ghi một metric chỉ
+tốn vài micro giây), xuất ra dạng text của Prometheus qua một HTTP endpoint
+cục bộ. Các giá trị đã có sẵn ở nơi khác (thống kê cache, độ dài hàng đợi)
+được đọc lúc scrape qua callback thay vì cập nhật trên hot path.
+"""
+
+import bisect
+import logging
+import math
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from aiohttp import web
+
+LabelValues = Tuple[str, ...]
+
+# Bucket mặc định (giây) cho độ trễ từ vài mili giây tới vài chục giây
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def snapshot(self) -> Dict[LabelValues, float]:
+        return dict(self._values)
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Giá trị tức thời, có thể đặt trực tiếp hoặc đọc từ callback lúc scrape"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._callback: Callable[[], Dict[LabelValues, float]] | None = None
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def set_function(self, callback: Callable[[], Dict[LabelValues, float]]):
+        """callback trả về {label values: giá trị}, được gọi mỗi lần scrape"""
+        self._callback = callback
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self._values)
+        if self._callback is not None:
+            try:
+                values.update(self._callback())
+            except Exception as e:
+                logging.error(f"Lỗi khi đọc metric {self.name}: {e}")
+        for labels, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class CallbackCounter(Gauge):
+    """Counter có giá trị nằm sẵn ở nơi khác (ví dụ thống kê hit/miss của cache)"""
+
+    type = "counter"
+
+
+class Histogram(_Metric):
+    """Histogram với bucket cố định, mỗi bộ label giữ mảng đếm riêng"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [đếm theo bucket (không cộng dồn)..., +Inf, tổng, số lần]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def count(self, *labels: str) -> int:
+        state = self._values.get(labels)
+        return state[-1] if state else 0
+
+    def samples(self) -> Iterable[str]:
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), state):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            label_text = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(state[-2])}"
+            yield f"{self.name}_count{label_text} {state[-1]}"
+
+
+class MetricsRegistry:
+    """Danh sách metric được xuất ra endpoint"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} đã được đăng ký")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def callback_counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> CallbackCounter:
+        return self.register(CallbackCounter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """HTTP endpoint /metrics (định dạng text của Prometheus)"""
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.registry.render(),
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+            charset="utf-8",
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logging.info(f"Metrics endpoint: http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+# --- Metric dùng chung trong bot ---
+REGISTRY = MetricsRegistry()
+
+INTERACTION_DEFER_SECONDS = REGISTRY.histogram(
+    "moon_interaction_defer_seconds",
+    "Thời gian defer một slash command",
+)
+OPENAI_REQUEST_SECONDS = REGISTRY.histogram(
+    "moon_openai_request_seconds",
+    "Độ trễ gọi Responses API (first: lượt hỏi, tool: lượt gửi kết quả function, summary: nén ngữ cảnh)",
+    ("call", "model"),
+)
+FUNCTION_SECONDS = REGISTRY.histogram(
+    "moon_function_seconds",
+    "Thời gian thực thi function do model gọi",
+    ("function", "status"),
+)
+DISCORD_SEND_SECONDS = REGISTRY.histogram(
+    "moon_discord_send_seconds",
+    "Độ trễ gửi/sửa tin nhắn Discord",
+    ("operation",),
+)
+TOKENS_TOTAL = REGISTRY.counter(
+    "moon_tokens_total",
+    "Số token đã dùng theo tier và model",
+    ("tier", "model"),
+)
+ERRORS_TOTAL = REGISTRY.counter(
+    "moon_errors_total",
+    "Số lỗi theo nơi xảy ra và loại lỗi",
+    ("source", "type"),
+)
+CACHE_REQUESTS_TOTAL = REGISTRY.callback_counter(
+    "moon_cache_requests_total",
+    "Số lần tra cache theo kết quả (hit, miss, shared)",
+    ("cache", "result"),
+)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "moon_queue_depth",
+    "Số lượt hỏi đang chờ (channel: hàng đợi theo kênh, admission: chờ chỗ gọi OpenAI)",
+    ("queue",),
+)
@@ -0,0 +1,517 @@
+#!/usr/bin/env python3.10
+
+"""
+Function registry cho Moon Discord Bot
+
+Quản lý các function mà OpenAI có thể gọi (function calling) và thực thi
+các lượt gọi function của model. Module function (functions.py) có thể được
+nạp lại khi bot đang chạy: load_functions dựng và kiểm tra một registry mới,
+main.py chỉ thay con trỏ registry nên lượt hỏi đang chạy vẫn dùng bản cũ.
+"""
+
+import asyncio
+import copy
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import aiohttp
+
+from cache import TTLCache
+from metrics import ERRORS_TOTAL, FUNCTION_SECONDS
+from schema_validator import ArgumentValidationError, compile_validator
+from tracing import TRACER
+
+
+class UpstreamError(Exception):
+    """Lỗi từ dịch vụ bên ngoài, được tính vào circuit breaker của function"""
+
+
+class FunctionSchemaError(ValueError):
+    """Schema của function không hợp lệ (OpenAI sẽ từ chối request)"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+# Tên function hợp lệ theo Responses API
+_FUNCTION_NAME = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+
+
+class CircuitBreaker:
+    """Ngắt gọi function sau nhiều lỗi liên tiếp, thử lại một lần sau thời gian chờ"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            # Chỉ cho một request thử nghiệm đi qua
+            self._probing = True
+            return True
+        return False
+
+    def is_probe(self) -> bool:
+        """allow() vừa trả True lúc half-open thì lượt gọi đó là lượt thử nghiệm"""
+        return self._probing and self.state == "half_open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release_probe(self):
+        """Kết thúc lượt thử nghiệm không có kết quả (bị hủy, context chưa sẵn sàng...)"""
+        self._probing = False
+
+    def record_failure(self, probe: bool = False):
+        """Ghi một lỗi; chỉ lượt thử nghiệm (`probe`) mới trả lại quyền thử nghiệm
+
+        Lượt gọi bắt đầu từ trước khi breaker mở có thể kết thúc lúc half-open,
+        kết quả của nó không được làm mất cờ thử nghiệm của lượt đang chạy.
+        """
+        self.failures += 1
+        if probe or self.failures >= self.failure_threshold:
+            if self.opened_at is None or probe:
+                logging.warning(f"Circuit breaker của {self.name} mở sau {self.failures} lỗi liên tiếp")
+            self.opened_at = time.monotonic()
+        if probe:
+            self._probing = False
+
+
+class RuntimeContext:
+    """Tài nguyên dùng chung cho các function: HTTP session và snapshot cấu hình
+
+    Được tạo một lần trong MoonBot.setup_hook và đóng khi bot tắt. Function nào
+    khai báo tham số `ctx` sẽ được registry truyền context này vào.
+    """
+
+    def __init__(
+        self,
+        settings: Any,
+        pool_limit: int = 100,
+        pool_limit_per_host: int = 10,
+        timeout: float = 15.0,
+        trace_configs: List[aiohttp.TraceConfig] | None = None,
+    ):
+        self.settings = settings
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.timeout = timeout
+        self.trace_configs = trace_configs or []
+        self.session: aiohttp.ClientSession | None = None
+        self.caches: Dict[str, TTLCache] = {}
+        # Gazetteer offline cho get_weather (nạp một lần lúc khởi động)
+        self.gazetteer = None
+        # Gắn vào mọi cache của function (ghi cassette cần biết lượt nào được trả từ cache)
+        self.on_cache_hit: Callable[[str, Any, Any], None] | None = None
+
+    def cache(self, name: str, **kwargs) -> TTLCache:
+        """Lấy cache theo tên, tạo mới ở lần gọi đầu tiên (sống cùng context)"""
+        cache = self.caches.get(name)
+        if cache is None:
+            cache = TTLCache(name, **kwargs)
+            cache.on_hit = self.on_cache_hit
+            self.caches[name] = cache
+        return cache
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    async def start(self):
+        """Tạo HTTP session có connection pool, keep-alive và DNS cache"""
+        if self.session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            trace_configs=self.trace_configs or None,
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class FunctionRegistry:
+    """Registry để quản lý các function có thể gọi từ OpenAI"""
+    
+    def __init__(self):
+        self.functions: Dict[str, Callable] = {}
+        self.function_schemas: List[Dict[str, Any]] = []
+        # Các function cần được truyền RuntimeContext qua tham số `ctx`
+        self.context_functions: set[str] = set()
+        self.context: RuntimeContext | None = None
+        # Giới hạn thực thi theo từng function
+        self.timeouts: Dict[str, float] = {}
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        # Function trả kết quả phụ thuộc thời điểm gọi (câu trả lời không được cache)
+        self.time_sensitive: set[str] = set()
+        # Validator biên dịch sẵn từ schema của từng function
+        self.validators: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+        # Payload `tools`, JSON và phiên bản của schemas: dựng lại mỗi lần đăng ký, dùng chung cho mọi request
+        self._tools_payload: Tuple[Dict[str, Any], ...] = ()
+        self._schemas_json = b"[]"
+        self._schema_version = hashlib.sha256(self._schemas_json).hexdigest()[:16]
+    
+    def register(
+        self,
+        name: str = None,
+        description: str = "",
+        parameters: Dict[str, Any] = None,
+        timeout: float = None,
+        max_concurrency: int = None,
+        breaker_threshold: int = None,
+        breaker_cooldown: float = 30.0,
+        time_sensitive: bool = False,
+    ):
+        """Decorator để đăng ký function
+
+        timeout: thời gian tối đa (giây) cho mỗi lần gọi
+        max_concurrency: số lần gọi đồng thời tối đa
+        breaker_threshold: số lỗi liên tiếp trước khi ngắt function trong breaker_cooldown giây
+        time_sensitive: kết quả thay đổi theo thời gian, câu trả lời dùng function này không được cache
+        """
+        def decorator(func: Callable):
+            func_name = name or func.__name__
+            
+            # Tạo schema cho OpenAI API với format mới
+            schema = {
+                "type": "function",
+                "name": func_name,
+                "description": description or func.__doc__ or f"Function {func_name}",
+                "parameters": parameters or {
+                    "type": "object",
+                    "properties": {},
+                    "additionalProperties": False
+                },
+                "strict": True
+            }
+            
+            if not parameters:
+                # Tự động tạo parameters từ function signature
+                sig = inspect.signature(func)
+                props = {}
+                required = []
+                
+                for param_name, param in sig.parameters.items():
+                    if param_name in ('self', 'ctx'):
+                        continue
+                        
+                    param_type = "string"  # default
+                    if param.annotation != inspect.Parameter.empty:
+                        if param.annotation == int:
+                            param_type = "integer"
+                        elif param.annotation == float:
+                            param_type = "number"
+                        elif param.annotation == bool:
+                            param_type = "boolean"
+                        elif param.annotation == list:
+                            param_type = "array"
+                        elif param.annotation == dict:
+                            param_type = "object"
+                    
+                    props[param_name] = {"type": param_type}
+                    
+                    # Trong strict mode, tất cả properties đều phải có trong required
+                    required.append(param_name)
+                
+                if props:
+                    schema["parameters"] = {
+                        "type": "object",
+                        "properties": props,
+                        "required": required,
+                        "additionalProperties": False
+                    }
+            
+            self.validators[func_name] = compile_validator(schema["parameters"])
+            self.functions[func_name] = func
+            self.function_schemas.append(schema)
+            self._freeze_schemas()
+            if "ctx" in inspect.signature(func).parameters:
+                self.context_functions.add(func_name)
+            if timeout:
+                self.timeouts[func_name] = timeout
+            if max_concurrency:
+                self.semaphores[func_name] = asyncio.Semaphore(max_concurrency)
+            if breaker_threshold:
+                self.breakers[func_name] = CircuitBreaker(func_name, breaker_threshold, breaker_cooldown)
+            if time_sensitive:
+                self.time_sensitive.add(func_name)
+            return func
+        return decorator
+    
+    async def call_function(self, name: str, arguments: Dict[str, Any]) -> str:
+        """Gọi function và trả về kết quả"""
+        started = time.perf_counter()
+        label = name if name in self.functions else "unknown"
+        with TRACER.span("function", function=label) as span:
+            status, result = await self._call_function(name, arguments)
+            span.set(status=status)
+        FUNCTION_SECONDS.observe(time.perf_counter() - started, label, status)
+        if status != "ok":
+            ERRORS_TOTAL.inc("function", status)
+        return result
+    
+    async def _call_function(self, name: str, arguments: Dict[str, Any]) -> tuple[str, str]:
+        """Thực thi function, trả về (trạng thái, kết quả) để ghi metrics"""
+        if name not in self.functions:
+            return "not_found", f"Function '{name}' not found"
+        
+        try:
+            arguments = self.validators[name](arguments)
+        except ArgumentValidationError as e:
+            # Trả lỗi cho model để nó sửa tham số ở vòng tool tiếp theo
+            logging.warning(f"Invalid arguments for function {name}: {e}")
+            return "invalid_arguments", json.dumps({
+                "status": "invalid_arguments",
+                "function": name,
+                "errors": e.errors
+            }, ensure_ascii=False)
+        
+        breaker = self.breakers.get(name)
+        probe = False
+        if breaker and not breaker.allow():
+            # Trả lời ngay cho model thay vì chờ một upstream đang chết
+            logging.warning(f"Function {name} is unavailable (circuit open)")
+            return "unavailable", json.dumps({
+                "status": "unavailable",
+                "function": name,
+                "retry_after_seconds": round(breaker.retry_after()),
+                "message": f"{name} tạm thời không khả dụng, hãy báo người dùng thử lại sau."
+            }, ensure_ascii=False)
+        if breaker:
+            probe = breaker.is_probe()
+        
+        try:
+            func = self.functions[name]
+            logging.info(f"Calling function {name} with arguments: {arguments}")
+            
+            kwargs = dict(arguments)
+            if name in self.context_functions:
+                if self.context is None:
+                    return "error", f"Error executing {name}: runtime context is not ready"
+                kwargs["ctx"] = self.context
+            
+            semaphore = self.semaphores.get(name)
+            # Thời gian chờ chỗ trong semaphore cũng tính vào timeout
+            result = await asyncio.wait_for(self._invoke(func, kwargs, semaphore), timeout=self.timeouts.get(name))
+            
+            if breaker:
+                breaker.record_success()
+            logging.info(f"Function {name} returned: {result}")
+            return "ok", str(result)
+        except asyncio.TimeoutError:
+            if breaker:
+                breaker.record_failure(probe)
+            logging.error(f"Function {name} timed out after {self.timeouts.get(name)}s")
+            return "timeout", json.dumps({
+                "status": "timeout",
+                "function": name,
+                "message": f"{name} phản hồi quá lâu, hãy báo người dùng thử lại sau."
+            }, ensure_ascii=False)
+        except UpstreamError as e:
+            if breaker:
+                breaker.record_failure(probe)
+            logging.error(f"Upstream error in function {name}: {e}")
+            return "upstream_error", str(e)
+        except Exception as e:
+            if breaker:
+                breaker.record_failure(probe)
+            logging.error(f"Error calling function {name}: {e}")
+            logging.error(f"Arguments were: {arguments}")
+            return "error", f"Error executing {name}: {str(e)}"
+        finally:
+            # Lượt thử nghiệm kết thúc mà không ghi nhận kết quả thì breaker vẫn phải thử lại được
+            if probe:
+                breaker.release_probe()
+    
+    @staticmethod
+    async def _invoke(func: Callable, kwargs: Dict[str, Any], semaphore: asyncio.Semaphore | None) -> Any:
+        # Function đồng bộ chạy trên thread riêng để timeout áp dụng được (và không chặn event loop)
+        call = (lambda: func(**kwargs)) if inspect.iscoroutinefunction(func) else (lambda: asyncio.to_thread(func, **kwargs))
+        if semaphore is None:
+            return await call()
+        async with semaphore:
+            return await call()
+    
+    async def call_functions(self, calls: List[Any], max_parallel: int = 4) -> List[Dict[str, Any]]:
+        """Chạy đồng thời tất cả function_call trong một response, giữ đúng call_id"""
+        semaphore = asyncio.Semaphore(max(1, max_parallel))
+
+        async def run(call) -> Dict[str, Any]:
+            arguments_str = getattr(call, "arguments", "") or ""
+            try:
+                arguments = json.loads(arguments_str) if arguments_str else {}
+            except json.JSONDecodeError as e:
+                result = json.dumps({
+                    "status": "invalid_arguments",
+                    "function": call.name,
+                    "errors": [f"arguments is not valid JSON: {e}"]
+                }, ensure_ascii=False)
+                return {"call_id": call.call_id, "name": call.name, "result": result}
+            async with semaphore:
+                result = await self.call_function(call.name, arguments)
+            return {"call_id": call.call_id, "name": call.name, "result": result}
+
+        # Một tool lỗi không được làm mất kết quả của các tool khác
+        results = await asyncio.gather(*(run(call) for call in calls), return_exceptions=True)
+        for index, (call, result) in enumerate(zip(calls, results)):
+            if isinstance(result, BaseException):
+                logging.error(f"Function {call.name} failed: {type(result).__name__}: {result}")
+                results[index] = {
+                    "call_id": call.call_id,
+                    "name": call.name,
+                    "result": json.dumps({
+                        "status": "error",
+                        "function": call.name,
+                        "message": f"{call.name} gặp lỗi ({type(result).__name__}), hãy báo người dùng thử lại sau."
+                    }, ensure_ascii=False),
+                }
+        return results
+    
+    def validate(self):
+        """Kiểm tra schema đã đăng ký, ném FunctionSchemaError nếu có lỗi"""
+        errors = []
+        seen = set()
+        for schema in self.function_schemas:
+            name = schema["name"]
+            if name in seen:
+                errors.append(f"{name}: đăng ký trùng tên")
+            seen.add(name)
+            if not _FUNCTION_NAME.match(name):
+                errors.append(f"{name}: tên không hợp lệ")
+            parameters = schema["parameters"]
+            if parameters.get("type") != "object":
+                errors.append(f"{name}: parameters phải có type object")
+                continue
+            # Strict mode: mọi property phải nằm trong required và không nhận property lạ
+            properties = set(parameters.get("properties", {}))
+            missing = properties - set(parameters.get("required", []))
+            if missing:
+                errors.append(f"{name}: thiếu trong required: {', '.join(sorted(missing))}")
+            if parameters.get("additionalProperties") is not False:
+                errors.append(f"{name}: additionalProperties phải là false")
+        if errors:
+            raise FunctionSchemaError(errors)
+
+    def get_schemas(self) -> List[Dict[str, Any]]:
+        """Lấy danh sách schemas cho OpenAI"""
+        return self.function_schemas
+    
+    def _freeze_schemas(self):
+        """Dựng payload `tools` (bản sao riêng trong tuple), JSON và phiên bản của schemas"""
+        self._tools_payload = tuple(copy.deepcopy(self.function_schemas))
+        self._schemas_json = json.dumps(
+            self.function_schemas, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        ).encode("utf-8")
+        self._schema_version = hashlib.sha256(self._schemas_json).hexdigest()[:16]
+    
+    def tools_payload(self) -> Tuple[Dict[str, Any], ...]:
+        """Payload `tools` gửi lên OpenAI, dùng chung cho mọi request (không được sửa)"""
+        return self._tools_payload
+    
+    @property
+    def schemas_json(self) -> bytes:
+        """Dạng JSON chuẩn hóa của tất cả schemas (dùng để so sánh/băm)"""
+        return self._schemas_json
+    
+    @property
+    def schema_version(self) -> str:
+        """Mã phiên bản của bộ tool hiện tại, đổi khi bất kỳ schema nào thay đổi"""
+        return self._schema_version
+
+
+def load_functions(module_name: str = "functions", reload: bool = False) -> FunctionRegistry:
+    """Import module function, đăng ký vào một registry mới và kiểm tra schema
+
+    Lỗi (import, đăng ký hoặc schema) được ném ra trước khi registry được dùng,
+    nên registry đang chạy không bị ảnh hưởng khi nạp lại thất bại.
+    """
+    module = importlib.import_module(module_name)
+    if reload:
+        module = importlib.reload(module)
+    registry = FunctionRegistry()
+    module.register_all_functions(registry)
+    registry.validate()
+    return registry
+
+
+class ModuleWatcher:
+    """Theo dõi mtime của file module, gọi `on_change` khi file thay đổi"""
+
+    def __init__(self, path: str, on_change: Callable[[], Any], interval: float = 2.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._mtime = self._stat()
+        self._task: asyncio.Task | None = None
+
+    def _stat(self) -> float | None:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self._stat()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                result = self.on_change()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logging.error(f"Lỗi khi xử lý thay đổi của {self.path}: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,17 +1,66 @@
 #!/bin/bash
 
+# Khởi động lại bot gần như không gián đoạn:
+# process mới kết nối Discord xong mới gửi SIGTERM cho process cũ (--takeover),
+# process cũ ngừng nhận lượt hỏi mới, trả lời nốt các lượt đang chạy rồi tự thoát.
+# Nếu process mới không sẵn sàng kịp, process cũ được giữ nguyên.
+
+READY_FILE=${READY_FILE:-moon_ready.txt}
+# Thời gian tối đa chờ process mới sẵn sàng (giây)
+READY_TIMEOUT=${READY_TIMEOUT:-180}
+# Thời gian tối đa chờ process cũ drain xong (nên lớn hơn DRAIN_TIMEOUT)
+STOP_TIMEOUT=${STOP_TIMEOUT:-90}
+
 # Kích hoạt môi trường ảo
 source .venv/bin/activate
 
 # Cài đặt các thư viện cần thiết
 pip install -r requirements.txt
 
-# Dừng tiến trình cũ nếu tồn tại
-if [ -f moon_pid.txt ]; then
-    kill -9 $(cat moon_pid.txt) 2>/dev/null
-    rm moon_pid.txt
+# Process cũ (nếu còn chạy)
+OLD_PID=""
+if [ -f moon_pid.txt ] && kill -0 "$(cat moon_pid.txt)" 2>/dev/null; then
+    OLD_PID=$(cat moon_pid.txt)
+fi
+
+# Chạy process mới và lưu PID (log ghi nối vì hai process cùng chạy trong lúc chuyển giao)
+if [ -n "$OLD_PID" ]; then
+    nohup python3 main.py --takeover "$OLD_PID" >> moon.log 2>&1 &
+else
+    nohup python3 main.py >> moon.log 2>&1 &
 fi
+NEW_PID=$!
+echo $NEW_PID > moon_pid.txt
 
-# Chạy lại bot và lưu PID
-nohup python3 main.py > moon.log 2>&1 &
-echo $! > moon_pid.txt
\ No newline at end of file
+# Chờ process mới ghi PID vào file ready
+for ((i = 0; i < READY_TIMEOUT; i++)); do
+    if [ "$(cat "$READY_FILE" 2>/dev/null)" = "$NEW_PID" ]; then
+        echo "Moon (pid $NEW_PID) đã sẵn sàng"
+        break
+    fi
+    if ! kill -0 $NEW_PID 2>/dev/null; then
+        echo "Process mới đã thoát, xem moon.log"
+        [ -n "$OLD_PID" ] && echo $OLD_PID > moon_pid.txt
+        exit 1
+    fi
+    sleep 1
+done
+
+if [ "$(cat "$READY_FILE" 2>/dev/null)" != "$NEW_PID" ]; then
+    echo "Process mới không sẵn sàng sau ${READY_TIMEOUT}s, dừng process mới và giữ process cũ"
+    kill -TERM $NEW_PID 2>/dev/null
+    [ -n "$OLD_PID" ] && echo $OLD_PID > moon_pid.txt
+    exit 1
+fi
+
+# Chờ process cũ drain xong; chỉ kill -9 khi quá hạn
+if [ -n "$OLD_PID" ]; then
+    for ((i = 0; i < STOP_TIMEOUT; i++)); do
+        kill -0 $OLD_PID 2>/dev/null || break
+        sleep 1
+    done
+    if kill -0 $OLD_PID 2>/dev/null; then
+        echo "Process cũ (pid $OLD_PID) không dừng sau ${STOP_TIMEOUT}s, kill -9"
+        kill -9 $OLD_PID
+    fi
+fi
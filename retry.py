@@ -0,0 +1,213 @@
+#!/usr/bin/env python3.10
+
+"""
+Retry và hedged request cho các lượt gọi Responses API của Moon Discord Bot
+
+Lỗi tạm thời (429, 5xx, mất kết nối, timeout) được thử lại với exponential
+backoff có jitter, tôn trọng Retry-After và không vượt quá deadline của
+request. Hedging (tùy chọn) gửi thêm một request khi request đầu chạy lâu hơn
+p95 độ trễ gần đây và lấy kết quả về trước; request thua bị hủy nhưng vẫn
+có thể đã bị tính token nên được báo lại để ghi vào ngân sách.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import openai
+
+T = TypeVar("T")
+
+# Mã HTTP được coi là lỗi tạm thời
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_attempts: int = 4
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+    # Tổng thời gian tối đa (giây) cho mọi lần thử của một request
+    deadline: float = 120.0
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: ngẫu nhiên trong [0, min(max_delay, base * 2^attempt)]"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+def _retry_after(error: openai.APIStatusError) -> float | None:
+    headers = getattr(error.response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            # Dạng HTTP-date hiếm gặp với OpenAI, để backoff tự tính
+            return None
+    return None
+
+
+def classify(error: BaseException) -> tuple[bool, float | None]:
+    """Trả về (có nên thử lại không, thời gian chờ server yêu cầu nếu có)"""
+    if isinstance(error, openai.APIConnectionError):
+        # Bao gồm cả APITimeoutError
+        return True, None
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code in RETRYABLE_STATUS or error.status_code >= 500:
+            return True, _retry_after(error)
+        return False, None
+    if isinstance(error, asyncio.TimeoutError):
+        return True, None
+    return False, None
+
+
+async def with_retry(
+    attempt: Callable[[float], Awaitable[T]],
+    policy: RetryPolicy,
+    can_retry: Callable[[], bool] = lambda: True,
+    label: str = "OpenAI request",
+) -> T:
+    """Gọi attempt(timeout) cho tới khi thành công, hết số lần thử hoặc hết deadline
+
+    can_retry cho phép người gọi chặn việc thử lại (ví dụ stream đã gửi text ra ngoài).
+    """
+    deadline = time.monotonic() + policy.deadline
+    for attempt_number in range(policy.max_attempts):
+        remaining = deadline - time.monotonic()
+        try:
+            return await attempt(remaining)
+        except Exception as e:
+            retryable, retry_after = classify(e)
+            if not retryable or not can_retry() or attempt_number + 1 >= policy.max_attempts:
+                raise
+            delay = retry_after if retry_after is not None else policy.backoff(attempt_number)
+            if time.monotonic() + delay >= deadline:
+                logging.warning(f"{label} failed and retry would exceed the deadline: {e}")
+                raise
+            logging.warning(
+                f"{label} failed (attempt {attempt_number + 1}/{policy.max_attempts}), "
+                f"retrying in {delay:.2f}s: {e}"
+            )
+            await asyncio.sleep(delay)
+    raise RuntimeError("unreachable")
+
+
+class LatencyTracker:
+    """Giữ các độ trễ gần nhất để tính percentile"""
+
+    def __init__(self, window: int = 200):
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Hedger:
+    """Gửi request dự phòng khi request đầu chậm hơn p95, giới hạn theo tỉ lệ
+
+    Chỉ dùng cho request không stream: stream đã gửi text cho người dùng thì
+    không thể đổi sang kết quả của request khác.
+    """
+
+    def __init__(self, quantile: float = 0.95, min_samples: int = 20, max_ratio: float = 0.1):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        # Số request dự phòng tối đa so với tổng số request (giới hạn chi phí)
+        self.max_ratio = max_ratio
+        self._latency: Dict[str, LatencyTracker] = {}
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.abandoned = 0
+
+    def threshold(self, key: str) -> float | None:
+        tracker = self._latency.get(key)
+        if tracker is None or len(tracker) < self.min_samples:
+            return None
+        return tracker.percentile(self.quantile)
+
+    def _record(self, key: str, seconds: float):
+        tracker = self._latency.get(key)
+        if tracker is None:
+            tracker = self._latency[key] = LatencyTracker()
+        tracker.record(seconds)
+
+    async def run(
+        self,
+        key: str,
+        call: Callable[[], Awaitable[T]],
+        on_abandoned: Optional[Callable[[T], None]] = None,
+    ) -> T:
+        """Chạy `call`, gửi thêm request dự phòng nếu chậm
+
+        `on_abandoned(result)` được gọi cho mỗi request bị hủy khi request kia
+        thắng, với kết quả của request thắng để ước tính chi phí đã mất.
+        """
+        self.requests += 1
+        started = time.monotonic()
+        threshold = self.threshold(key)
+        if threshold is None or self.hedged >= self.max_ratio * self.requests:
+            result = await call()
+            self._record(key, time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(call())
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+        if done:
+            self._record(key, time.monotonic() - started)
+            return primary.result()
+
+        self.hedged += 1
+        logging.info(f"Request {key} slower than p95 ({threshold:.2f}s), sending hedged request")
+        backup = asyncio.ensure_future(call())
+        pending = {primary, backup}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        # Ghi độ trễ người dùng thực sự chờ (luôn >= ngưỡng)
+                        self._record(key, time.monotonic() - started)
+                        result = task.result()
+                        # Request thua đã được server xử lý input, coi như tốn ngang request thắng
+                        for loser in pending:
+                            loser.cancel()
+                            self.abandoned += 1
+                            if on_abandoned is not None:
+                                on_abandoned(result)
+                        return result
+                if not pending:
+                    # Cả hai đều lỗi: trả lỗi của request đầu cho lớp retry
+                    raise primary.exception()
+        finally:
+            for task in (primary, backup):
+                if not task.done():
+                    task.cancel()
+        raise RuntimeError("unreachable")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3.10
+
+"""
+Biên dịch JSON schema của function thành validator cho Moon Discord Bot
+
+Mỗi schema được biên dịch một lần lúc đăng ký thành một closure kiểm tra và
+ép kiểu tham số (ví dụ "5" -> 5 cho integer), nên lỗi tham số được phát hiện
+trước khi gọi function thay vì nổ ra ở giữa function.
+"""
+
+from typing import Any, Callable, Dict, List
+
+Validator = Callable[[Any, str], Any]
+
+
+class ArgumentValidationError(ValueError):
+    """Tham số do model sinh ra không khớp với schema"""
+
+    def __init__(self, errors: List[str]):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def _fail(path: str, message: str):
+    raise ArgumentValidationError([f"{path or 'arguments'}: {message}"])
+
+
+def _coerce_string(value: Any, path: str) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    _fail(path, f"expected string, got {type(value).__name__}")
+
+
+def _coerce_integer(value: Any, path: str) -> int:
+    if isinstance(value, bool):
+        _fail(path, "expected integer, got boolean")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            pass
+    _fail(path, f"expected integer, got {value!r}")
+
+
+def _coerce_number(value: Any, path: str) -> float:
+    if isinstance(value, bool):
+        _fail(path, "expected number, got boolean")
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            pass
+    _fail(path, f"expected number, got {value!r}")
+
+
+def _coerce_boolean(value: Any, path: str) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        return value.strip().lower() == "true"
+    _fail(path, f"expected boolean, got {value!r}")
+
+
+def _coerce_null(value: Any, path: str) -> None:
+    if value is None:
+        return None
+    _fail(path, f"expected null, got {value!r}")
+
+
+_SCALARS: Dict[str, Validator] = {
+    "string": _coerce_string,
+    "integer": _coerce_integer,
+    "number": _coerce_number,
+    "boolean": _coerce_boolean,
+    "null": _coerce_null,
+}
+
+
+def _compile_object(schema: Dict[str, Any]) -> Validator:
+    properties = {
+        key: _compile(sub_schema) for key, sub_schema in schema.get("properties", {}).items()
+    }
+    required = tuple(schema.get("required", ()))
+    allow_extra = schema.get("additionalProperties", True) is not False
+
+    def validate(value: Any, path: str) -> Dict[str, Any]:
+        if not isinstance(value, dict):
+            _fail(path, f"expected object, got {type(value).__name__}")
+        errors = []
+        result = {}
+        for key in required:
+            if key not in value:
+                errors.append(f"{path + '.' if path else ''}{key}: is required")
+        for key, item in value.items():
+            item_path = f"{path}.{key}" if path else key
+            validator = properties.get(key)
+            if validator is None:
+                if allow_extra:
+                    result[key] = item
+                else:
+                    errors.append(f"{item_path}: unexpected property")
+                continue
+            try:
+                result[key] = validator(item, item_path)
+            except ArgumentValidationError as e:
+                errors.extend(e.errors)
+        if errors:
+            raise ArgumentValidationError(errors)
+        return result
+
+    return validate
+
+
+def _compile_array(schema: Dict[str, Any]) -> Validator:
+    item_validator = _compile(schema["items"]) if "items" in schema else None
+
+    def validate(value: Any, path: str) -> List[Any]:
+        if not isinstance(value, list):
+            _fail(path, f"expected array, got {type(value).__name__}")
+        if item_validator is None:
+            return value
+        return [item_validator(item, f"{path}[{i}]") for i, item in enumerate(value)]
+
+    return validate
+
+
+def _compile(schema: Dict[str, Any]) -> Validator:
+    schema_type = schema.get("type")
+    types = schema_type if isinstance(schema_type, list) else [schema_type] if schema_type else []
+
+    validators = []
+    for name in types:
+        if name == "object":
+            validators.append(_compile_object(schema))
+        elif name == "array":
+            validators.append(_compile_array(schema))
+        elif name in _SCALARS:
+            validators.append(_SCALARS[name])
+
+    enum = schema.get("enum")
+    allowed = frozenset(enum) if enum and all(isinstance(v, (str, int, float, bool)) for v in enum) else None
+
+    if not validators:
+        validate_type: Validator = lambda value, path: value
+    elif len(validators) == 1:
+        validate_type = validators[0]
+    else:
+        # Union type (ví dụ ["string", "null"]): lấy kiểu đầu tiên khớp
+        def validate_type(value: Any, path: str) -> Any:
+            errors = []
+            for validator in validators:
+                try:
+                    return validator(value, path)
+                except ArgumentValidationError as e:
+                    errors.extend(e.errors)
+            raise ArgumentValidationError(errors)
+
+    if allowed is None:
+        return validate_type
+
+    def validate_enum(value: Any, path: str) -> Any:
+        value = validate_type(value, path)
+        if value not in allowed:
+            _fail(path, f"must be one of {sorted(map(str, allowed))}")
+        return value
+
+    return validate_enum
+
+
+def compile_validator(parameters: Dict[str, Any]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """Biên dịch schema `parameters` của một function thành hàm validate(arguments)"""
+    if not parameters or not parameters.get("properties"):
+        # Function không nhận tham số: bỏ qua mọi tham số thừa
+        return lambda arguments: {}
+    validate = _compile_object({**parameters, "type": "object"})
+    return lambda arguments: validate(arguments, "")
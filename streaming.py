@@ -0,0 +1,122 @@
+#!/usr/bin/env python3.10
+
+"""
+Hiển thị câu trả lời dạng streaming trên Discord
+
+Gửi tin nhắn đầu tiên ngay khi có token và chỉnh sửa (edit) tin nhắn đó theo
+chu kỳ để không vượt quá giới hạn edit của Discord (khoảng 5 lần / 5 giây).
+"""
+
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, TypeVar
+
+import discord
+
+from metrics import DISCORD_SEND_SECONDS, ERRORS_TOTAL
+from tracing import TRACER
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+T = TypeVar("T")
+
+
+async def timed_send(operation: str, call: Awaitable[T]) -> T:
+    """Chờ một lần gửi/sửa tin nhắn Discord và ghi độ trễ vào metrics"""
+    started = time.perf_counter()
+    try:
+        with TRACER.span(f"discord.{operation}"):
+            return await call
+    except discord.HTTPException as e:
+        ERRORS_TOTAL.inc("discord", type(e).__name__)
+        raise
+    finally:
+        DISCORD_SEND_SECONDS.observe(time.perf_counter() - started, operation)
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> List[str]:
+    """Chia nội dung dài thành các đoạn vừa giới hạn của Discord, ưu tiên cắt ở dòng mới"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class StreamingReply:
+    """Tin nhắn Discord được cập nhật dần theo các delta từ OpenAI"""
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[discord.Message]],
+        send_more: Callable[[str], Awaitable[discord.Message]] | None = None,
+        edit_interval: float = 1.0,
+    ):
+        self._send = send
+        self._send_more = send_more or send
+        self.edit_interval = edit_interval
+        self.text = ""
+        self.message: discord.Message | None = None
+        self.first_token_at: float | None = None
+        self._started_at = time.monotonic()
+        self._rendered = ""
+        self._closed = False
+        self._pump_task: asyncio.Task | None = None
+
+    def feed(self, delta: str):
+        """Nhận một delta text (đồng bộ, không chặn vòng đọc stream)"""
+        if not delta or self._closed:
+            return
+        self.text += delta
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            self._pump_task = asyncio.create_task(self._pump())
+
+    def _preview(self) -> str:
+        if len(self.text) <= DISCORD_MESSAGE_LIMIT:
+            return self.text
+        return self.text[:DISCORD_MESSAGE_LIMIT - 1] + "…"
+
+    async def _pump(self):
+        try:
+            content = self._preview()
+            self.message = await timed_send("send", self._send(content))
+            self._rendered = content
+            logging.info(
+                f"Streaming: tin nhắn đầu tiên sau {self.first_token_at - self._started_at:.2f}s"
+            )
+            while not self._closed:
+                await asyncio.sleep(self.edit_interval)
+                content = self._preview()
+                if not self._closed and content != self._rendered:
+                    await timed_send("edit", self.message.edit(content=content))
+                    self._rendered = content
+        except asyncio.CancelledError:
+            pass
+        except discord.HTTPException as e:
+            logging.warning(f"Streaming: không cập nhật được tin nhắn: {e}")
+
+    async def finish(self, final_text: str):
+        """Hiển thị nội dung cuối cùng (có thể dài hơn một tin nhắn)"""
+        self._closed = True
+        if self._pump_task is not None:
+            if self.message is None:
+                # Tin nhắn đầu tiên đang được gửi, đợi nó xong để edit thay vì gửi trùng
+                await asyncio.wait({self._pump_task}, timeout=10)
+            self._pump_task.cancel()
+
+        chunks = split_message(final_text) or [final_text]
+        first, rest = chunks[0], chunks[1:]
+        if self.message is None:
+            self.message = await timed_send("send", self._send(first))
+        elif first != self._rendered:
+            await timed_send("edit", self.message.edit(content=first))
+        self._rendered = first
+        for chunk in rest:
+            await timed_send("send", self._send_more(chunk))
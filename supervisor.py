@@ -0,0 +1,185 @@
+#!/usr/bin/env python3.10
+
+"""
+Supervisor chạy nhiều process (sharding) cho Moon Discord Bot
+
+Supervisor chia `shard_count` shard của gateway cho `workers` process con, mỗi
+process là một AutoShardedBot chỉ giữ các shard của mình. Process con nào thoát
+sẽ được khởi động lại với thời gian chờ tăng dần. Trạng thái hội thoại và token
+usage nằm trong SQLite dùng chung nên các process không cần nói chuyện với nhau:
+một kênh luôn thuộc đúng một shard (theo guild, DM thuộc shard 0).
+Supervisor chỉ ghi file ready khi mọi worker đã kết nối xong (restart_moon.sh
+chờ file này).
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+from typing import Dict, List
+
+from lifecycle import clear_ready_file, read_ready_file, terminate, wait_exit, write_ready_file
+
+# Biến môi trường supervisor truyền cho process con
+WORKER_ENV = "MOON_SHARD_WORKER"
+# Discord chỉ cho IDENTIFY một shard mỗi 5 giây (max_concurrency = 1)
+IDENTIFY_INTERVAL = 5.0
+
+
+def shard_ids_for(worker: int, shard_count: int, workers: int) -> List[int]:
+    """Các shard mà process `worker` phụ trách"""
+    return list(range(worker, shard_count, workers))
+
+
+def current_worker() -> int | None:
+    """Chỉ số worker của process hiện tại (None nếu không chạy dưới supervisor)"""
+    value = os.environ.get(WORKER_ENV)
+    return int(value) if value is not None else None
+
+
+async def watch_parent(on_orphaned, interval: float = 2.0):
+    """Gọi `on_orphaned` khi supervisor chết (process con bị chuyển sang cha khác)"""
+    parent = os.getppid()
+    while True:
+        await asyncio.sleep(interval)
+        if os.getppid() != parent:
+            logging.warning("Supervisor đã dừng, worker tự tắt")
+            await on_orphaned()
+            return
+
+
+class ShardSupervisor:
+    """Chạy và khởi động lại các worker process"""
+
+    def __init__(
+        self,
+        script: str,
+        shard_count: int,
+        workers: int,
+        args: List[str] | None = None,
+        ready_file: str | None = None,
+        takeover_pid: int | None = None,
+        min_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        stable_after: float = 60.0,
+        stop_timeout: float = 30.0,
+    ):
+        self.script = script
+        self.shard_count = shard_count
+        self.workers = max(1, min(workers, shard_count))
+        # Tham số chỉ truyền cho lần chạy đầu của mỗi worker (ví dụ --force-sync)
+        self.args = args or []
+        # Worker `i` ghi `<ready_file>.i`; supervisor ghi ready_file khi mọi worker đã sẵn sàng
+        self.ready_file = ready_file
+        # Supervisor cũ cần dừng trước khi chạy worker (các shard không được chạy song song)
+        self.takeover_pid = takeover_pid
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        # Worker chạy lâu hơn ngưỡng này thì lần thoát sau bắt đầu lại từ min_backoff
+        self.stable_after = stable_after
+        self.stop_timeout = stop_timeout
+        self.restarts = 0
+        self._processes: Dict[int, asyncio.subprocess.Process] = {}
+        self._stopping = asyncio.Event()
+
+    async def _spawn(self, worker: int, args: List[str]) -> asyncio.subprocess.Process:
+        env = {**os.environ, WORKER_ENV: str(worker)}
+        process = await asyncio.create_subprocess_exec(sys.executable, self.script, *args, env=env)
+        self._processes[worker] = process
+        logging.info(
+            f"Worker {worker} (pid {process.pid}) chạy shard "
+            f"{shard_ids_for(worker, self.shard_count, self.workers)}/{self.shard_count}"
+        )
+        return process
+
+    async def _sleep(self, seconds: float) -> bool:
+        """Chờ `seconds` giây, trả về True nếu supervisor bị dừng trong lúc chờ"""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=seconds)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _run_worker(self, worker: int):
+        # Giãn thời điểm khởi động để các process không IDENTIFY cùng lúc
+        shards_before = sum(
+            len(shard_ids_for(w, self.shard_count, self.workers)) for w in range(worker)
+        )
+        if await self._sleep(shards_before * IDENTIFY_INTERVAL):
+            return
+        backoff = self.min_backoff
+        args = self.args
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            process = await self._spawn(worker, args)
+            args = []
+            if self._stopping.is_set():
+                process.terminate()
+            code = await process.wait()
+            if self._stopping.is_set():
+                return
+            if time.monotonic() - started >= self.stable_after:
+                backoff = self.min_backoff
+            self.restarts += 1
+            logging.warning(f"Worker {worker} thoát với mã {code}, khởi động lại sau {backoff:.1f}s")
+            if await self._sleep(backoff):
+                return
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stop(self):
+        """Dừng supervisor và gửi SIGTERM cho mọi worker"""
+        if self._stopping.is_set():
+            return
+        logging.info("Đang dừng các worker...")
+        self._stopping.set()
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+
+    async def _wait_stopped(self):
+        running = [p for p in self._processes.values() if p.returncode is None]
+        if not running:
+            return
+        _, pending = await asyncio.wait([asyncio.create_task(p.wait()) for p in running], timeout=self.stop_timeout)
+        if pending:
+            for process in running:
+                if process.returncode is None:
+                    logging.warning(f"Worker pid {process.pid} không dừng kịp, kill")
+                    process.kill()
+            await asyncio.wait(pending)
+
+    def _workers_ready(self) -> bool:
+        if len(self._processes) < self.workers:
+            return False
+        return all(
+            read_ready_file(f"{self.ready_file}.{worker}") == process.pid
+            for worker, process in self._processes.items()
+        )
+
+    async def _watch_ready(self):
+        while not self._workers_ready():
+            if await self._sleep(1.0):
+                return
+        logging.info("Mọi worker đã sẵn sàng")
+        write_ready_file(self.ready_file)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        if self.takeover_pid and terminate(self.takeover_pid):
+            # Worker cũ drain xong mới IDENTIFY lại các shard
+            logging.info(f"Chờ supervisor cũ (pid {self.takeover_pid}) dừng")
+            if not await wait_exit(self.takeover_pid, self.stop_timeout + 5):
+                logging.warning(f"Supervisor cũ (pid {self.takeover_pid}) chưa dừng, vẫn tiếp tục khởi động")
+        logging.info(f"Supervisor chạy {self.shard_count} shard trên {self.workers} process")
+        tasks = [asyncio.create_task(self._run_worker(worker)) for worker in range(self.workers)]
+        if self.ready_file:
+            tasks.append(asyncio.create_task(self._watch_ready()))
+        await self._stopping.wait()
+        await self._wait_stopped()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.ready_file:
+            clear_ready_file(self.ready_file)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3.10
+
+"""
+Sổ theo dõi token (token usage ledger) cho Moon Discord Bot
+
+Giữ bộ đếm token của từng tier trong bộ nhớ, tự reset khi sang ngày mới và
+ghi xuống file JSON ở nền (write-behind) để hot path không phải chạm tới ổ đĩa.
+Mỗi lần flush chỉ cộng phần token phát sinh kể từ lần trước (delta) vào số
+đọc lại từ file, nên process cũ và process mới lúc takeover không ghi đè token
+của nhau.
+Request đang chạy giữ chỗ (reserve) phần token ước tính trước khi gọi model và
+quyết toán (settle) bằng số token thực tế khi xong.
+
+Khi chạy nhiều process (sharding), SQLiteTokenUsageLedger cộng dồn phần token
+của từng process vào một database SQLite dùng chung để ngân sách ngày được tính
+chung cho mọi shard.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ một process ghi file
+    fcntl = None
+
+
+def _next_midnight(now: float) -> float:
+    """Trả về timestamp của 00:00 ngày hôm sau (giờ local)"""
+    today = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (today + timedelta(days=1)).timestamp()
+
+
+class TokenUsageLedger:
+    """Bộ đếm token trong bộ nhớ, flush định kỳ xuống file bằng ghi nguyên tử"""
+
+    def __init__(self, path: str, flush_interval: float = 30.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._date = ""
+        self._rollover_at = 0.0
+        self._usage: Dict[str, int] = {}
+        # Token đã giữ chỗ cho các request đang chạy (không reset khi sang ngày mới)
+        self._reserved: Dict[str, int] = {}
+        # Token đã cộng nhưng chưa ghi, theo (ngày, tier) để phần của ngày cũ vẫn được ghi sau khi reset
+        self._pending: Dict[tuple[str, str], int] = {}
+        self._dirty = False
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._load()
+
+    # --- Đọc file một lần lúc khởi động ---
+    def _load(self):
+        now = time.time()
+        self._reset(now)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            self._dirty = True
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            logging.warning(f"Không đọc được {self.path}, bắt đầu lại từ 0: {e}")
+            self._dirty = True
+            return
+
+        if isinstance(data, dict) and data.get("date") == self._date:
+            for tier, value in data.items():
+                if tier != "date" and isinstance(value, int):
+                    self._usage[tier] = value
+        else:
+            self._dirty = True
+
+    def _reset(self, now: float):
+        self._date = datetime.fromtimestamp(now).strftime("%Y-%m-%d")
+        self._rollover_at = _next_midnight(now)
+        self._usage = {"premium": 0, "mini": 0}
+        self._dirty = True
+
+    def _check_rollover(self):
+        now = time.time()
+        if now >= self._rollover_at:
+            logging.info(f"Sang ngày mới, reset token usage (ngày cũ: {self._date})")
+            self._reset(now)
+
+    # --- Hot path: chỉ thao tác trên bộ nhớ ---
+    def get(self, tier: str) -> int:
+        """Số token đã dùng trong ngày của một tier"""
+        self._check_rollover()
+        return self._usage.get(tier, 0)
+
+    def add(self, tier: str, tokens: int) -> int:
+        """Cộng token cho tier và trả về tổng mới"""
+        self._check_rollover()
+        total = self._usage.get(tier, 0) + tokens
+        self._usage[tier] = total
+        key = (self._date, tier)
+        self._pending[key] = self._pending.get(key, 0) + tokens
+        self._dirty = True
+        return total
+
+    def reserved(self, tier: str) -> int:
+        """Số token đang được giữ chỗ cho các request chưa xong"""
+        return self._reserved.get(tier, 0)
+
+    def reserve(self, tier: str, tokens: int, limit: int | None = None) -> bool:
+        """Giữ chỗ `tokens` cho tier nếu tổng đã dùng + đang giữ không vượt `limit`
+
+        Không có await giữa bước kiểm tra và bước cộng nên các request đồng thời
+        không thể cùng vượt giới hạn.
+        """
+        self._check_rollover()
+        if limit is not None and self._usage.get(tier, 0) + self.reserved(tier) + tokens > limit:
+            return False
+        self._reserved[tier] = self.reserved(tier) + tokens
+        return True
+
+    def settle(self, tier: str, reserved: int, actual: int) -> int:
+        """Trả lại phần đã giữ chỗ, cộng số token thực tế và trả về tổng mới"""
+        self._reserved[tier] = max(0, self.reserved(tier) - reserved)
+        if actual:
+            return self.add(tier, actual)
+        return self.get(tier)
+
+    def snapshot(self) -> Dict[str, int | str]:
+        """Bản sao dữ liệu hiện tại theo đúng format của file JSON"""
+        self._check_rollover()
+        return {"date": self._date, **self._usage}
+
+    # --- Ghi xuống đĩa ---
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Khóa đọc-cộng-ghi giữa các process dùng chung file (process cũ và mới lúc takeover)"""
+        if fcntl is None:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self, pending: Dict[tuple[str, str], int], date: str) -> Dict[str, int]:
+        """Cộng delta vào số trong file và trả về tổng của ngày `date` (chạy trên thread riêng)"""
+        with self._file_lock():
+            usage: Dict[str, int] = {}
+            stale = True
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and data.get("date") == date:
+                    usage = {k: v for k, v in data.items() if k != "date" and isinstance(v, int)}
+                    stale = False
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logging.warning(f"Không đọc được {self.path}, bắt đầu lại từ 0: {e}")
+            # File chỉ giữ một ngày: delta của ngày đã qua không còn chỗ để cộng
+            for (day, tier), tokens in pending.items():
+                if day == date:
+                    usage[tier] = usage.get(tier, 0) + tokens
+            if pending or stale:
+                self._write({"date": date, "premium": 0, "mini": 0, **usage})
+            return usage
+
+    def _write(self, data: Dict[str, int | str]):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".token_usage.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    async def flush(self):
+        """Ghi delta xuống file và cập nhật tổng đã dùng của mọi process"""
+        async with self._flush_lock:
+            self._check_rollover()
+            date = self._date
+            pending, self._pending = self._pending, {}
+            try:
+                totals = await asyncio.to_thread(self._sync, pending, date)
+            except Exception as e:
+                for key, tokens in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + tokens
+                logging.error(f"Lỗi khi lưu token usage: {e}")
+                return
+            if date != self._date:
+                return
+            # Cộng lại phần token phát sinh trong lúc đang ghi
+            usage = {"premium": 0, "mini": 0, **totals}
+            for (day, tier), tokens in self._pending.items():
+                if day == date:
+                    usage[tier] = usage.get(tier, 0) + tokens
+            self._usage = usage
+            self._dirty = False
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Bắt đầu task flush nền (gọi khi event loop đã chạy)"""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Dừng task nền và flush lần cuối"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+class SQLiteTokenUsageLedger(TokenUsageLedger):
+    """Ledger dùng chung giữa nhiều process qua SQLite (WAL)
+
+    Mỗi process giữ phần token đã cộng nhưng chưa ghi (delta), định kỳ cộng dồn
+    delta vào database rồi đọc lại tổng của mọi process, nên hot path vẫn chỉ
+    chạm bộ nhớ. Token giữ chỗ chỉ có trong từng process: các process khác thấy
+    token đã dùng chậm nhất một chu kỳ đồng bộ.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 2.0):
+        self._conn: sqlite3.Connection | None = None
+        super().__init__(path, flush_interval)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # Các process khác có thể đang ghi cùng lúc
+            conn.execute("PRAGMA busy_timeout=5000")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_usage ("
+                " date TEXT NOT NULL,"
+                " tier TEXT NOT NULL,"
+                " tokens INTEGER NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (date, tier))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _sync(self, pending: Dict[tuple[str, str], int], date: str) -> Dict[str, int]:
+        """Cộng delta vào database và trả về tổng của ngày `date` (chạy trên thread riêng)"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for (day, tier), tokens in pending.items():
+                conn.execute(
+                    "INSERT INTO token_usage (date, tier, tokens) VALUES (?, ?, ?)"
+                    " ON CONFLICT(date, tier) DO UPDATE SET tokens = tokens + excluded.tokens",
+                    (day, tier, tokens),
+                )
+            rows = conn.execute("SELECT tier, tokens FROM token_usage WHERE date = ?", (date,)).fetchall()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return dict(rows)
+
+    def _load(self):
+        self._reset(time.time())
+        try:
+            self._usage.update(self._sync({}, self._date))
+        except sqlite3.Error as e:
+            logging.warning(f"Không đọc được {self.path}, bắt đầu lại từ 0: {e}")
+
+    async def close(self):
+        await super().close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3.10
+
+"""
+Tracing theo từng lượt hỏi cho Moon Discord Bot
+
+Mỗi lượt /chat hoặc mention tạo một trace; span hiện tại được truyền qua
+contextvars nên ask_openai, call_function và các request aiohttp trong
+functions.py tự gắn vào đúng cây span mà không phải truyền tham số. Chỉ một
+phần trace được lấy mẫu; trace không được chọn chỉ tốn một lần tra contextvar
+cho mỗi span. Span đã xong được ghi ra file JSONL xoay vòng bởi một thread nền.
+"""
+
+import json
+import logging
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from logging.handlers import QueueListener, RotatingFileHandler
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator
+
+import aiohttp
+
+
+@dataclass(slots=True)
+class Span:
+    """Một đoạn công việc trong trace, thời gian tính bằng epoch giây"""
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    start: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    end: float | None = None
+    # Đồng hồ monotonic để tính thời lượng chính xác
+    _started: float = 0.0
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "duration_ms": round((self.end - self.start) * 1000, 3) if self.end else None,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Span của trace không được lấy mẫu: mọi thao tác đều bỏ qua"""
+
+    __slots__ = ()
+
+    def set(self, **attributes: Any):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: ContextVar[Span | None] = ContextVar("moon_current_span", default=None)
+
+
+def current_span() -> Span | None:
+    """Span đang chạy trong context hiện tại (None nếu không có trace được lấy mẫu)"""
+    return _current_span.get()
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str, separators=(",", ":"))
+
+
+class SpanWriter:
+    """Ghi span ra file JSONL xoay vòng trên thread nền (không chặn event loop)"""
+
+    def __init__(self, path: str, max_bytes: int = 10_000_000, backup_count: int = 3):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True
+        )
+        self._handler.setFormatter(_JsonLineFormatter())
+        self._listener = QueueListener(self._queue, self._handler)
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._listener.start()
+            self._running = True
+
+    def write(self, span: Span):
+        # Serialize ở thread nền, event loop chỉ đưa span vào hàng đợi
+        self._queue.put_nowait(logging.makeLogRecord({"msg": span.to_dict()}))
+
+    def close(self):
+        """Ghi nốt các span còn trong hàng đợi rồi đóng file"""
+        if self._running:
+            self._listener.stop()
+            self._running = False
+        self._handler.close()
+
+
+class Tracer:
+    """Tạo trace/span và chuyển span đã xong cho SpanWriter"""
+
+    def __init__(self, writer: SpanWriter | None = None, sample_rate: float = 0.0):
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.sampled = 0
+
+    def configure(self, writer: SpanWriter | None, sample_rate: float):
+        self.writer = writer
+        self.sample_rate = max(0.0, min(1.0, sample_rate))
+
+    @property
+    def enabled(self) -> bool:
+        return self.writer is not None and self.sample_rate > 0
+
+    def start(self):
+        if self.writer is not None:
+            self.writer.start()
+            logging.info(f"Tracing to {self.writer.path} (sample rate {self.sample_rate})")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    # --- Tạo và kết thúc span ---
+    def start_span(self, name: str, parent: Span | None = None, **attributes: Any) -> Span | None:
+        """Tạo span con của `parent` (mặc định là span hiện tại), không đổi context"""
+        parent = parent or _current_span.get()
+        if parent is None:
+            return None
+        return Span(
+            parent.trace_id, _new_id(64), parent.span_id, name, time.time(), attributes,
+            _started=time.perf_counter(),
+        )
+
+    def end_span(self, span: Span | None, **attributes: Any):
+        if span is None:
+            return
+        if attributes:
+            span.attributes.update(attributes)
+        span.end = span.start + (time.perf_counter() - span._started)
+        if self.writer is not None:
+            self.writer.write(span)
+
+    @contextmanager
+    def _activate(self, span: Span) -> Iterator[Span]:
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            self.end_span(span)
+
+    @contextmanager
+    def trace(self, name: str, **attributes: Any) -> Iterator[Span | _NoopSpan]:
+        """Bắt đầu trace mới cho một lượt hỏi (quyết định lấy mẫu ở đây)"""
+        if _current_span.get() is not None:
+            # Đã nằm trong một trace: chỉ là span con
+            with self.span(name, **attributes) as span:
+                yield span
+            return
+        if not self.enabled or random.random() >= self.sample_rate:
+            yield NOOP_SPAN
+            return
+        self.sampled += 1
+        root = Span(_new_id(128), _new_id(64), None, name, time.time(), attributes, _started=time.perf_counter())
+        with self._activate(root) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span | _NoopSpan]:
+        """Span con của span hiện tại; không làm gì nếu trace không được lấy mẫu"""
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield NOOP_SPAN
+            return
+        with self._activate(span) as span:
+            yield span
+
+    @contextmanager
+    def resume(self, parent: Span | None, name: str, **attributes: Any) -> Iterator[Span | _NoopSpan]:
+        """Tiếp tục trace của `parent` trong một task khác (ví dụ worker của kênh)"""
+        token = _current_span.set(parent)
+        try:
+            with self.span(name, **attributes) as span:
+                yield span
+        finally:
+            _current_span.reset(token)
+
+    # --- aiohttp ---
+    def aiohttp_trace_config(self) -> aiohttp.TraceConfig:
+        """TraceConfig tạo span cho mỗi request HTTP của session dùng chung"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestStartParams):
+            ctx.span = self.start_span("http", method=params.method, host=params.url.host, path=params.url.path)
+
+        async def on_request_end(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams):
+            self.end_span(getattr(ctx, "span", None), status=params.response.status)
+
+        async def on_request_exception(session, ctx: SimpleNamespace, params: aiohttp.TraceRequestExceptionParams):
+            self.end_span(getattr(ctx, "span", None), error=type(params.exception).__name__)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+
+# Tracer dùng chung trong bot, được cấu hình trong main.py
+TRACER = Tracer()